@@ -10,38 +10,84 @@ from dotenv import load_dotenv
 from openai import AsyncAzureOpenAI, AsyncOpenAI
 from opentelemetry.instrumentation.openai import OpenAIInstrumentor
 from opentelemetry.instrumentation.sqlalchemy import SQLAlchemyInstrumentor
-from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker
 
+from fastapi_app.answer_cache import configure_answer_cache
+from fastapi_app.citation_graph import CitationGraphStore, citation_graph_enabled
 from fastapi_app.dependencies import (
     FastAPIAppContext,
     common_parameters,
     create_async_sessionmaker,
     get_azure_credential,
 )
+from fastapi_app.embeddings import configure_embedding_cache, embedding_cache
 from fastapi_app.openai_clients import create_openai_chat_client, create_openai_embed_client
-from fastapi_app.postgres_engine import create_postgres_engine_from_env
+from fastapi_app.postgres_engine import (
+    create_postgres_engine_from_env,
+    create_postgres_replica_engines_from_env,
+    register_pool_metrics,
+)
+from fastapi_app.read_replicas import ReadReplicaRouter
 
 logger = logging.getLogger("ragapp")
 
 
 class State(TypedDict):
+    engine: AsyncEngine
+    replica_engines: list[AsyncEngine]
     sessionmaker: async_sessionmaker[AsyncSession]
+    read_replica_router: ReadReplicaRouter
     context: FastAPIAppContext
     chat_client: AsyncOpenAI | AsyncAzureOpenAI
     embed_client: AsyncOpenAI | AsyncAzureOpenAI
+    citation_graph_store: CitationGraphStore | None
 
 
 @asynccontextmanager
 async def lifespan(app: fastapi.FastAPI) -> AsyncIterator[State]:
     context = await common_parameters()
     azure_credential = await get_azure_credential()
-    engine = await create_postgres_engine_from_env(azure_credential)
+    engine = await create_postgres_engine_from_env(azure_credential, load_age=True)
     sessionmaker = await create_async_sessionmaker(engine)
+    # Searches read from the replicas when POSTGRES_REPLICA_HOSTS is set, writes and seeding stay on the primary
+    replica_engines = await create_postgres_replica_engines_from_env(azure_credential, load_age=True)
+    read_replica_router = ReadReplicaRouter(
+        sessionmaker,
+        [await create_async_sessionmaker(replica_engine) for replica_engine in replica_engines],
+        retry_after=float(os.getenv("POSTGRES_REPLICA_RETRY_SECONDS", 30)),
+    )
+    configure_embedding_cache(engine)
+    configure_answer_cache(engine)
     chat_client = await create_openai_chat_client(azure_credential)
     embed_client = await create_openai_embed_client(azure_credential)
+    citation_graph_store = None
+    if citation_graph_enabled():
+        citation_graph_store = CitationGraphStore(
+            sessionmaker, poll_interval=float(os.getenv("CITATION_GRAPH_POLL_SECONDS", 30))
+        )
+        try:
+            await citation_graph_store.refresh()
+        except Exception as e:
+            logger.warning("Failed to load the in-process citation graph, GraphRAG will rank in SQL: %s", e)
+        citation_graph_store.start()
     if os.getenv("APPLICATIONINSIGHTS_CONNECTION_STRING"):
-        SQLAlchemyInstrumentor().instrument(engine=engine.sync_engine)
-    yield {"sessionmaker": sessionmaker, "context": context, "chat_client": chat_client, "embed_client": embed_client}
+        SQLAlchemyInstrumentor().instrument(engines=[each.sync_engine for each in [engine, *replica_engines]])
+        register_pool_metrics([engine, *replica_engines])
+    yield {
+        "engine": engine,
+        "replica_engines": replica_engines,
+        "sessionmaker": sessionmaker,
+        "read_replica_router": read_replica_router,
+        "context": context,
+        "chat_client": chat_client,
+        "embed_client": embed_client,
+        "citation_graph_store": citation_graph_store,
+    }
+    if citation_graph_store is not None:
+        await citation_graph_store.stop()
+    await embedding_cache.flush()
+    for replica_engine in replica_engines:
+        await replica_engine.dispose()
     await engine.dispose()
 
 
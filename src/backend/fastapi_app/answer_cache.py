@@ -0,0 +1,126 @@
+import json
+import logging
+import os
+from collections.abc import Sequence
+from datetime import UTC, datetime, timedelta
+from typing import Any
+
+from sqlalchemy import delete, select
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker
+
+from fastapi_app.api_models import ChatParams
+from fastapi_app.caching import hash_key
+from fastapi_app.postgres_models import AnswerCacheEntry
+
+logger = logging.getLogger("ragapp")
+
+
+class AnswerCache:
+    """
+    Semantic answer cache in the `answer_cache` table: a question within max_distance (cosine) of a cached one,
+    with the same retrieval mode and filters, is answered with the cached answer. Entries expire after ttl seconds.
+    """
+
+    def __init__(self, max_distance: float, ttl: float):
+        self.max_distance = max_distance
+        self.ttl = ttl
+        self.sessionmaker: async_sessionmaker[AsyncSession] | None = None
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+
+    def enabled_for(self, chat_params: ChatParams) -> bool:
+        # Answers that depend on earlier turns of the conversation are not reused
+        return self.sessionmaker is not None and chat_params.use_answer_cache and not chat_params.past_messages
+
+    @staticmethod
+    def filters_key(chat_params: ChatParams, filters: list[dict] | None) -> str:
+        """Hash of the search filters and the request settings that change the answer besides the question."""
+        return hash_key(
+            json.dumps(filters or [], sort_keys=True, default=str),
+            chat_params.top,
+            chat_params.consider_n,
+            chat_params.ef_search,
+            chat_params.graph_candidates,
+            chat_params.temperature,
+            chat_params.use_advanced_flow,
+            chat_params.prompt_template,
+        )
+
+    def expires_before(self) -> datetime:
+        return datetime.now(UTC) - timedelta(seconds=self.ttl)
+
+    async def get(
+        self, question_vector: list[float], retrieval_mode: str, filters_key: str
+    ) -> tuple[AnswerCacheEntry, float] | None:
+        if self.sessionmaker is None:
+            return None
+        distance = AnswerCacheEntry.question_vector.cosine_distance(question_vector)
+        query = (
+            select(AnswerCacheEntry, distance)
+            .where(
+                AnswerCacheEntry.retrieval_mode == retrieval_mode,
+                AnswerCacheEntry.filters_key == filters_key,
+                AnswerCacheEntry.created_at > self.expires_before(),
+            )
+            .order_by(distance)
+            .limit(1)
+        )
+        try:
+            async with self.sessionmaker() as session:
+                row = (await session.execute(query)).first()
+        except Exception as e:
+            logger.warning("Failed to read the answer cache: %s", e)
+            return None
+        if row is None or row[1] > self.max_distance:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return row[0], float(row[1])
+
+    async def set(
+        self,
+        question: str,
+        question_vector: list[float],
+        retrieval_mode: str,
+        filters_key: str,
+        case_ids: Sequence[Any],
+        answer: str,
+    ) -> None:
+        if self.sessionmaker is None or not answer:
+            return
+        entry = AnswerCacheEntry(
+            question=question,
+            question_vector=question_vector,
+            retrieval_mode=retrieval_mode,
+            filters_key=filters_key,
+            case_ids=[str(case_id) for case_id in case_ids],
+            answer=answer,
+        )
+        try:
+            async with self.sessionmaker() as session:
+                session.add(entry)
+                # Expired entries are never served, remove them while writing
+                await session.execute(
+                    delete(AnswerCacheEntry).where(AnswerCacheEntry.created_at <= self.expires_before())
+                )
+                await session.commit()
+            self.stores += 1
+        except Exception as e:
+            logger.warning("Failed to write the answer cache: %s", e)
+
+    def stats(self) -> dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "stores": self.stores}
+
+
+answer_cache = AnswerCache(
+    max_distance=float(os.getenv("ANSWER_CACHE_MAX_DISTANCE", 0.05)),
+    ttl=float(os.getenv("ANSWER_CACHE_TTL_SECONDS", 86400)),
+)
+
+
+def configure_answer_cache(engine: AsyncEngine) -> None:
+    """Attach the answer cache to the primary database when ANSWER_CACHE_ENABLED is set."""
+    if os.getenv("ANSWER_CACHE_ENABLED", "false").lower() == "true":
+        logger.info("Using the semantic answer cache")
+        answer_cache.sessionmaker = async_sessionmaker(engine, expire_on_commit=False)
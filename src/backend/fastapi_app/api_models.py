@@ -1,8 +1,8 @@
-from enum import Enum
+from enum import Enum, StrEnum
 from typing import Any
 
 from openai.types.chat import ChatCompletionMessageParam
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
 
 class AIChatRoles(str, Enum):
@@ -23,12 +23,29 @@ class RetrievalMode(str, Enum):
     MSRGRAPHRAG = "MSR GraphRAG"
 
 
+class RewritePolicy(StrEnum):
+    ALWAYS = "always"
+    NEVER = "never"
+    AUTO = "auto"
+
+
 class ChatRequestOverrides(BaseModel):
-    top: int = 3
+    top: int = Field(default=3, ge=1)
     temperature: float = 0.3
     retrieval_mode: RetrievalMode = RetrievalMode.VECTOR
     use_advanced_flow: bool = True
     prompt_template: str | None = None
+    # Candidate pool size and hnsw.ef_search, None for the retrieval mode defaults; capped by the server
+    consider_n: int | None = None
+    ef_search: int | None = None
+    # MSR GraphRAG candidates whose citations are counted, None for the default; capped by the server
+    graph_candidates: int | None = None
+    # Simple flow: embed the original query while it is rewritten, search with it if the rewrite matches
+    speculative_search: bool = False
+    # Simple flow: when to rewrite the query with the chat model, None for QUERY_REWRITE_POLICY
+    rewrite_policy: RewritePolicy | None = None
+    # Serve near-duplicate questions from the answer cache, when ANSWER_CACHE_ENABLED is set
+    use_answer_cache: bool = True
 
 
 class ChatRequestContext(BaseModel):
@@ -84,6 +101,8 @@ class ItemWithDistance(ItemPublic):
 
 class ChatParams(ChatRequestOverrides):
     prompt_template: str
+    # Resolved by get_params, QUERY_REWRITE_POLICY when the request has none
+    rewrite_policy: RewritePolicy
     response_token_limit: int = 1024
     enable_text_search: bool
     enable_vector_search: bool
@@ -0,0 +1,376 @@
+import argparse
+import asyncio
+import json
+import logging
+import math
+import time
+from datetime import UTC, datetime
+from typing import Any
+
+import numpy as np
+from dotenv import load_dotenv
+from pgvector.sqlalchemy import Vector
+from sqlalchemy import column, text
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from fastapi_app.api_models import RetrievalMode
+from fastapi_app.citation_graph import load_citation_graph
+from fastapi_app.dependencies import common_parameters, get_azure_credential
+from fastapi_app.embeddings import embedding_cache
+from fastapi_app.openai_clients import create_openai_embed_client
+from fastapi_app.postgres_engine import create_postgres_engine_from_args, create_postgres_engine_from_env
+from fastapi_app.postgres_searcher import QUANTIZATION_OVERSAMPLE, VECTOR_QUANTIZATIONS, PostgresSearcher
+
+logger = logging.getLogger("legalcaseapp")
+
+# The question the gold_dataset labels were judged against
+DEFAULT_QUERIES = ["Water leaking into the apartment from the floor above."]
+
+# Graded gains of the gold_dataset labels, by label prefix
+LABEL_GAINS = {"gold": 3, "orig": 2, "maybe": 1, "no": 0}
+# Cases with at least this gain count as relevant for recall
+RELEVANT_GAIN = 2
+
+STUB_EMBEDDING_MODEL = "benchmark-stub"
+# Number of full-text matches whose description vectors are averaged into a stub query embedding
+STUB_EMBEDDING_MATCHES = 10
+
+
+def label_gain(label: str | None) -> int:
+    if not label:
+        return 0
+    return LABEL_GAINS.get(label.split("-")[0], 0)
+
+
+def recall_at_k(case_ids: list[str], gains: dict[str, int], k: int) -> float:
+    relevant = {case_id for case_id, gain in gains.items() if gain >= RELEVANT_GAIN}
+    if not relevant:
+        return 0.0
+    return len(relevant.intersection(case_ids[:k])) / len(relevant)
+
+
+def ndcg_at_k(case_ids: list[str], gains: dict[str, int], k: int) -> float:
+    dcg = sum(gains.get(case_id, 0) / math.log2(position + 2) for position, case_id in enumerate(case_ids[:k]))
+    ideal = sorted(gains.values(), reverse=True)[:k]
+    idcg = sum(gain / math.log2(position + 2) for position, gain in enumerate(ideal))
+    return dcg / idcg if idcg > 0 else 0.0
+
+
+def latency_summary(values: list[float]) -> dict[str, float]:
+    if not values:
+        return {}
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {"p50": round(float(p50), 2), "p95": round(float(p95), 2), "p99": round(float(p99), 2)}
+
+
+async def load_gold_gains(session: AsyncSession) -> dict[str, int]:
+    rows = await session.execute(text("SELECT gold_id, label FROM gold_dataset;"))
+    return {row.gold_id: label_gain(row.label) for row in rows}
+
+
+async def install_stub_reranker(session: AsyncSession):
+    """
+    Define a local azure_ml.invoke that scores the reranker pairs with full-text ts_rank,
+    so the ranking functions run against a Postgres without the azure_ai extension.
+    """
+    existing = await session.scalar(
+        text(
+            """
+            SELECT COUNT(*) FROM pg_proc
+            JOIN pg_namespace ON pg_namespace.oid = pg_proc.pronamespace
+            WHERE pg_namespace.nspname = 'azure_ml' AND pg_proc.proname = 'invoke'
+                AND obj_description(pg_proc.oid, 'pg_proc') IS DISTINCT FROM 'benchmark stub';
+        """
+        )
+    )
+    if existing:
+        raise RuntimeError("azure_ml.invoke is already installed, refusing to replace it with the benchmark stub")
+
+    await session.execute(text("CREATE SCHEMA IF NOT EXISTS azure_ml;"))
+    await session.execute(
+        text(
+            """
+            CREATE OR REPLACE FUNCTION azure_ml.invoke(
+                input_data JSONB,
+                deployment_name TEXT DEFAULT NULL,
+                timeout_ms INT DEFAULT NULL
+            )
+            RETURNS JSONB AS $_$
+                SELECT COALESCE(
+                    jsonb_agg(
+                        ts_rank(to_tsvector('english', pairs.pair ->> 1), plainto_tsquery('english', pairs.pair ->> 0))
+                        ORDER BY pairs.ord
+                    ),
+                    '[]'::jsonb
+                )
+                FROM jsonb_array_elements(input_data -> 'pairs') WITH ORDINALITY AS pairs(pair, ord);
+            $_$ LANGUAGE sql IMMUTABLE;
+        """
+        )
+    )
+    await session.execute(text("COMMENT ON FUNCTION azure_ml.invoke(jsonb, text, integer) IS 'benchmark stub';"))
+    await session.commit()
+    logger.info("Installed the stub azure_ml.invoke reranker.")
+
+
+async def stub_text_embedding(session: AsyncSession, query_text: str) -> list[float]:
+    """
+    Pseudo-relevance embedding: the mean description vector of the cases whose opinion best matches the query
+    in full-text search, or of all cases when none has an opinion. Deterministic and close enough to the real
+    embedding to exercise the HNSW index.
+    """
+    sql = text(
+        """
+        SELECT COALESCE(
+            AVG(matches.description_vector),
+            (SELECT AVG(cases_updated.description_vector) FROM cases_updated)
+        ) AS embedding
+        FROM (
+            SELECT cases_updated.description_vector
+            FROM cases_updated
+            JOIN case_opinions ON case_opinions.case_id = cases_updated.id AND case_opinions.ordinal = 0
+            WHERE cases_updated.description_vector IS NOT NULL
+            ORDER BY ts_rank(
+                to_tsvector('english', case_opinions.text),
+                plainto_tsquery('english', :query_text)
+            ) DESC
+            LIMIT :matches
+        ) AS matches;
+    """
+    ).columns(column("embedding", Vector(1536)))
+    embedding = await session.scalar(sql, {"query_text": query_text, "matches": STUB_EMBEDDING_MATCHES})
+    if embedding is None or len(embedding) == 0:
+        raise RuntimeError("No case has a description vector, seed the database before running the benchmark")
+    return [float(value) for value in embedding]
+
+
+async def vector_index_bytes(session: AsyncSession, quantization: str) -> int:
+    """Total size of the whole-table and per-court HNSW indexes used by the first pass of a quantization setting."""
+    # Index names from setup_postgres_legal_database.vector_index_name
+    suffix = f"_{quantization}" if quantization != "none" else ""
+    pattern = f"^cases_updated_description_vector(_court_[0-9]+)?{suffix}_idx$"
+    size = await session.scalar(
+        text(
+            """
+            SELECT COALESCE(SUM(pg_relation_size(indexrelid)), 0)
+            FROM pg_stat_user_indexes
+            WHERE relname = 'cases_updated' AND indexrelname ~ :pattern;
+        """
+        ),
+        {"pattern": pattern},
+    )
+    return int(size)
+
+
+async def benchmark_mode(
+    args,
+    sessionmaker: async_sessionmaker[AsyncSession],
+    mode: RetrievalMode,
+    quantization: str,
+    queries: list[str],
+    gains: dict[str, int],
+    openai_embed_client,
+    common_params,
+    citation_graph,
+) -> dict[str, Any]:
+    latencies: dict[str, list[float]] = {"total": []}
+    query_results = []
+    for query_text in queries:
+        case_ids: list[str] = []
+        for run in range(args.warmup + args.runs):
+            if args.cold:
+                embedding_cache.memory.clear()
+            async with sessionmaker() as session:
+                searcher = PostgresSearcher(
+                    db_session=session,
+                    openai_embed_client=openai_embed_client,
+                    embed_deployment=common_params.openai_embed_deployment if common_params else None,
+                    embed_model=common_params.openai_embed_model if common_params else STUB_EMBEDDING_MODEL,
+                    embed_dimensions=common_params.openai_embed_dimensions if common_params else 1536,
+                    embedding_column=common_params.embedding_column if common_params else "description_vector",
+                    citation_graph=citation_graph,
+                    vector_quantization=quantization,
+                )
+                start = time.perf_counter()
+                if args.stub_endpoints:
+                    embedding_start = time.perf_counter()
+                    vector = await stub_text_embedding(session, query_text)
+                    embedding_ms = (time.perf_counter() - embedding_start) * 1000
+                    results = await searcher.search(
+                        query_text, vector, args.top, None, mode, args.consider_n, args.ef_search, args.graph_candidates
+                    )
+                    searcher.stage_timings["embedding"] = embedding_ms
+                else:
+                    results = await searcher.search_and_embed(
+                        mode,
+                        query_text,
+                        top=args.top,
+                        consider_n=args.consider_n,
+                        ef_search=args.ef_search,
+                        graph_candidates=args.graph_candidates,
+                    )
+                total_ms = (time.perf_counter() - start) * 1000
+                await session.commit()
+
+            case_ids = [case.id for case in results]
+            if run < args.warmup:
+                continue
+            latencies["total"].append(total_ms)
+            for stage, elapsed_ms in searcher.stage_timings.items():
+                latencies.setdefault(stage, []).append(elapsed_ms)
+
+        query_results.append(
+            {
+                "query": query_text,
+                "case_ids": case_ids,
+                f"recall@{args.top}": recall_at_k(case_ids, gains, args.top),
+                f"ndcg@{args.top}": ndcg_at_k(case_ids, gains, args.top),
+            }
+        )
+
+    return {
+        f"recall@{args.top}": float(np.mean([result[f"recall@{args.top}"] for result in query_results])),
+        f"ndcg@{args.top}": float(np.mean([result[f"ndcg@{args.top}"] for result in query_results])),
+        "latency_ms": {stage: latency_summary(values) for stage, values in latencies.items()},
+        "queries": query_results,
+    }
+
+
+async def run_benchmark(args, engine) -> dict[str, Any]:
+    sessionmaker = async_sessionmaker(engine, expire_on_commit=False)
+    modes = [RetrievalMode(mode) for mode in args.modes]
+    queries = DEFAULT_QUERIES
+    if args.queries:
+        with open(args.queries, encoding="utf-8") as file:
+            queries = json.load(file)
+
+    async with sessionmaker() as session:
+        gains = await load_gold_gains(session)
+        if args.stub_endpoints:
+            await install_stub_reranker(session)
+        citation_graph = await load_citation_graph(session) if args.citation_graph else None
+
+    openai_embed_client = None
+    common_params = None
+    if not args.stub_endpoints:
+        azure_credential = await get_azure_credential()
+        openai_embed_client = await create_openai_embed_client(azure_credential)
+        common_params = await common_parameters()
+
+    report: dict[str, Any] = {
+        "started_at": datetime.now(UTC).isoformat(),
+        "settings": {
+            "top": args.top,
+            "consider_n": args.consider_n,
+            "ef_search": args.ef_search,
+            "graph_candidates": args.graph_candidates,
+            "quantization_oversample": QUANTIZATION_OVERSAMPLE,
+            "runs": args.runs,
+            "warmup": args.warmup,
+            "stub_endpoints": args.stub_endpoints,
+            "citation_graph": args.citation_graph,
+            "queries": queries,
+        },
+        "quantization": {},
+    }
+
+    for quantization in args.quantization:
+        async with sessionmaker() as session:
+            index_bytes = await vector_index_bytes(session, quantization)
+        if index_bytes == 0:
+            logger.warning(f"No {quantization} HNSW index found, its first pass scans the table")
+        setting_report: dict[str, Any] = {"index_bytes": index_bytes, "modes": {}}
+        report["quantization"][quantization] = setting_report
+
+        for mode in modes:
+            try:
+                mode_report = await benchmark_mode(
+                    args,
+                    sessionmaker,
+                    mode,
+                    quantization,
+                    queries,
+                    gains,
+                    openai_embed_client,
+                    common_params,
+                    citation_graph,
+                )
+            except Exception as e:
+                logger.error(f"Benchmark of {mode.value} with {quantization} vectors failed: {e}")
+                setting_report["modes"][mode.value] = {"error": str(e)}
+                continue
+
+            setting_report["modes"][mode.value] = mode_report
+            logger.info(
+                "%s/%s: index=%.1fMB recall@%d=%.3f ndcg@%d=%.3f p50=%.1fms p95=%.1fms",
+                quantization,
+                mode.value,
+                index_bytes / 1024 / 1024,
+                args.top,
+                mode_report[f"recall@{args.top}"],
+                args.top,
+                mode_report[f"ndcg@{args.top}"],
+                mode_report["latency_ms"]["total"].get("p50", 0.0),
+                mode_report["latency_ms"]["total"].get("p95", 0.0),
+            )
+
+    return report
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Benchmark retrieval quality and latency against gold_dataset")
+    parser.add_argument("--host", type=str, help="Postgres host")
+    parser.add_argument("--username", type=str, help="Postgres username")
+    parser.add_argument("--password", type=str, help="Postgres password")
+    parser.add_argument("--database", type=str, help="Postgres database")
+    parser.add_argument("--sslmode", type=str, help="Postgres sslmode")
+    parser.add_argument(
+        "--modes",
+        nargs="+",
+        default=[mode.value for mode in RetrievalMode],
+        choices=[mode.value for mode in RetrievalMode],
+        help="Retrieval modes to benchmark",
+    )
+    parser.add_argument(
+        "--quantization",
+        nargs="+",
+        default=["none"],
+        choices=list(VECTOR_QUANTIZATIONS),
+        help="First-pass vector precisions to compare, each needs its index from setup_postgres_legal_database",
+    )
+    parser.add_argument("--queries", type=str, help="JSON file with a list of query strings judged by gold_dataset")
+    parser.add_argument("--top", type=int, default=10, help="Number of results, the k of recall@k and nDCG@k")
+    parser.add_argument("--consider-n", type=int, help="Candidate pool size, defaults to the retrieval mode default")
+    parser.add_argument("--ef-search", type=int, help="hnsw.ef_search, defaults to the candidate pool size")
+    parser.add_argument("--graph-candidates", type=int, help="MSR GraphRAG candidates whose citations are counted")
+    parser.add_argument("--runs", type=int, default=20, help="Measured runs per query")
+    parser.add_argument("--warmup", type=int, default=2, help="Unmeasured runs per query before the measured ones")
+    parser.add_argument("--cold", action="store_true", help="Clear the in-process embedding cache before every run")
+    parser.add_argument("--citation-graph", action="store_true", help="Rank GraphRAG with the in-process graph")
+    parser.add_argument(
+        "--stub-endpoints",
+        action="store_true",
+        help="Use a full-text stub for the embedding and the azure_ml.invoke reranker, for a local Postgres",
+    )
+    parser.add_argument("--output", type=str, default="benchmark_results.json", help="JSON file for the report")
+
+    # if no args are specified, use environment variables
+    args = parser.parse_args()
+    if args.host is None:
+        engine = await create_postgres_engine_from_env()
+    else:
+        engine = await create_postgres_engine_from_args(args)
+
+    report = await run_benchmark(args, engine)
+    with open(args.output, "w", encoding="utf-8") as file:
+        json.dump(report, file, indent=2)
+    logger.info(f"Benchmark report written to {args.output}")
+
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    logger.setLevel(logging.INFO)
+    load_dotenv(override=True)
+    asyncio.run(main())
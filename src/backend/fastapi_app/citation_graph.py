@@ -0,0 +1,244 @@
+import asyncio
+import contextlib
+import logging
+import os
+from collections.abc import Mapping, Sequence
+from datetime import datetime
+from typing import Any
+
+import numpy as np
+from sqlalchemy import Text, any_, bindparam, func, select, text
+from sqlalchemy.dialects.postgresql import ARRAY, insert
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from fastapi_app.postgres_models import Case, CitationGraphRefresh
+
+logger = logging.getLogger("legalcaseapp")
+
+# Same constants as the graph stage of get_vector_semantic_graphrag_optimized
+GRAPH_CANDIDATES = 25
+GRAPH_REF_LIMIT = 200
+RRF_K = 60
+# Dimensions of cases_updated.description_vector
+VECTOR_DIMENSIONS = 1536
+
+
+def rank(values: Sequence[Any], descending: bool = False) -> list[int]:
+    """
+    SQL RANK() over the given values: ties share a rank and leave a gap after them.
+    Tuples rank like an ORDER BY over several columns.
+    """
+    order = sorted(range(len(values)), key=lambda i: values[i], reverse=descending)
+    ranks = [0] * len(values)
+    for position, i in enumerate(order):
+        if position > 0 and values[i] == values[order[position - 1]]:
+            ranks[i] = ranks[order[position - 1]]
+        else:
+            ranks[i] = position + 1
+    return ranks
+
+
+class CitationGraph:
+    """
+    Citation edges in compressed sparse row form, indexed by cited case:
+    the citers of case i are neighbors[offsets[i]:offsets[i + 1]].
+    The unit-normalized description vectors of the citing cases are kept as float16, about 3 KB per citer,
+    so the citers are ordered by their distance to the query without a database round trip.
+    """
+
+    def __init__(
+        self,
+        case_ids: list[str],
+        offsets: np.ndarray,
+        neighbors: np.ndarray,
+        citer_vectors: np.ndarray,
+        vector_rows: np.ndarray,
+    ):
+        self.case_ids = case_ids
+        self.index = {case_id: i for i, case_id in enumerate(case_ids)}
+        self.offsets = offsets
+        self.neighbors = neighbors
+        self.citer_vectors = citer_vectors
+        # Row of case i in citer_vectors, -1 for cases that cite nothing or have no vector
+        self.vector_rows = vector_rows
+
+    @classmethod
+    def from_edges(
+        cls,
+        case_ids: list[str],
+        citing: np.ndarray,
+        cited: np.ndarray,
+        citer_vectors: np.ndarray,
+        vector_rows: np.ndarray,
+    ) -> "CitationGraph":
+        order = np.argsort(cited, kind="stable")
+        neighbors = citing[order].astype(np.int32)
+        offsets = np.zeros(len(case_ids) + 1, dtype=np.int32)
+        offsets[1:] = np.cumsum(np.bincount(cited, minlength=len(case_ids)))
+        return cls(case_ids, offsets, neighbors, citer_vectors, vector_rows)
+
+    @property
+    def edge_count(self) -> int:
+        return len(self.neighbors)
+
+    def in_degree(self, case_id: str) -> int:
+        """Number of citers of the case, as case_citation_counts.in_degree"""
+        i = self.index.get(case_id)
+        if i is None:
+            return 0
+        return int(self.offsets[i + 1] - self.offsets[i])
+
+    def citers(self, case_id: str) -> np.ndarray:
+        i = self.index.get(case_id)
+        if i is None:
+            return np.empty(0, dtype=np.int32)
+        return self.neighbors[self.offsets[i] : self.offsets[i + 1]]
+
+    def count_refs(self, candidate_ids: Sequence[str], query_vector: Sequence[float]) -> dict[str, int]:
+        """
+        Count the citers of each candidate among the GRAPH_REF_LIMIT citing cases closest to the query,
+        like the graph CTE of the ranking function does.
+        """
+        citers = [self.citers(candidate_id) for candidate_id in candidate_ids]
+        if not any(len(candidate_citers) for candidate_citers in citers):
+            return {}
+        owners = np.concatenate(
+            [
+                np.full(len(candidate_citers), position, dtype=np.int32)
+                for position, candidate_citers in enumerate(citers)
+            ]
+        )
+        rows = self.vector_rows[np.concatenate(citers)]
+
+        query = np.asarray(query_vector, dtype=np.float32)
+        query /= np.linalg.norm(query) or 1.0
+        # Citers without a vector sort last, as NULL distances do in SQL
+        distances = np.full(len(rows), np.inf)
+        has_vector = rows >= 0
+        distances[has_vector] = 1.0 - self.citer_vectors[rows[has_vector]].astype(np.float32) @ query
+
+        closest = np.argsort(distances, kind="stable")[:GRAPH_REF_LIMIT]
+        counts = np.bincount(owners[closest], minlength=len(candidate_ids))
+        return {candidate_ids[position]: int(count) for position, count in enumerate(counts) if count > 0}
+
+    def rank_candidates(
+        self, candidates: Sequence[Mapping[str, Any]], query_vector: Sequence[float], top: int
+    ) -> list[Mapping[str, Any]]:
+        """
+        Add graph_rank, refs and the reciprocal rank fusion score to semantically ranked candidates
+        and return the top ones by score.
+        """
+        graph_candidates = [row["id"] for row in candidates if row["semantic_rank"] <= GRAPH_CANDIDATES]
+        refs = self.count_refs(graph_candidates, query_vector)
+
+        # Ties in refs are broken by the in-degree, like the graph_ranked CTE
+        graph_ranks = rank([(refs.get(row["id"], 0), self.in_degree(row["id"])) for row in candidates], descending=True)
+        ranked: list[Mapping[str, Any]] = []
+        for row, graph_rank in zip(candidates, graph_ranks):
+            ranked.append(
+                {
+                    **row,
+                    "refs": refs.get(row["id"]),
+                    "graph_rank": graph_rank,
+                    "score": 1.0 / (RRF_K + graph_rank) + 1.0 / (RRF_K + row["semantic_rank"]),
+                }
+            )
+        ranked.sort(key=lambda row: row["score"], reverse=True)
+        return ranked[:top]
+
+
+async def load_citation_graph(session: AsyncSession) -> CitationGraph:
+    """Load the case ids, the citation edges and the vectors of the citing cases into a CitationGraph."""
+    case_ids = list((await session.scalars(select(Case.id).order_by(Case.id))).all())
+    index = {case_id: i for i, case_id in enumerate(case_ids)}
+
+    citing_indexes = []
+    cited_indexes = []
+    for edge in await session.execute(text("SELECT citing_id, cited_id FROM case_citations")):
+        if edge.citing_id in index and edge.cited_id in index:
+            citing_indexes.append(index[edge.citing_id])
+            cited_indexes.append(index[edge.cited_id])
+    citing = np.array(citing_indexes, dtype=np.int32)
+    cited = np.array(cited_indexes, dtype=np.int32)
+
+    # Only the citing cases are ever ordered by distance, the other cases keep no vector
+    citer_indexes = np.unique(citing)
+    citer_vectors = np.zeros((len(citer_indexes), VECTOR_DIMENSIONS), dtype=np.float16)
+    vector_rows = np.full(len(case_ids), -1, dtype=np.int32)
+    query = select(Case.id, Case.description_vector).where(
+        Case.id == any_(bindparam("ids", [case_ids[i] for i in citer_indexes], ARRAY(Text))),
+        Case.description_vector.is_not(None),
+    )
+    for row, (case_id, vector) in enumerate(await session.execute(query)):
+        vector = np.asarray(vector, dtype=np.float32)
+        citer_vectors[row] = vector / (np.linalg.norm(vector) or 1.0)
+        vector_rows[index[case_id]] = row
+
+    return CitationGraph.from_edges(case_ids, citing, cited, citer_vectors, vector_rows)
+
+
+class CitationGraphStore:
+    """
+    Holds the in-process citation graph and reloads it on demand, e.g. after seeding.
+    A reload request is recorded in the citation_graph_refresh table, and every worker polls it
+    every poll_interval seconds, so a refresh on one worker reaches all of them.
+    """
+
+    def __init__(self, sessionmaker: async_sessionmaker[AsyncSession], poll_interval: float = 30):
+        self.sessionmaker = sessionmaker
+        self.poll_interval = poll_interval
+        self.graph: CitationGraph | None = None
+        # requested_at of the refresh request the current graph was loaded for
+        self.loaded_for: datetime | None = None
+        self._lock = asyncio.Lock()
+        self._poll_task: asyncio.Task | None = None
+
+    async def refresh(self) -> CitationGraph:
+        async with self._lock:
+            async with self.sessionmaker() as session:
+                requested_at = await self.requested_at(session)
+                graph = await load_citation_graph(session)
+            # Swap the reference so in-flight searches keep using the graph they started with
+            self.graph = graph
+            self.loaded_for = requested_at
+            logger.info("Loaded citation graph with %d cases and %d edges", len(graph.case_ids), graph.edge_count)
+            return graph
+
+    async def request_refresh(self) -> CitationGraph:
+        """Record a reload request for the other workers, and reload the graph of this one."""
+        statement = insert(CitationGraphRefresh).values(id=1, requested_at=func.now())
+        statement = statement.on_conflict_do_update(
+            index_elements=[CitationGraphRefresh.id], set_={"requested_at": statement.excluded.requested_at}
+        )
+        async with self.sessionmaker() as session:
+            await session.execute(statement)
+            await session.commit()
+        return await self.refresh()
+
+    @staticmethod
+    async def requested_at(session: AsyncSession) -> datetime | None:
+        return await session.scalar(select(CitationGraphRefresh.requested_at).where(CitationGraphRefresh.id == 1))
+
+    async def poll(self) -> None:
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                async with self.sessionmaker() as session:
+                    requested_at = await self.requested_at(session)
+                if requested_at is not None and (self.loaded_for is None or requested_at > self.loaded_for):
+                    await self.refresh()
+            except Exception as e:
+                logger.warning("Failed to check for a citation graph refresh: %s", e)
+
+    def start(self) -> None:
+        self._poll_task = asyncio.create_task(self.poll())
+
+    async def stop(self) -> None:
+        if self._poll_task is not None:
+            self._poll_task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._poll_task
+
+
+def citation_graph_enabled() -> bool:
+    return os.getenv("CITATION_GRAPH_IN_MEMORY", "false").lower() == "true"
@@ -0,0 +1,69 @@
+import os
+from functools import lru_cache
+
+import tiktoken
+
+from fastapi_app.postgres_models import Case
+
+# Token budget of the sources in the answer prompt, shared by the top-k cases
+CONTEXT_TOKEN_BUDGET = int(os.getenv("RAG_CONTEXT_TOKEN_BUDGET", 2000))
+# Upper bound of the characters in a token, an opinion prefix of budget * MAX_CHARS_PER_TOKEN characters holds
+# more tokens than the budget can give to any one case
+MAX_CHARS_PER_TOKEN = 8
+
+
+def opinion_char_limit(budget: int = CONTEXT_TOKEN_BUDGET) -> int:
+    """Length of the opinion prefix to fetch per case, the rest of the text can never fit in the budget"""
+    return budget * MAX_CHARS_PER_TOKEN
+
+
+@lru_cache(maxsize=8)
+def get_encoding(model: str) -> tiktoken.Encoding:
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def render_sources(headers: list[str], opinions: list[str]) -> str:
+    return "\n".join(
+        (f"{header} | Opinion: {opinion}" if opinion else header) + "\n\n" for header, opinion in zip(headers, opinions)
+    )
+
+
+def pack_context(
+    cases: list[Case], opinion_texts: dict[str, str], model: str, budget: int = CONTEXT_TOKEN_BUDGET
+) -> tuple[str, int]:
+    """
+    Build the sources of the answer prompt within a token budget. Every case gets its whitelisted metadata,
+    and the tokens left are shared among the full opinion texts by rank: the case at rank r is weighted 1 / r,
+    and what a shorter opinion does not use goes to the cases ranked below it. Cases without opinion_texts
+    fall back to their snippet.
+    Returns the sources and the token count of the returned string.
+    """
+    encoding = get_encoding(model)
+    headers = [
+        f"[{case.id}]:" + " | ".join(f"{key}: {value}" for key, value in case.rag_fields().items()) for case in cases
+    ]
+    opinions = [encoding.encode(opinion_texts.get(case.id) or case.opinion_snippet or "") for case in cases]
+    # The headers and separators are in the prompt whatever the opinions, the label only comes with an opinion
+    label_tokens = len(encoding.encode(" | Opinion: "))
+    remaining = max(budget - len(encoding.encode(render_sources(headers, [""] * len(cases)))), 0)
+
+    weights = [1 / rank for rank in range(1, len(cases) + 1)]
+    packed = []
+    for index, opinion in enumerate(opinions):
+        allocation = int(remaining * weights[index] / sum(weights[index:]))
+        opinion = opinion[: allocation - label_tokens] if allocation > label_tokens else []
+        if opinion:
+            remaining -= len(opinion) + label_tokens
+        packed.append(opinion)
+
+    # Tokens can merge across the joins, so count the final string and trim the lowest-ranked opinion if it is over
+    while True:
+        content = render_sources(headers, [encoding.decode(opinion) for opinion in packed])
+        total_tokens = len(encoding.encode(content))
+        if total_tokens <= budget or not any(packed):
+            return content, total_tokens
+        index = max(index for index, opinion in enumerate(packed) if opinion)
+        packed[index] = packed[index][: max(len(packed[index]) - (total_tokens - budget), 0)]
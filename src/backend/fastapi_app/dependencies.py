@@ -9,6 +9,9 @@ from openai import AsyncAzureOpenAI, AsyncOpenAI
 from pydantic import BaseModel
 from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker
 
+from fastapi_app.citation_graph import CitationGraph, CitationGraphStore
+from fastapi_app.read_replicas import ReadReplicaRouter
+
 logger = logging.getLogger("ragapp")
 
 
@@ -110,6 +113,18 @@ async def create_async_sessionmaker(engine: AsyncEngine) -> async_sessionmaker[A
     )
 
 
+async def get_async_engine(
+    request: Request,
+) -> AsyncEngine:
+    return request.state.engine
+
+
+async def get_replica_engines(
+    request: Request,
+) -> list[AsyncEngine]:
+    return request.state.replica_engines
+
+
 async def get_async_sessionmaker(
     request: Request,
 ) -> AsyncGenerator[async_sessionmaker[AsyncSession], None]:
@@ -129,6 +144,20 @@ async def get_async_db_session(
         yield session
 
 
+async def get_read_replica_router(
+    request: Request,
+) -> ReadReplicaRouter:
+    return request.state.read_replica_router
+
+
+async def get_async_read_db_session(
+    read_replica_router: Annotated[ReadReplicaRouter, Depends(get_read_replica_router)],
+) -> AsyncGenerator[AsyncSession, None]:
+    """Session for read-only queries, on a read replica when one is configured and healthy"""
+    async with await read_replica_router.session() as session:
+        yield session
+
+
 async def get_openai_chat_client(
     request: Request,
 ) -> OpenAIClient:
@@ -143,7 +172,26 @@ async def get_openai_embed_client(
     return OpenAIClient(client=request.state.embed_client)
 
 
+async def get_citation_graph_store(
+    request: Request,
+) -> CitationGraphStore | None:
+    """Get the in-process citation graph store, None when the graph is ranked in SQL"""
+    return request.state.citation_graph_store
+
+
+async def get_citation_graph(
+    citation_graph_store: Annotated[CitationGraphStore | None, Depends(get_citation_graph_store)],
+) -> CitationGraph | None:
+    return citation_graph_store.graph if citation_graph_store else None
+
+
 CommonDeps = Annotated[FastAPIAppContext, Depends(get_context)]
+DBEngine = Annotated[AsyncEngine, Depends(get_async_engine)]
+DBReplicaEngines = Annotated[list[AsyncEngine], Depends(get_replica_engines)]
 DBSession = Annotated[AsyncSession, Depends(get_async_db_session)]
+ReadDBSession = Annotated[AsyncSession, Depends(get_async_read_db_session)]
+ReadReplicaRouterDep = Annotated[ReadReplicaRouter, Depends(get_read_replica_router)]
 ChatClient = Annotated[OpenAIClient, Depends(get_openai_chat_client)]
 EmbeddingsClient = Annotated[OpenAIClient, Depends(get_openai_embed_client)]
+CitationGraphStoreDep = Annotated[CitationGraphStore | None, Depends(get_citation_graph_store)]
+CitationGraphDep = Annotated[CitationGraph | None, Depends(get_citation_graph)]
@@ -1,8 +1,133 @@
+import asyncio
+import logging
+import os
+import unicodedata
+from array import array
+from datetime import UTC, datetime, timedelta
 from typing import (
     TypedDict,
 )
 
 from openai import AsyncAzureOpenAI, AsyncOpenAI
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker
+
+from fastapi_app.caching import TTLCache, hash_key
+from fastapi_app.postgres_models import EmbeddingCacheEntry
+
+logger = logging.getLogger("ragapp")
+
+
+def normalize_embedding_text(q: str) -> str:
+    """Normalize the text the same way for every cache tier: NFC and collapsed whitespace."""
+    return " ".join(unicodedata.normalize("NFC", q).split())
+
+
+class PostgresEmbeddingStore:
+    """
+    Persistent embedding cache tier in the `embedding_cache` table, so that replicas and restarts share warm entries.
+    """
+
+    def __init__(self, sessionmaker: async_sessionmaker[AsyncSession], ttl: float):
+        self.sessionmaker = sessionmaker
+        self.ttl = ttl
+
+    async def get(self, key: str) -> array | None:
+        async with self.sessionmaker() as session:
+            embedding = await session.scalar(
+                select(EmbeddingCacheEntry.embedding).where(
+                    EmbeddingCacheEntry.cache_key == key,
+                    EmbeddingCacheEntry.created_at > datetime.now(UTC) - timedelta(seconds=self.ttl),
+                )
+            )
+        return array("f", embedding) if embedding is not None else None
+
+    async def set(self, key: str, embedding: array) -> None:
+        statement = insert(EmbeddingCacheEntry).values(cache_key=key, embedding=list(embedding))
+        statement = statement.on_conflict_do_update(
+            index_elements=[EmbeddingCacheEntry.cache_key],
+            set_={"embedding": statement.excluded.embedding, "created_at": statement.excluded.created_at},
+        )
+        async with self.sessionmaker() as session:
+            await session.execute(statement)
+            await session.commit()
+
+
+class EmbeddingCache:
+    """
+    Query embedding cache: a bounded in-process LRU with a TTL in front of an optional Postgres tier.
+    Vectors are kept as float32 arrays, about 6 KB per 1536-dimension entry.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.memory: TTLCache[array] = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.persistent_store: PostgresEmbeddingStore | None = None
+        self.persistent_hits = 0
+        # Pending writes to the persistent tier, referenced until they finish
+        self._pending_writes: set[asyncio.Task] = set()
+
+    @staticmethod
+    def key(q: str, embed_model: str, embed_deployment: str | None, embedding_dimensions: int | None) -> str:
+        return hash_key(embed_model, embed_deployment, embedding_dimensions, normalize_embedding_text(q))
+
+    async def get(self, key: str) -> array | None:
+        if (embedding := self.memory.get(key)) is not None:
+            return embedding
+        if self.persistent_store is None:
+            return None
+        try:
+            embedding = await self.persistent_store.get(key)
+        except Exception as e:
+            logger.warning("Failed to read the persistent embedding cache: %s", e)
+            return None
+        if embedding is not None:
+            self.persistent_hits += 1
+            self.memory.set(key, embedding)
+        return embedding
+
+    async def set(self, key: str, embedding: array) -> None:
+        self.memory.set(key, embedding)
+        if self.persistent_store is None:
+            return
+        # The caller already has the embedding, so it does not wait for the database write
+        task = asyncio.create_task(self._write_persistent(self.persistent_store, key, embedding))
+        self._pending_writes.add(task)
+        task.add_done_callback(self._pending_writes.discard)
+
+    @staticmethod
+    async def _write_persistent(persistent_store: PostgresEmbeddingStore, key: str, embedding: array) -> None:
+        try:
+            await persistent_store.set(key, embedding)
+        except Exception as e:
+            logger.warning("Failed to write the persistent embedding cache: %s", e)
+
+    async def flush(self) -> None:
+        """Wait for the pending writes to the persistent tier, before its engine is disposed."""
+        if self._pending_writes:
+            await asyncio.gather(*self._pending_writes)
+
+    def stats(self) -> dict[str, int]:
+        # Memory misses that were served by the persistent tier are not misses of the cache as a whole
+        stats = self.memory.stats()
+        stats["persistent_hits"] = self.persistent_hits
+        stats["misses"] -= self.persistent_hits
+        return stats
+
+
+embedding_cache = EmbeddingCache(
+    maxsize=int(os.getenv("EMBEDDING_CACHE_SIZE", 1024)),
+    ttl=float(os.getenv("EMBEDDING_CACHE_TTL_SECONDS", 3600)),
+)
+
+
+def configure_embedding_cache(engine: AsyncEngine) -> None:
+    """Attach the persistent Postgres tier to the embedding cache when EMBEDDING_CACHE_PERSISTENT is enabled."""
+    if os.getenv("EMBEDDING_CACHE_PERSISTENT", "false").lower() == "true":
+        logger.info("Using the persistent embedding cache in Postgres")
+        embedding_cache.persistent_store = PostgresEmbeddingStore(
+            async_sessionmaker(engine, expire_on_commit=False), ttl=embedding_cache.memory.ttl
+        )
 
 
 async def compute_text_embedding(
@@ -28,10 +153,16 @@ async def compute_text_embedding(
         else:
             dimensions_args = {"dimensions": embedding_dimensions}
 
+    cache_key = embedding_cache.key(q, embed_model, embed_deployment, embedding_dimensions)
+    if (cached_embedding := await embedding_cache.get(cache_key)) is not None:
+        return cached_embedding.tolist()
+
     embedding = await openai_client.embeddings.create(
         # Azure OpenAI takes the deployment name as the model name
         model=embed_deployment if embed_deployment else embed_model,
         input=q,
         **dimensions_args,
     )
-    return embedding.data[0].embedding
+    vector = embedding.data[0].embedding
+    await embedding_cache.set(cache_key, array("f", vector))
+    return vector
@@ -1,52 +1,270 @@
+import asyncio
 import logging
 import os
+import threading
+import time
+from collections.abc import Iterable, Sequence
+from typing import Any
 
 from azure.identity import AzureDeveloperCliCredential
+from opentelemetry import metrics
 from sqlalchemy import event
 from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 
 from fastapi_app.dependencies import get_azure_credential
 
 logger = logging.getLogger("ragapp")
 
+POSTGRES_TOKEN_SCOPE = "https://ossrdbms-aad.database.windows.net/.default"
 
-async def create_postgres_engine(*, host, username, database, password, sslmode, azure_credential) -> AsyncEngine:
-    def get_password_from_azure_credential():
-        token = azure_credential.get_token("https://ossrdbms-aad.database.windows.net/.default")
-        return token.token
+AGE_GRAPH_NAME = "case_graph"
+# Key set on each pooled connection's info dict once the AGE session bootstrap has run on it
+AGE_READY_KEY = "age_ready"
 
-    token_based_password = False
+
+class CachedTokenProvider:
+    """
+    Entra ID access token for Postgres connections, cached until shortly before it expires.
+    A daemon timer refreshes it refresh_margin seconds ahead of expiry, so connecting only reads the cached token
+    and never waits on the credential (which shells out to the Azure Developer CLI locally).
+    """
+
+    def __init__(self, azure_credential, scope: str = POSTGRES_TOKEN_SCOPE, refresh_margin: float = 300):
+        self.azure_credential = azure_credential
+        self.scope = scope
+        self.refresh_margin = refresh_margin
+        self._token: str | None = None
+        self._expires_on = 0.0
+        self._lock = threading.Lock()
+        self._timer: threading.Timer | None = None
+
+    def refresh(self) -> str:
+        with self._lock:
+            access_token = self.azure_credential.get_token(self.scope)
+            self._token = access_token.token
+            self._expires_on = float(access_token.expires_on)
+            self._schedule_refresh()
+            return self._token
+
+    def _schedule_refresh(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+        delay = max(self._expires_on - self.refresh_margin - time.time(), 30)
+        self._timer = threading.Timer(delay, self._refresh_in_background)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _refresh_in_background(self) -> None:
+        try:
+            self.refresh()
+        except Exception as e:
+            logger.warning("Background refresh of the Postgres access token failed, retrying: %s", e)
+            with self._lock:
+                self._schedule_refresh()
+
+    async def start(self) -> str:
+        """Fetch the first token off the event loop, later tokens are refreshed by the timer."""
+        return await asyncio.to_thread(self.refresh)
+
+    def token(self) -> str:
+        """The cached token, only fetched inline when the background refresh has not kept it valid."""
+        if self._token is None or self._expires_on - time.time() < 60:
+            logger.warning("Cached Postgres access token is missing or about to expire, refreshing inline")
+            return self.refresh()
+        return self._token
+
+    def close(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+
+
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    """Connection pool that records how long checkouts wait for a connection, for the pool metrics."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            elapsed = time.perf_counter() - start
+            self.checkouts += 1
+            self.wait_seconds_total += elapsed
+            self.wait_seconds_max = max(self.wait_seconds_max, elapsed)
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.checkouts = self.checkouts
+        pool.wait_seconds_total = self.wait_seconds_total
+        pool.wait_seconds_max = self.wait_seconds_max
+        return pool
+
+
+def pool_options_from_env() -> dict[str, Any]:
+    """
+    Pool settings of create_async_engine from the POSTGRES_POOL_* variables.
+    POSTGRES_PREPARED_STATEMENT_CACHE_SIZE sizes the asyncpg prepared statement caches, 0 turns them off
+    (needed behind a transaction-mode PgBouncer).
+    """
+    return {
+        "pool_size": int(os.getenv("POSTGRES_POOL_SIZE", 5)),
+        "max_overflow": int(os.getenv("POSTGRES_POOL_MAX_OVERFLOW", 10)),
+        "pool_timeout": float(os.getenv("POSTGRES_POOL_TIMEOUT", 30)),
+        # Recycle before Entra ID access tokens expire, they are only checked when connecting
+        "pool_recycle": int(os.getenv("POSTGRES_POOL_RECYCLE", 1800)),
+        "pool_pre_ping": os.getenv("POSTGRES_POOL_PRE_PING", "true").lower() == "true",
+        "prepared_statement_cache_size": int(os.getenv("POSTGRES_PREPARED_STATEMENT_CACHE_SIZE", 100)),
+    }
+
+
+def pool_stats(engine: AsyncEngine) -> dict[str, Any]:
+    """Checked-out connections, overflow and checkout wait time of the engine's connection pool."""
+    pool = engine.pool
+    stats: dict[str, Any] = {"status": pool.status()}
+    if isinstance(pool, AsyncAdaptedQueuePool):
+        stats.update(
+            {
+                "size": pool.size(),
+                "checked_in": pool.checkedin(),
+                "checked_out": pool.checkedout(),
+                "overflow": pool.overflow(),
+            }
+        )
+    if isinstance(pool, TimedQueuePool):
+        stats.update(
+            {
+                "checkouts": pool.checkouts,
+                "wait_seconds_total": pool.wait_seconds_total,
+                "wait_seconds_max": pool.wait_seconds_max,
+            }
+        )
+    return stats
+
+
+def engine_host(engine: AsyncEngine) -> str:
+    return engine.url.host or "localhost"
+
+
+def pool_stats_by_host(primary: AsyncEngine, replicas: Sequence[AsyncEngine]) -> dict[str, dict[str, Any]]:
+    """The pool statistics of the primary and every read replica engine, keyed by host."""
+    stats = {engine_host(primary): {"role": "primary", **pool_stats(primary)}}
+    for replica in replicas:
+        stats[engine_host(replica)] = {"role": "replica", **pool_stats(replica)}
+    return stats
+
+
+def register_pool_metrics(engines: Sequence[AsyncEngine]) -> None:
+    """
+    Report the pool statistics as OpenTelemetry observable instruments, exported with the other app metrics.
+    Each engine is observed separately, labelled with its host in the server.address attribute.
+    """
+    meter = metrics.get_meter("fastapi_app.postgres_engine")
+
+    def observe(*keys: str):
+        def callback(options: metrics.CallbackOptions) -> Iterable[metrics.Observation]:
+            observations: list[metrics.Observation] = []
+            for engine in engines:
+                stats = pool_stats(engine)
+                attributes = {"server.address": engine_host(engine)}
+                observations.extend(metrics.Observation(stats[key], attributes) for key in keys if key in stats)
+            return observations
+
+        return callback
+
+    meter.create_observable_gauge(
+        "db.client.connections.checked_out", callbacks=[observe("checked_out")], unit="{connection}"
+    )
+    meter.create_observable_gauge(
+        "db.client.connections.overflow", callbacks=[observe("overflow")], unit="{connection}"
+    )
+    meter.create_observable_gauge("db.client.connections.size", callbacks=[observe("size")], unit="{connection}")
+    meter.create_observable_counter(
+        "db.client.connections.wait_time", callbacks=[observe("wait_seconds_total")], unit="s"
+    )
+    meter.create_observable_counter(
+        "db.client.connections.checkouts", callbacks=[observe("checkouts")], unit="{checkout}"
+    )
+
+
+def register_age_bootstrap(engine: AsyncEngine, graph_name: str = AGE_GRAPH_NAME) -> None:
+    """
+    Load Apache AGE, set the search_path and warm up the citation graph once per pooled connection,
+    instead of preparing the session before every search.
+    """
+
+    async def bootstrap(conn):
+        await conn.execute("LOAD 'age';")
+        await conn.execute('SET search_path = ag_catalog, "$user", public;')
+        # Touch the REF label once so AGE caches the graph metadata for this connection
+        await conn.execute(
+            f"SELECT * FROM cypher('{graph_name}', $$ MATCH ()-[r:REF]->() RETURN r LIMIT 1 $$) AS (r agtype);"
+        )
+
+    @event.listens_for(engine.sync_engine, "connect")
+    def initialize_age_session(dbapi_connection, connection_record):
+        try:
+            dbapi_connection.run_async(bootstrap)
+            connection_record.info[AGE_READY_KEY] = True
+        except Exception as e:
+            connection_record.info[AGE_READY_KEY] = False
+            logger.warning("AGE session bootstrap failed, searches will set the search_path per query: %s", e)
+
+
+async def create_postgres_engine(
+    *, host, username, database, password, sslmode, azure_credential, load_age: bool = False
+) -> AsyncEngine:
+    token_provider: CachedTokenProvider | None = None
     if host.endswith(".database.azure.com"):
-        token_based_password = True
         logger.info("Authenticating to Azure Database for PostgreSQL using Azure Identity...")
         if azure_credential is None:
             raise ValueError("Azure credential must be provided for Azure Database for PostgreSQL")
-        password = get_password_from_azure_credential()
+        token_provider = CachedTokenProvider(azure_credential)
+        password = await token_provider.start()
     else:
         logger.info("Authenticating to PostgreSQL using password...")
 
+    pool_options = pool_options_from_env()
+    statement_cache_size = pool_options.pop("prepared_statement_cache_size")
     DATABASE_URI = f"postgresql+asyncpg://{username}:{password}@{host}/{database}"
+    # SQLAlchemy's asyncpg adapter keeps its own prepared statement cache next to asyncpg's
+    DATABASE_URI += f"?prepared_statement_cache_size={statement_cache_size}"
     # Specify SSL mode if needed
     if sslmode:
-        DATABASE_URI += f"?ssl={sslmode}"
+        DATABASE_URI += f"&ssl={sslmode}"
 
     engine = create_async_engine(
         DATABASE_URI,
         echo=False,
+        poolclass=TimedQueuePool,
+        connect_args={"statement_cache_size": statement_cache_size},
+        **pool_options,
     )
 
-    @event.listens_for(engine.sync_engine, "do_connect")
-    def update_password_token(dialect, conn_rec, cargs, cparams):
-        if token_based_password:
-            logger.info("Updating password token for Azure Database for PostgreSQL")
-            cparams["password"] = get_password_from_azure_credential()
+    if token_provider is not None:
+
+        @event.listens_for(engine.sync_engine, "do_connect")
+        def update_password_token(dialect, conn_rec, cargs, cparams):
+            cparams["password"] = token_provider.token()
+
+        @event.listens_for(engine.sync_engine, "engine_disposed")
+        def stop_token_refresh(engine):
+            token_provider.close()
+
+    if load_age:
+        register_age_bootstrap(engine)
 
     return engine
 
 
-async def create_postgres_engine_from_env(azure_credential=None) -> AsyncEngine:
+async def create_postgres_engine_from_env(azure_credential=None, load_age: bool = False) -> AsyncEngine:
     if azure_credential is None and os.environ["POSTGRES_HOST"].endswith(".database.azure.com"):
-        azure_credential = get_azure_credential()
+        azure_credential = await get_azure_credential()
 
     return await create_postgres_engine(
         host=os.environ["POSTGRES_HOST"],
@@ -55,9 +273,30 @@ async def create_postgres_engine_from_env(azure_credential=None) -> AsyncEngine:
         password=os.environ.get("POSTGRES_PASSWORD"),
         sslmode=os.environ.get("POSTGRES_SSL"),
         azure_credential=azure_credential,
+        load_age=load_age,
     )
 
 
+async def create_postgres_replica_engines_from_env(azure_credential=None, load_age: bool = False) -> list[AsyncEngine]:
+    """Engines for the read replicas in POSTGRES_REPLICA_HOSTS, they share the primary's database and credentials."""
+    hosts = [host.strip() for host in os.getenv("POSTGRES_REPLICA_HOSTS", "").split(",") if host.strip()]
+    if hosts and azure_credential is None and any(host.endswith(".database.azure.com") for host in hosts):
+        azure_credential = await get_azure_credential()
+
+    return [
+        await create_postgres_engine(
+            host=host,
+            username=os.environ["POSTGRES_USERNAME"],
+            database=os.environ["POSTGRES_DATABASE"],
+            password=os.environ.get("POSTGRES_PASSWORD"),
+            sslmode=os.environ.get("POSTGRES_SSL"),
+            azure_credential=azure_credential,
+            load_age=load_age,
+        )
+        for host in hosts
+    ]
+
+
 async def create_postgres_engine_from_args(args, azure_credential=None) -> AsyncEngine:
     if azure_credential is None and args.host.endswith(".database.azure.com"):
         azure_credential = AzureDeveloperCliCredential(process_timeout=60)
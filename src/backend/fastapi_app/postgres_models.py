@@ -1,8 +1,10 @@
 from __future__ import annotations
 
+from datetime import datetime
+
 from pgvector.sqlalchemy import Vector
-from sqlalchemy import Index, Text
-from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy import BigInteger, Computed, DateTime, Index, Integer, Text, func
+from sqlalchemy.dialects.postgresql import ARRAY, JSONB
 from sqlalchemy.ext.mutable import MutableDict
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
 
@@ -76,39 +78,61 @@ class Item(Base):
 
 class Case(Base):
     __tablename__ = "cases_updated"
+    # Allows the unmapped search_scores attribute below
+    __allow_unmapped__ = True
+
     id: Mapped[str] = mapped_column(Text, primary_key=True)
     data: Mapped[MutableDict] = mapped_column(MutableDict.as_mutable(JSONB), nullable=False)
     description_vector: Mapped[Vector] = mapped_column(Vector(1536), nullable=True)
+    # Stored generated columns for the JSONB paths the search functions filter on and return,
+    # so ranking candidates does not detoast the full document
+    court_id: Mapped[int | None] = mapped_column(Integer, Computed("(data #>> '{court,id}')::integer", persisted=True))
+    case_name: Mapped[str | None] = mapped_column(Text, Computed("data #>> '{name_abbreviation}'", persisted=True))
+    decision_date: Mapped[str | None] = mapped_column(Text, Computed("data #>> '{decision_date}'", persisted=True))
+    jurisdiction: Mapped[str | None] = mapped_column(
+        Text, Computed("data #>> '{jurisdiction,name_long}'", persisted=True)
+    )
+    # The first 800 characters of the first opinion, the opinion texts themselves are stored in case_opinions
+    opinion_snippet: Mapped[str | None] = mapped_column(Text, nullable=True)
+
+    # Rank and score columns from the search function that returned this case, not persisted
+    search_scores: dict[str, float | None] | None = None
 
     def to_dict(self, include_vectors: bool = False):
         """
         Converts the Case instance to a dictionary representation.
         """
-        model_dict = {column.name: getattr(self, column.name) for column in self.__table__.columns}
+        # The generated columns only repeat fields of data
+        model_dict = {
+            column.name: getattr(self, column.name) for column in self.__table__.columns if column.computed is None
+        }
         if not include_vectors:
             model_dict.pop("description_vector", None)
+        if self.search_scores is not None:
+            model_dict["search_scores"] = self.search_scores
         return model_dict
 
+    def rag_fields(self) -> dict[str, str]:
+        """
+        The case metadata given to the chat model, a whitelist of the useful fields of the case document.
+        """
+        data = self.data or {}
+        fields = {
+            "Case": data.get("name_abbreviation") or data.get("name"),
+            "Court": (data.get("court") or {}).get("name"),
+            "Jurisdiction": (data.get("jurisdiction") or {}).get("name_long"),
+            "Decided": data.get("decision_date"),
+            "Citation": ", ".join(citation["cite"] for citation in data.get("citations") or [] if citation.get("cite")),
+            "Pagerank": ((data.get("analysis") or {}).get("pagerank") or {}).get("percentile"),
+        }
+        return {key: str(value) for key, value in fields.items() if value not in (None, "")}
+
     def to_str_for_rag(self):
         """
         Converts Case to a string representation for Retrieval-Augmented Generation (RAG) usage.
         """
-        # data_fields = " ".join([f"{key}:{value}" for key, value in self.data.items()])
-        # return f"ID: {self.id} Data: {data_fields}"
-        casebody_text = self.data.get("casebody", {}).get("opinions", [{}])[0].get("text", "")
-        truncated_text = casebody_text[:800]  # Truncate to 800 characters
-
-        # Include truncated data alongside other fields if necessary
-        data_fields = [
-            f"{key}:{value}"
-            for key, value in self.data.items()
-            if key != "casebody"  # Exclude the large 'casebody' field
-        ]
-        data_fields.append(f"casebody_opinion_text:{truncated_text}")
-
-        page_rank = self.data.get("analysis", {}).get("pagerank", [{}]).get("percentile", "")
-        data_str = " ".join(data_fields)
-        return f"Pagerank: {page_rank} Data: {data_str}"
+        fields = " | ".join(f"{key}: {value}" for key, value in self.rag_fields().items())
+        return f"{fields} | Opinion: {self.opinion_snippet or ''}"
 
     def to_str_for_embedding(self):
         """
@@ -117,6 +141,65 @@ class Case(Base):
         return " ".join([f"{key}: {value}" for key, value in self.data.items() if key != "embedding"])
 
 
+class CaseOpinion(Base):
+    """
+    Opinion texts of a case, split out of the case document so that searches only read its metadata and snippet.
+    """
+
+    __tablename__ = "case_opinions"
+    case_id: Mapped[str] = mapped_column(Text, primary_key=True)
+    # Position of the opinion in casebody.opinions
+    ordinal: Mapped[int] = mapped_column(Integer, primary_key=True)
+    type: Mapped[str | None] = mapped_column(Text, nullable=True)
+    author: Mapped[str | None] = mapped_column(Text, nullable=True)
+    text: Mapped[str] = mapped_column(Text, nullable=False)
+
+    def to_dict(self):
+        return {column.name: getattr(self, column.name) for column in self.__table__.columns}
+
+
+class EmbeddingCacheEntry(Base):
+    """
+    Persistent tier of the query embedding cache, shared by replicas and across restarts.
+    """
+
+    __tablename__ = "embedding_cache"
+    cache_key: Mapped[str] = mapped_column(Text, primary_key=True)
+    # No fixed dimensions, the key already includes the model and dimensions
+    embedding: Mapped[Vector] = mapped_column(Vector(), nullable=False)
+    created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+
+
+class CitationGraphRefresh(Base):
+    """
+    Single row holding when a reload of the in-process citation graph was last requested,
+    polled by every app worker so that a refresh reaches all of them.
+    """
+
+    __tablename__ = "citation_graph_refresh"
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    requested_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+
+
+class AnswerCacheEntry(Base):
+    """
+    Chat answers keyed by the question embedding, served again for near-duplicate questions
+    with the same retrieval mode and filters.
+    """
+
+    __tablename__ = "answer_cache"
+    id: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=True)
+    question: Mapped[str] = mapped_column(Text, nullable=False)
+    question_vector: Mapped[Vector] = mapped_column(Vector(1536), nullable=False)
+    retrieval_mode: Mapped[str] = mapped_column(Text, nullable=False)
+    # Hash of the search filters and the other request settings that change the answer
+    filters_key: Mapped[str] = mapped_column(Text, nullable=False)
+    # The cases the answer was generated from, reloaded on a hit so the data points are current
+    case_ids: Mapped[list[str]] = mapped_column(ARRAY(Text), nullable=False)
+    answer: Mapped[str] = mapped_column(Text, nullable=False)
+    created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+
+
 # Define HNSW index to support vector similarity search
 # Use the vector_ip_ops access method (inner product) since these embeddings are normalized
 
@@ -147,3 +230,20 @@ index_description_vector = Index(
     postgresql_with={"m": 16, "ef_construction": 64},
     postgresql_ops={"description_vector": "vector_cosine_ops"},
 )
+
+# B-tree indexes on the generated columns the search filters compare against,
+# see search_filters.FILTER_OPERATORS. The 800-character opinion_snippet is returned, never filtered on.
+index_court_id = Index(f"{table_name}_court_id_idx", Case.court_id)
+index_decision_date = Index(f"{table_name}_decision_date_idx", Case.decision_date)
+index_case_name = Index(f"{table_name}_case_name_idx", Case.case_name)
+index_jurisdiction = Index(f"{table_name}_jurisdiction_idx", Case.jurisdiction)
+
+# Nearest cached question, and TTL expiry of the answer cache
+index_answer_cache_question_vector = Index(
+    "answer_cache_question_vector_idx",
+    AnswerCacheEntry.question_vector,
+    postgresql_using="hnsw",
+    postgresql_with={"m": 16, "ef_construction": 64},
+    postgresql_ops={"question_vector": "vector_cosine_ops"},
+)
+index_answer_cache_created_at = Index("answer_cache_created_at_idx", AnswerCacheEntry.created_at)
@@ -1,18 +1,103 @@
 import logging
-import subprocess
-from pathlib import Path
+import os
+import time
+from collections.abc import Iterator, Mapping, Sequence
+from contextlib import contextmanager
+from typing import Any
 
 from openai import AsyncAzureOpenAI, AsyncOpenAI
 from pgvector.utils import to_db
-from sqlalchemy import String, column, select, text
+from sqlalchemy import BigInteger, Float, Numeric, Text, any_, bindparam, column, func, literal, select, text
+from sqlalchemy.dialects.postgresql import ARRAY, JSONB, aggregate_order_by
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from fastapi_app.api_models import RetrievalMode
+from fastapi_app.citation_graph import CitationGraph
 from fastapi_app.embeddings import compute_text_embedding
-from fastapi_app.postgres_models import Case
+from fastapi_app.postgres_engine import AGE_READY_KEY
+from fastapi_app.postgres_models import Case, CaseOpinion
+from fastapi_app.search_filters import compile_filters
 
 logger = logging.getLogger("legalcaseapp")
 
+# Result columns of get_vector_semantic_graphrag_optimized, in order
+CASE_RANKING_COLUMNS = (
+    column("label", Text),
+    column("score", Numeric),
+    column("graph_rank", BigInteger),
+    column("semantic_rank", BigInteger),
+    column("vector_rank", BigInteger),
+    column("id", Text),
+    column("case_name", Text),
+    column("date", Text),
+    column("data", JSONB),
+    column("opinion_snippet", Text),
+    column("refs", BigInteger),
+    column("relevance", Float),
+)
+
+# Result columns of get_vector_ranked, in order
+VECTOR_RANKING_COLUMNS = (
+    column("vector_rank", BigInteger),
+    column("id", Text),
+    column("case_name", Text),
+    column("date", Text),
+    column("opinion_snippet", Text),
+)
+
+# Result columns of get_vector_semantic_ranked, in order
+SEMANTIC_RANKING_COLUMNS = (
+    column("semantic_rank", BigInteger),
+    column("vector_rank", BigInteger),
+    column("id", Text),
+    column("case_name", Text),
+    column("date", Text),
+    column("relevance", Float),
+)
+
+# Result columns of get_msr_graphrag_combined, in order
+MSR_RANKING_COLUMNS = (
+    column("label", Text),
+    column("score", Numeric),
+    column("graph_rank", BigInteger),
+    column("semantic_rank", BigInteger),
+    column("msr_rank", BigInteger),
+    column("id", Text),
+    column("case_name", Text),
+    column("data", Text),
+    column("relevance", Float),
+)
+
+# Candidate pool size per retrieval mode when the request does not set one,
+# Vector mode has no reranking stage so its pool is the requested top-k
+DEFAULT_CONSIDER_N = {
+    RetrievalMode.SEMANTIC: 60,
+    RetrievalMode.GRAPHRAG: 60,
+    RetrievalMode.MSRGRAPHRAG: 103,
+}
+# MSR GraphRAG candidates, by semantic rank, whose citations are counted for the graph rank
+DEFAULT_GRAPH_CANDIDATES = 39
+# pgvector's default hnsw.ef_search, which also bounds how many rows an HNSW scan returns
+DEFAULT_EF_SEARCH = 40
+# Server-side caps on the request-level search knobs
+MAX_CONSIDER_N = int(os.getenv("SEARCH_MAX_CONSIDER_N", 200))
+MAX_EF_SEARCH = int(os.getenv("SEARCH_MAX_EF_SEARCH", 400))
+MAX_GRAPH_CANDIDATES = int(os.getenv("SEARCH_MAX_GRAPH_CANDIDATES", 100))
+
+# First-pass vector search precision. halfvec and binary scan the quantized expression indexes for
+# QUANTIZATION_OVERSAMPLE times the candidates and re-score them against the full-precision vectors
+VECTOR_QUANTIZATIONS = ("none", "halfvec", "binary")
+VECTOR_QUANTIZATION = os.getenv("SEARCH_VECTOR_QUANTIZATION", "none")
+QUANTIZATION_OVERSAMPLE = int(os.getenv("SEARCH_QUANTIZATION_OVERSAMPLE", 4))
+
+# Filter arguments shared by the ranking functions, bound from compile_filters
+FILTER_ARGUMENTS = (
+    "CAST(:court_ids AS INT[]), CAST(:decided_from AS TEXT), CAST(:decided_to AS TEXT), CAST(:jurisdiction AS TEXT)"
+)
+
+# Per-hit rank and score columns kept on the hydrated models
+SCORE_COLUMNS = ("score", "graph_rank", "semantic_rank", "vector_rank", "msr_rank", "refs", "relevance")
+
 
 class PostgresSearcher:
     def __init__(
@@ -23,6 +108,8 @@ class PostgresSearcher:
         embed_model: str,
         embed_dimensions: int | None,
         embedding_column: str,
+        citation_graph: CitationGraph | None = None,
+        vector_quantization: str | None = None,
     ):
         self.db_session = db_session
         self.openai_embed_client = openai_embed_client
@@ -30,19 +117,21 @@ class PostgresSearcher:
         self.embed_deployment = embed_deployment
         self.embed_dimensions = embed_dimensions
         self.embedding_column = embedding_column
+        # In-process citation graph, when loaded GraphRAG ranks the reranked candidates without the SQL graph stage
+        self.citation_graph = citation_graph
+        self.vector_quantization = vector_quantization or VECTOR_QUANTIZATION
+        if self.vector_quantization not in VECTOR_QUANTIZATIONS:
+            raise ValueError(f"Invalid vector quantization. Options are: {', '.join(VECTOR_QUANTIZATIONS)}")
+        # Wall-clock milliseconds per stage of the last search, e.g. for the retrieval benchmark
+        self.stage_timings: dict[str, float] = {}
 
-    def build_filter_clause(self, filters) -> tuple[str, str]:
-        if filters is None:
-            return "", ""
-        filter_clauses = []
-        for filter in filters:
-            if isinstance(filter["value"], str):
-                filter["value"] = f"'{filter['value']}'"
-            filter_clauses.append(f"{filter['column']} {filter['comparison_operator']} {filter['value']}")
-        filter_clause = " AND ".join(filter_clauses)
-        if len(filter_clause) > 0:
-            return f"WHERE {filter_clause}", f"AND {filter_clause}"
-        return "", ""
+    @contextmanager
+    def timed(self, stage: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stage_timings[stage] = self.stage_timings.get(stage, 0.0) + (time.perf_counter() - start) * 1000
 
     async def search(
         self,
@@ -51,104 +140,288 @@ class PostgresSearcher:
         top: int = 5,
         filters: list[dict] | None = None,
         retrieval_mode: RetrievalMode = RetrievalMode.GRAPHRAG,
+        consider_n: int | None = None,
+        ef_search: int | None = None,
+        graph_candidates: int | None = None,
     ):
-        # Build filters if provided (assuming self.build_filter_clause exists and returns correct clauses)
-        filter_clause_where, filter_clause_and = self.build_filter_clause(filters)
-        table_name = Case.__tablename__
+        if top < 1:
+            return []
+        # Filters become bound parameters of the ranking functions, so they narrow the candidate set
+        # and the statements stay the same across requests
+        filter_params = compile_filters(filters)
+        self.stage_timings = {}
+        oversample = QUANTIZATION_OVERSAMPLE if self.vector_quantization != "none" else 1
+        consider_n, ef_search, graph_candidates = self.search_limits(
+            retrieval_mode, top, consider_n, ef_search, oversample, graph_candidates
+        )
+        # Scoped to the search transaction, so pooled connections keep the server defaults
+        await self.db_session.execute(
+            text(
+                """
+                SELECT set_config('hnsw.ef_search', :ef_search, true),
+                    set_config('search.vector_quantization', :quantization, true),
+                    set_config('search.quantization_oversample', :oversample, true);
+            """
+            ),
+            {"ef_search": str(ef_search), "quantization": self.vector_quantization, "oversample": str(oversample)},
+        )
 
-        try:
-            script_path = Path(__file__).parent / "setup_postgres_age.py"
+        # Each mode only runs the stages it ranks by: Vector is a plain HNSW top-k, Semantic adds the reranker
+        # and only the GraphRAG modes add the citation stage
+        with self.timed("ranking"):
+            if retrieval_mode == RetrievalMode.VECTOR:
+                rows = await self.vector_ranked(query_vector, top, filter_params)
+            elif retrieval_mode == RetrievalMode.SEMANTIC:
+                rows = await self.semantic_ranked(query_text, query_vector, consider_n, filter_params, top)
+            elif retrieval_mode == RetrievalMode.GRAPHRAG:
+                if self.citation_graph is not None:
+                    rows = await self.semantic_ranked(query_text, query_vector, consider_n, filter_params)
+                else:
+                    rows = await self.graphrag_ranked(query_text, query_vector, top, consider_n, filter_params)
+            elif retrieval_mode == RetrievalMode.MSRGRAPHRAG:
+                rows = await self.msr_graphrag_ranked(
+                    query_text, query_vector, top, consider_n, ef_search, graph_candidates, filter_params
+                )
+            else:
+                raise ValueError("Invalid retrieval_mode. Options are: VECTOR, SEMANTIC, GRAPHRAG, MSRGRAPHRAG")
 
-            if not script_path.exists():
-                logger.error(f"Setup script not found at {script_path}")
-                raise FileNotFoundError(f"Script {script_path} does not exist.")
+        if retrieval_mode == RetrievalMode.GRAPHRAG and self.citation_graph is not None:
+            with self.timed("citation_graph"):
+                rows = self.citation_graph.rank_candidates(rows, query_vector, top)
 
-            logger.info("Running setup_postgres_age.py...")
-            subprocess.run(["python", str(script_path)], check=True)
-            logger.info("setup_postgres_age.py completed successfully.")
+        if not rows:
+            return []  # Return an empty list if no results are found
 
-        except subprocess.CalledProcessError as e:
-            logger.error(f"Error occurred while running setup_postgres_age.py: {e}")
-        except Exception as e:
-            logger.error(f"Unexpected error: {e}")
+        with self.timed("hydrate"):
+            return await self.hydrate(rows, retrieval_mode)
 
-        await self.db_session.execute(text('SET search_path = ag_catalog, "$user", public;'))
+    async def ensure_age_search_path(self) -> None:
+        # Connections from the app engine are bootstrapped for AGE when they join the pool,
+        # fall back to setting the search_path here for connections where that did not succeed
+        connection = await self.db_session.connection()
+        if not connection.info.get(AGE_READY_KEY):
+            await self.db_session.execute(text('SET search_path = ag_catalog, "$user", public;'))
 
-        if retrieval_mode == RetrievalMode.MSRGRAPHRAG:
-            function_call = """
-                SELECT * FROM get_msr_graphrag_combined(
+    async def vector_ranked(
+        self, query_vector: list[float], top: int, filter_params: dict[str, Any]
+    ) -> list[Mapping[str, Any]]:
+        # The ranking functions return the candidates without the case document, join it for the hits only
+        sql = text(
+            f"""
+            SELECT ranked.*, cases_updated.data
+            FROM get_vector_ranked(
+                CAST(:embedding AS vector(1536)),
+                :top_n,
+                {FILTER_ARGUMENTS}
+            ) AS ranked
+            JOIN cases_updated ON cases_updated.id = ranked.id
+            ORDER BY ranked.vector_rank;
+        """
+        ).columns(*VECTOR_RANKING_COLUMNS, column("data", JSONB))
+        results = await self.db_session.execute(sql, {"embedding": to_db(query_vector), "top_n": top, **filter_params})
+        return [row._mapping for row in results]
+
+    async def semantic_ranked(
+        self,
+        query_text: str | None,
+        query_vector: list[float],
+        consider_n: int,
+        filter_params: dict[str, Any],
+        top: int | None = None,
+    ) -> list[Mapping[str, Any]]:
+        """
+        Reranked candidates in semantic order, with their case document. With top, only the top hits are returned;
+        without it, all the candidates, for the in-process citation graph to rank.
+        """
+        # LIMIT NULL returns all the rows
+        sql = text(
+            f"""
+            WITH ranked AS (
+                SELECT * FROM get_vector_semantic_ranked(
                     :query_text,
                     CAST(:embedding AS vector(1536)),
-                    :top_n
-                );
-            """
-            sql = text(function_call).columns(
-                column("rrf.id", String),
+                    :consider_n,
+                    {FILTER_ARGUMENTS}
+                )
+                ORDER BY semantic_rank
+                LIMIT :top_n
             )
+            SELECT ranked.*, cases_updated.data, cases_updated.opinion_snippet
+            FROM ranked
+            JOIN cases_updated ON cases_updated.id = ranked.id
+            ORDER BY ranked.semantic_rank;
+        """
+        ).columns(*SEMANTIC_RANKING_COLUMNS, column("data", JSONB), column("opinion_snippet", Text))
+        params = {
+            "query_text": query_text,
+            "embedding": to_db(query_vector),
+            "consider_n": consider_n,
+            "top_n": top,
+            **filter_params,
+        }
+        results = await self.db_session.execute(sql, params)
+        return [row._mapping for row in results]
 
-            results = (
-                await self.db_session.execute(
-                    sql,
-                    {
-                        "query_text": query_text,
-                        "embedding": to_db(query_vector),
-                        "top_n": top,
-                    },
-                )
-            ).fetchall()
-        else:
-            ranking_type_map = {
-                RetrievalMode.GRAPHRAG: "score",
-                RetrievalMode.SEMANTIC: "semantic_rank",
-                RetrievalMode.VECTOR: "vector_rank",
-            }
-
-            if retrieval_mode not in ranking_type_map:
-                raise ValueError("Invalid retrieval_mode. Options are: VECTOR, SEMANTIC, GRAPHRAG")
-
-            ranking_type = ranking_type_map[retrieval_mode]
-
-            function_call = f"""
-                SELECT * FROM get_vector_semantic_graphrag_optimized(
-                    :query_text, 
-                    CAST(:embedding AS vector(1536)), 
-                    :top_n, 
-                    :consider_n,
-                    '{ranking_type}'
-                );
+    async def graphrag_ranked(
+        self,
+        query_text: str | None,
+        query_vector: list[float],
+        top: int,
+        consider_n: int,
+        filter_params: dict[str, Any],
+    ) -> list[Mapping[str, Any]]:
+        await self.ensure_age_search_path()
+        sql = text(
+            f"""
+            SELECT * FROM get_vector_semantic_graphrag_optimized(
+                :query_text,
+                CAST(:embedding AS vector(1536)),
+                :top_n,
+                :consider_n,
+                'score',
+                {FILTER_ARGUMENTS}
+            );
+        """
+        ).columns(*CASE_RANKING_COLUMNS)
+        results = await self.db_session.execute(
+            sql,
+            {
+                "query_text": query_text,
+                "embedding": to_db(query_vector),
+                "top_n": top,
+                "consider_n": consider_n,
+                **filter_params,
+            },
+        )
+        return [row._mapping for row in results]
+
+    async def msr_graphrag_ranked(
+        self,
+        query_text: str | None,
+        query_vector: list[float],
+        top: int,
+        consider_n: int,
+        ef_search: int,
+        graph_candidates: int,
+        filter_params: dict[str, Any],
+    ) -> list[Mapping[str, Any]]:
+        await self.ensure_age_search_path()
+        # The GraphRAG documents only carry the court id, the other filters do not apply to them.
+        # An HNSW scan returns at most ef_search rows, which bounds the nearest reports and text units fetched
+        # as MSR candidates
+        sql = text(
             """
+            SELECT * FROM get_msr_graphrag_combined(
+                :query_text,
+                CAST(:embedding AS vector(1536)),
+                :top_n,
+                :consider_n,
+                graph_candidates => :graph_candidates,
+                court_ids => CAST(:court_ids AS INT[]),
+                ann_k => :ann_k
+            );
+        """
+        ).columns(*MSR_RANKING_COLUMNS)
+        results = await self.db_session.execute(
+            sql,
+            {
+                "query_text": query_text,
+                "embedding": to_db(query_vector),
+                "top_n": top,
+                "consider_n": consider_n,
+                "graph_candidates": graph_candidates,
+                "court_ids": filter_params["court_ids"],
+                "ann_k": ef_search,
+            },
+        )
+        return [row._mapping for row in results]
+
+    @staticmethod
+    def search_limits(
+        retrieval_mode: RetrievalMode,
+        top: int,
+        consider_n: int | None,
+        ef_search: int | None,
+        oversample: int = 1,
+        graph_candidates: int | None = None,
+    ) -> tuple[int, int, int]:
+        """
+        Resolve the candidate pool size, hnsw.ef_search and the MSR graph candidates for a search,
+        within the server-side caps.
+        An HNSW scan returns at most ef_search rows, so ef_search defaults to at least the (oversampled) pool size.
+        Only the candidate pool can have graph candidates, so they are capped at the pool size.
+        """
+        if retrieval_mode == RetrievalMode.VECTOR:
+            consider_n = top
+        consider_n = min(max(consider_n or DEFAULT_CONSIDER_N[retrieval_mode], top), MAX_CONSIDER_N)
+        ef_search = min(max(ef_search or max(consider_n * oversample, DEFAULT_EF_SEARCH), 1), MAX_EF_SEARCH)
+        graph_candidates = min(max(graph_candidates or DEFAULT_GRAPH_CANDIDATES, 1), consider_n, MAX_GRAPH_CANDIDATES)
+        return consider_n, ef_search, graph_candidates
 
-            sql = text(function_call).columns(
-                column("rrf.id", String),
+    async def hydrate(self, rows: Sequence[Mapping[str, Any]], retrieval_mode: RetrievalMode) -> list[Case]:
+        """
+        Turn the ranked rows returned by a search function into Case models, keeping the ranking order
+        and the per-hit rank and score columns.
+        """
+        if retrieval_mode == RetrievalMode.MSRGRAPHRAG:
+            # The MSR function returns the GraphRAG document text instead of the case document,
+            # so load all the cases in a single round trip
+            cases_by_id = await self.load_cases([row["id"] for row in rows])
+            row_models = []
+            for row in rows:
+                if case := cases_by_id.get(row["id"]):
+                    case.search_scores = self.scores_from_row(row)
+                    row_models.append(case)
+            return row_models
+
+        # The ranking query already returns the case document, so build the models from the result set
+        return [
+            Case(
+                id=row["id"],
+                data=row["data"],
+                opinion_snippet=row.get("opinion_snippet"),
+                search_scores=self.scores_from_row(row),
             )
+            for row in rows
+        ]
 
-            # Execute the query with the required parameters
-            await self.db_session.execute(text('SET search_path = ag_catalog, "$user", public;'))
+    async def load_cases(self, ids: Sequence[str]) -> dict[str, Case]:
+        """Load cases by id in a single round trip."""
+        query = select(Case).where(Case.id == any_(bindparam("ids", list(ids), ARRAY(Text))))
+        return {case.id: case for case in (await self.db_session.scalars(query)).all()}
 
-            results = (
-                await self.db_session.execute(
-                    sql,
-                    {
-                        "embedding": to_db(query_vector),
-                        "top_n": top,
-                        "consider_n": 60,
-                        "query_text": query_text,
-                    },
-                )
-            ).fetchall()
+    async def opinion_texts(self, case_ids: Sequence[str], max_chars: int) -> dict[str, str]:
+        """
+        The opinion texts of the cases from case_opinions, the opinions of a case joined in casebody order.
+        Only the first max_chars characters of a case are fetched, the prompt has no room for the rest.
+        """
+        if not case_ids:
+            return {}
+        joined = func.left(
+            func.string_agg(
+                func.left(CaseOpinion.text, max_chars), aggregate_order_by(literal("\n\n"), CaseOpinion.ordinal)
+            ),
+            max_chars,
+        )
+        query = (
+            select(CaseOpinion.case_id, joined)
+            .where(CaseOpinion.case_id == any_(bindparam("ids", list(case_ids), ARRAY(Text))))
+            .group_by(CaseOpinion.case_id)
+        )
+        return {case_id: opinion_text for case_id, opinion_text in (await self.db_session.execute(query)).all()}
 
-        if not results:
-            return []  # Return an empty list if no results are found
+    @staticmethod
+    def scores_from_row(row: Mapping[str, Any]) -> dict[str, float | None]:
+        return {key: float(row[key]) if row[key] is not None else None for key in SCORE_COLUMNS if key in row}
 
-        # Convert results to SQLAlchemy models
-        row_models = []
-        for row in results[:top]:
-            id = row.id
-            # Fetch the corresponding row using the ID
-            item = await self.db_session.execute(select(Case).where(Case.id == id))
-            # logger.info(f"Item found: {item.scalar()}")
-            row_models.append(item.scalar())
-        return row_models
+    async def embed(self, query_text: str | None) -> list[float]:
+        return await compute_text_embedding(
+            query_text,
+            self.openai_embed_client,
+            self.embed_model,
+            self.embed_deployment,
+            self.embed_dimensions,
+        )
 
     async def search_and_embed(
         self,
@@ -158,20 +431,25 @@ class PostgresSearcher:
         enable_vector_search: bool = False,
         enable_text_search: bool = False,
         filters: list[dict] | None = None,
+        consider_n: int | None = None,
+        ef_search: int | None = None,
+        query_vector: list[float] | None = None,
+        graph_candidates: int | None = None,
     ) -> list[Case]:
         """
         Search rows by query text. Optionally converts the query text to a vector if enable_vector_search is True.
+        A query_vector that was already computed for the query text skips the embedding call.
         """
         vector: list[float] = []
         # if enable_vector_search and query_text is not None:
-        vector = await compute_text_embedding(
-            query_text,
-            self.openai_embed_client,
-            self.embed_model,
-            self.embed_deployment,
-            self.embed_dimensions,
-        )
+        start = time.perf_counter()
+        vector = query_vector if query_vector is not None else await self.embed(query_text)
+        embedding_ms = (time.perf_counter() - start) * 1000
         # if not enable_text_search:
         #     query_text = None
 
-        return await self.search(query_text, vector, top, filters, retrieval_mode)
+        results = await self.search(
+            query_text, vector, top, filters, retrieval_mode, consider_n, ef_search, graph_candidates
+        )
+        self.stage_timings["embedding"] = embedding_ms
+        return results
@@ -1,10 +1,85 @@
 import json
+import os
+import re
+import unicodedata
+from typing import Any
 
 from openai.types.chat import (
     ChatCompletion,
+    ChatCompletionMessageParam,
     ChatCompletionToolParam,
 )
 
+from fastapi_app.api_models import RewritePolicy
+from fastapi_app.caching import TTLCache, hash_key
+
+# Rewritten queries (and extracted filters) of temperature-0 rewrite completions, keyed by rewrite_cache_key
+rewrite_cache: TTLCache[Any] = TTLCache(
+    maxsize=int(os.getenv("QUERY_REWRITE_CACHE_SIZE", 1024)),
+    ttl=float(os.getenv("QUERY_REWRITE_CACHE_TTL_SECONDS", 3600)),
+)
+
+# Tool arguments of search_database and the filterable columns they map to, see search_filters.FILTER_OPERATORS
+FILTER_ARGUMENT_COLUMNS = {
+    "court_filter": "court_id",
+    "decision_date_filter": "decision_date",
+    "jurisdiction_filter": "jurisdiction",
+}
+
+
+DEFAULT_REWRITE_POLICY = RewritePolicy(os.getenv("QUERY_REWRITE_POLICY", RewritePolicy.ALWAYS.value))
+# Longest query that the auto rewrite policy searches as is
+REWRITE_MAX_KEYWORD_TOKENS = int(os.getenv("QUERY_REWRITE_MAX_KEYWORD_TOKENS", 8))
+# Words that need the conversation to resolve, or that the rewrite prompt strips (prominence, precedents, locations)
+REWRITE_CUE_WORDS = set(
+    "it its they them their this that these those he she him her his "
+    "cited citing precedent precedents prominent landmark leading famous court courts".split()
+)
+
+
+def rewrite_decision(
+    policy: RewritePolicy, query: str, past_messages: list[ChatCompletionMessageParam]
+) -> tuple[bool, str]:
+    """
+    Whether to rewrite the query with the chat model, and why. The auto policy skips the rewrite for short,
+    single-turn keyword queries, which the rewrite would return nearly unchanged.
+    """
+    if policy == RewritePolicy.ALWAYS:
+        return True, "policy is always"
+    if policy == RewritePolicy.NEVER:
+        return False, "policy is never"
+    if past_messages:
+        return True, "the conversation has history"
+    tokens = re.findall(r"\w+", query.lower())
+    if len(tokens) > REWRITE_MAX_KEYWORD_TOKENS:
+        return True, f"more than {REWRITE_MAX_KEYWORD_TOKENS} tokens"
+    if cue_words := sorted(REWRITE_CUE_WORDS.intersection(tokens)):
+        return True, f"contains {', '.join(cue_words)}"
+    if "?" in query:
+        return True, "phrased as a question"
+    return False, "short single-turn keyword query"
+
+
+def rewrite_cache_key(prompt: Any, model: str, messages: list[ChatCompletionMessageParam]) -> str:
+    """
+    Cache key of a query rewrite: the prompt (template, few-shots and tools), the model and the message history,
+    with the message contents NFC-normalized and their whitespace collapsed.
+    """
+    history = [
+        {
+            "role": message["role"],
+            "content": (
+                " ".join(unicodedata.normalize("NFC", content).split())
+                if isinstance(content := message.get("content"), str)
+                else content
+            ),
+        }
+        for message in messages
+    ]
+    return hash_key(
+        json.dumps(prompt, sort_keys=True, default=str), model, json.dumps(history, sort_keys=True, default=str)
+    )
+
 
 def build_search_function() -> list[ChatCompletionToolParam]:
     return [
@@ -12,39 +87,54 @@ def build_search_function() -> list[ChatCompletionToolParam]:
             "type": "function",
             "function": {
                 "name": "search_database",
-                "description": "Search PostgreSQL database for relevant products based on user query",
+                "description": "Search PostgreSQL database for relevant legal cases based on user query",
                 "parameters": {
                     "type": "object",
                     "properties": {
                         "search_query": {
                             "type": "string",
-                            "description": "Query string to use for full text search, e.g. 'red shoes'",
+                            "description": "Query string to use for the search, e.g. 'water leaking from above'",
+                        },
+                        "court_filter": {
+                            "type": "object",
+                            "description": "Filter search results to cases decided by the given courts",
+                            "properties": {
+                                "comparison_operator": {
+                                    "type": "string",
+                                    "description": "Operator to compare the column value, either '=' or 'IN'",
+                                },
+                                "value": {
+                                    "type": "array",
+                                    "items": {"type": "integer"},
+                                    "description": "Court ids to compare against, e.g. [9029]",
+                                },
+                            },
                         },
-                        "price_filter": {
+                        "decision_date_filter": {
                             "type": "object",
-                            "description": "Filter search results based on price of the product",
+                            "description": "Filter search results based on the decision date of the case",
                             "properties": {
                                 "comparison_operator": {
                                     "type": "string",
                                     "description": "Operator to compare the column value, either '>', '<', '>=', '<=', '='",  # noqa
                                 },
                                 "value": {
-                                    "type": "number",
-                                    "description": "Value to compare against, e.g. 30",
+                                    "type": "string",
+                                    "description": "ISO date to compare against, e.g. 1980-01-01",
                                 },
                             },
                         },
-                        "brand_filter": {
+                        "jurisdiction_filter": {
                             "type": "object",
-                            "description": "Filter search results based on brand of the product",
+                            "description": "Filter search results based on the jurisdiction of the case",
                             "properties": {
                                 "comparison_operator": {
                                     "type": "string",
-                                    "description": "Operator to compare the column value, either '=' or '!='",
+                                    "description": "Operator to compare the column value, only '='",
                                 },
                                 "value": {
                                     "type": "string",
-                                    "description": "Value to compare against, e.g. AirStrider",
+                                    "description": "Jurisdiction to compare against, e.g. Washington",
                                 },
                             },
                         },
@@ -69,24 +159,16 @@ def extract_search_arguments(original_user_query: str, chat_completion: ChatComp
                 arg = json.loads(function.arguments)
                 # Even though its required, search_query is not always specified
                 search_query = arg.get("search_query", original_user_query)
-                if "price_filter" in arg and arg["price_filter"]:
-                    price_filter = arg["price_filter"]
-                    filters.append(
-                        {
-                            "column": "price",
-                            "comparison_operator": price_filter["comparison_operator"],
-                            "value": price_filter["value"],
-                        }
-                    )
-                if "brand_filter" in arg and arg["brand_filter"]:
-                    brand_filter = arg["brand_filter"]
-                    filters.append(
-                        {
-                            "column": "brand",
-                            "comparison_operator": brand_filter["comparison_operator"],
-                            "value": brand_filter["value"],
-                        }
-                    )
+                for argument, column in FILTER_ARGUMENT_COLUMNS.items():
+                    if argument in arg and arg[argument]:
+                        search_filter = arg[argument]
+                        filters.append(
+                            {
+                                "column": column,
+                                "comparison_operator": search_filter.get("comparison_operator", "="),
+                                "value": search_filter.get("value"),
+                            }
+                        )
     elif query_text := response_message.content:
         search_query = query_text.strip()
     return search_query, filters
@@ -1,3 +1,4 @@
+import asyncio
 from collections.abc import AsyncGenerator
 from typing import Any, Final
 
@@ -13,9 +14,15 @@ from fastapi_app.api_models import (
     RetrievalResponseDelta,
     ThoughtStep,
 )
+from fastapi_app.context_packer import opinion_char_limit, pack_context
 from fastapi_app.postgres_models import Item
 from fastapi_app.postgres_searcher import PostgresSearcher
-from fastapi_app.query_rewriter import build_search_function, extract_search_arguments
+from fastapi_app.query_rewriter import (
+    build_search_function,
+    extract_search_arguments,
+    rewrite_cache,
+    rewrite_cache_key,
+)
 from fastapi_app.rag_base import ChatParams, RAGChatBase
 
 
@@ -58,6 +65,16 @@ class AdvancedRAGChat(RAGChatBase):
 
         print("Query Messages", query_messages)
 
+        # The completion runs at temperature 0, so the same conversation gets the same search arguments
+        cache_key = rewrite_cache_key(
+            [self.query_prompt_template, self.query_fewshots, tools],
+            self.chat_deployment or self.chat_model,
+            [*past_messages, {"role": "user", "content": original_user_query}],
+        )
+        if (cached_arguments := rewrite_cache.get(cache_key)) is not None:
+            query_text, filters = cached_arguments
+            return query_messages, query_text, filters
+
         chat_completion: ChatCompletion = await self.openai_chat_client.chat.completions.create(
             messages=query_messages,
             # Azure OpenAI takes the deployment name as the model name
@@ -70,6 +87,8 @@ class AdvancedRAGChat(RAGChatBase):
         )
 
         query_text, filters = extract_search_arguments(original_user_query, chat_completion)
+        if query_text:
+            rewrite_cache.set(cache_key, (query_text, filters))
 
         print("Query Text", query_text)
         print("Filters", filters)
@@ -88,17 +107,25 @@ class AdvancedRAGChat(RAGChatBase):
         print("Query Messages", query_messages)
         print("Query Text", query_text)
 
+        if (cached_context := await self.answer_cache_context(chat_params, filters)) is not None:
+            return cached_context
+
         # Retrieve relevant rows from the database with the GPT optimized query
         results = await self.searcher.search_and_embed(
+            chat_params.retrieval_mode,
             query_text,
             top=chat_params.top,
             enable_vector_search=chat_params.enable_vector_search,
             enable_text_search=chat_params.enable_text_search,
             filters=filters,
+            consider_n=chat_params.consider_n,
+            ef_search=chat_params.ef_search,
+            graph_candidates=chat_params.graph_candidates,
+            query_vector=self.query_vector_for(chat_params, query_text),
         )
 
-        sources_content = [f"[{(item.id)}]:{item.to_str_for_rag()}\n\n" for item in results]
-        content = "\n".join(sources_content)
+        opinion_texts = await self.searcher.opinion_texts([case.id for case in results], opinion_char_limit())
+        content, context_tokens = await asyncio.to_thread(pack_context, results, opinion_texts, self.chat_model)
 
         # Generate a contextual and content specific answer using the search results and chat history
         contextual_messages: list[ChatCompletionMessageParam] = build_messages(
@@ -133,6 +160,7 @@ class AdvancedRAGChat(RAGChatBase):
             ThoughtStep(
                 title="Search results",
                 description=[result.to_dict() for result in results],
+                props={"context_tokens": context_tokens},
             ),
         ]
         return contextual_messages, results, thoughts
@@ -182,18 +210,7 @@ class AdvancedRAGChat(RAGChatBase):
         results: list[Item],
         earlier_thoughts: list[ThoughtStep],
     ) -> AsyncGenerator[RetrievalResponseDelta, None]:
-        chat_completion_async_stream: AsyncStream[
-            ChatCompletionChunk
-        ] = await self.openai_chat_client.chat.completions.create(
-            # Azure OpenAI takes the deployment name as the model name
-            model=self.chat_deployment if self.chat_deployment else self.chat_model,
-            messages=contextual_messages,
-            temperature=chat_params.temperature,
-            max_tokens=chat_params.response_token_limit,
-            n=1,
-            stream=True,
-        )
-
+        # Send the retrieval context before waiting on the chat model, so it reaches the client right after search
         yield RetrievalResponseDelta(
             context=RAGContext(
                 data_points={item.id: item.to_dict() for item in results},
@@ -212,6 +229,18 @@ class AdvancedRAGChat(RAGChatBase):
             ),
         )
 
+        chat_completion_async_stream: AsyncStream[
+            ChatCompletionChunk
+        ] = await self.openai_chat_client.chat.completions.create(
+            # Azure OpenAI takes the deployment name as the model name
+            model=self.chat_deployment if self.chat_deployment else self.chat_model,
+            messages=contextual_messages,
+            temperature=chat_params.temperature,
+            max_tokens=chat_params.response_token_limit,
+            n=1,
+            stream=True,
+        )
+
         async for response_chunk in chat_completion_async_stream:
             # first response has empty choices and last response has empty content
             if response_chunk.choices and response_chunk.choices[0].delta.content:
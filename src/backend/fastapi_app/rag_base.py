@@ -5,17 +5,28 @@ from collections.abc import AsyncGenerator
 
 from openai.types.chat import ChatCompletionMessageParam
 
+from fastapi_app.answer_cache import answer_cache
 from fastapi_app.api_models import (
+    AIChatRoles,
     ChatParams,
     ChatRequestOverrides,
+    Message,
+    RAGContext,
     RetrievalResponse,
     RetrievalResponseDelta,
     ThoughtStep,
 )
-from fastapi_app.postgres_models import Item
+from fastapi_app.postgres_models import AnswerCacheEntry, Case, Item
+from fastapi_app.postgres_searcher import PostgresSearcher
+from fastapi_app.query_rewriter import DEFAULT_REWRITE_POLICY
 
 
 class RAGChatBase(ABC):
+    searcher: PostgresSearcher
+    # Set by answer_cache_context: the question embedding, the answer cache key and the cache hit, if any
+    question_vector: list[float] | None = None
+    answer_cache_key: str | None = None
+    cached_answer_entry: tuple[AnswerCacheEntry, float] | None = None
     current_dir = pathlib.Path(__file__).parent
     query_prompt_template = open(current_dir / "prompts/query.txt").read()
     query_fewshots = json.loads(open(current_dir / "prompts/query_fewshots.json").read())
@@ -40,6 +51,12 @@ class RAGChatBase(ABC):
             temperature=overrides.temperature,
             retrieval_mode=overrides.retrieval_mode,
             use_advanced_flow=overrides.use_advanced_flow,
+            consider_n=overrides.consider_n,
+            ef_search=overrides.ef_search,
+            graph_candidates=overrides.graph_candidates,
+            speculative_search=overrides.speculative_search,
+            rewrite_policy=overrides.rewrite_policy or DEFAULT_REWRITE_POLICY,
+            use_answer_cache=overrides.use_answer_cache,
             response_token_limit=response_token_limit,
             prompt_template=prompt_template,
             enable_text_search=enable_text_search,
@@ -75,3 +92,93 @@ class RAGChatBase(ABC):
         raise NotImplementedError
         if False:
             yield 0
+
+    async def answer_cache_context(
+        self, chat_params: ChatParams, filters: list[dict] | None
+    ) -> tuple[list[ChatCompletionMessageParam], list[Case], list[ThoughtStep]] | None:
+        """
+        Look the question up in the answer cache before searching. On a hit, returns the context of the cached
+        answer with its cases reloaded, so the data points and thoughts are current; None when the flow
+        has to search. The question embedding is kept for the search and for storing the answer.
+        """
+        if not answer_cache.enabled_for(chat_params):
+            return None
+        self.question_vector = await self.searcher.embed(chat_params.original_user_query)
+        self.answer_cache_key = answer_cache.filters_key(chat_params, filters)
+        self.cached_answer_entry = await answer_cache.get(
+            self.question_vector, chat_params.retrieval_mode.value, self.answer_cache_key
+        )
+        if self.cached_answer_entry is None:
+            return None
+        entry, distance = self.cached_answer_entry
+        cases_by_id = await self.searcher.load_cases(entry.case_ids)
+        results = [cases_by_id[case_id] for case_id in entry.case_ids if case_id in cases_by_id]
+        thoughts = [
+            ThoughtStep(
+                title="Answer cache",
+                description=entry.question,
+                props={"distance": distance, "cached_at": entry.created_at.isoformat()},
+            ),
+            ThoughtStep(
+                title="Search results",
+                description=[result.to_dict() for result in results],
+            ),
+        ]
+        return [], results, thoughts
+
+    def query_vector_for(self, chat_params: ChatParams, query_text: str | None) -> list[float] | None:
+        """The question embedding of the answer cache lookup, when the search query is the question itself."""
+        return self.question_vector if query_text == chat_params.original_user_query else None
+
+    async def store_answer(self, chat_params: ChatParams, results: list[Item], answer: str) -> None:
+        if self.question_vector is None or self.answer_cache_key is None:
+            return
+        await answer_cache.set(
+            chat_params.original_user_query,
+            self.question_vector,
+            chat_params.retrieval_mode.value,
+            self.answer_cache_key,
+            [item.id for item in results],
+            answer,
+        )
+
+    async def cached_answer(
+        self,
+        chat_params: ChatParams,
+        contextual_messages: list[ChatCompletionMessageParam],
+        results: list[Item],
+        earlier_thoughts: list[ThoughtStep],
+    ) -> RetrievalResponse:
+        """answer, served from the answer cache when prepare_context found a near-duplicate question"""
+        if self.cached_answer_entry is not None:
+            return RetrievalResponse(
+                message=Message(content=self.cached_answer_entry[0].answer, role=AIChatRoles.ASSISTANT),
+                context=RAGContext(
+                    data_points={item.id: item.to_dict() for item in results}, thoughts=earlier_thoughts
+                ),
+            )
+        response = await self.answer(chat_params, contextual_messages, results, earlier_thoughts)
+        await self.store_answer(chat_params, results, response.message.content)
+        return response
+
+    async def cached_answer_stream(
+        self,
+        chat_params: ChatParams,
+        contextual_messages: list[ChatCompletionMessageParam],
+        results: list[Item],
+        earlier_thoughts: list[ThoughtStep],
+    ) -> AsyncGenerator[RetrievalResponseDelta, None]:
+        """answer_stream, replaying a cached answer as deltas when prepare_context found a near-duplicate question"""
+        if self.cached_answer_entry is not None:
+            yield RetrievalResponseDelta(
+                context=RAGContext(data_points={item.id: item.to_dict() for item in results}, thoughts=earlier_thoughts)
+            )
+            for line in self.cached_answer_entry[0].answer.splitlines(keepends=True):
+                yield RetrievalResponseDelta(delta=Message(content=line, role=AIChatRoles.ASSISTANT))
+            return
+        answer_parts = []
+        async for delta in self.answer_stream(chat_params, contextual_messages, results, earlier_thoughts):
+            if delta.delta is not None:
+                answer_parts.append(delta.delta.content)
+            yield delta
+        await self.store_answer(chat_params, results, "".join(answer_parts))
@@ -1,3 +1,6 @@
+import asyncio
+import os
+import re
 from collections.abc import AsyncGenerator
 
 from openai import AsyncAzureOpenAI, AsyncOpenAI, AsyncStream
@@ -12,10 +15,24 @@ from fastapi_app.api_models import (
     RetrievalResponseDelta,
     ThoughtStep,
 )
+from fastapi_app.context_packer import opinion_char_limit, pack_context
 from fastapi_app.postgres_models import Case
 from fastapi_app.postgres_searcher import PostgresSearcher
+from fastapi_app.query_rewriter import rewrite_cache, rewrite_cache_key, rewrite_decision
 from fastapi_app.rag_base import ChatParams, RAGChatBase
 
+# Token-set Jaccard similarity above which a rewritten query counts as the original one, so the original query
+# is searched with the embedding computed while the rewrite was generated
+SPECULATIVE_SEARCH_MIN_SIMILARITY = float(os.getenv("SPECULATIVE_SEARCH_MIN_SIMILARITY", 0.8))
+
+
+def query_similarity(query: str, other_query: str) -> float:
+    tokens = set(re.findall(r"\w+", query.lower()))
+    other_tokens = set(re.findall(r"\w+", other_query.lower()))
+    if not tokens or not other_tokens:
+        return 0.0
+    return len(tokens & other_tokens) / len(tokens | other_tokens)
+
 class MarkdownProcessor:
     def __init__(self):
         self.buffer = ""  # Stores the leftover incomplete text
@@ -88,10 +105,32 @@ class SimpleRAGChat(RAGChatBase):
         self.chat_deployment = chat_deployment
         self.chat_token_limit = get_token_limit(chat_model, default_to_minimum=True)
 
+    async def search(
+        self, chat_params: ChatParams, query_text: str | None, query_vector: list[float] | None = None
+    ) -> list[Case]:
+        try:
+            return await self.searcher.search_and_embed(
+                retrieval_mode=chat_params.retrieval_mode,
+                query_text=query_text,
+                top=chat_params.top,
+                enable_vector_search=chat_params.enable_vector_search,
+                enable_text_search=chat_params.enable_text_search,
+                consider_n=chat_params.consider_n,
+                ef_search=chat_params.ef_search,
+                graph_candidates=chat_params.graph_candidates,
+                query_vector=query_vector,
+            )
+        except Exception:
+            # Leave the session usable for the rest of the request
+            await self.searcher.db_session.rollback()
+            raise
+
     async def prepare_context(
         self, chat_params: ChatParams
     ) -> tuple[list[ChatCompletionMessageParam], list[Case], list[ThoughtStep]]:
         """Retrieve relevant rows from the database and build a context for the chat model."""
+        if (cached_context := await self.answer_cache_context(chat_params, None)) is not None:
+            return cached_context
 
         query_messages: list[ChatCompletionMessageParam] = build_messages(
             model=self.chat_model,
@@ -100,29 +139,65 @@ class SimpleRAGChat(RAGChatBase):
             new_user_content="QUERY:\n" + chat_params.original_user_query,
         )
 
-        chat_completion: ChatCompletion = await self.openai_chat_client.chat.completions.create(
-            messages=query_messages,
-            model=self.chat_deployment if self.chat_deployment else self.chat_model,
-            temperature=0.0,
-            max_tokens=500,
+        # The rewrite runs at temperature 0, so the same query gets the same rewrite
+        cache_key = rewrite_cache_key(
+            self.query_rewrite_template,
+            self.chat_deployment or self.chat_model,
+            [{"role": "user", "content": chat_params.original_user_query}],
         )
-
-        new_user_query = chat_completion.choices[0].message.content
-
-        # Retrieve relevant rows from the database
-        results = await self.searcher.search_and_embed(
-            retrieval_mode=chat_params.retrieval_mode,
-            query_text=new_user_query,
-            top=chat_params.top,
-            enable_vector_search=chat_params.enable_vector_search,
-            enable_text_search=chat_params.enable_text_search,
+        rewrite, rewrite_reason = rewrite_decision(
+            chat_params.rewrite_policy, chat_params.original_user_query, chat_params.past_messages
         )
+        new_user_query = rewrite_cache.get(cache_key) if rewrite else chat_params.original_user_query
+        rewrite_cached = rewrite and new_user_query is not None
+
+        speculative_embedding = None
+        if chat_params.speculative_search and new_user_query is None:
+            # Embed the original query while the rewrite is generated, the database session stays free for the search
+            speculative_embedding = asyncio.create_task(self.searcher.embed(chat_params.original_user_query))
+
+        if new_user_query is None:
+            try:
+                chat_completion: ChatCompletion = await self.openai_chat_client.chat.completions.create(
+                    messages=query_messages,
+                    model=self.chat_deployment if self.chat_deployment else self.chat_model,
+                    temperature=0.0,
+                    max_tokens=500,
+                )
+            except Exception:
+                if speculative_embedding is not None:
+                    speculative_embedding.cancel()
+                raise
+
+            new_user_query = chat_completion.choices[0].message.content
+            if new_user_query:
+                rewrite_cache.set(cache_key, new_user_query)
+
+        speculative: dict | None = None
+        results: list[Case] | None = None
+        if speculative_embedding is not None:
+            similarity = query_similarity(chat_params.original_user_query, new_user_query or "")
+            speculative = {"similarity": similarity, "used": similarity >= SPECULATIVE_SEARCH_MIN_SIMILARITY}
+            if not speculative["used"]:
+                speculative_embedding.cancel()
+            else:
+                try:
+                    original_vector = await speculative_embedding
+                except Exception as e:
+                    speculative = {"similarity": similarity, "used": False, "error": str(e)}
+                else:
+                    # The rewrite matches the original query, search the original query with its embedding
+                    results = await self.search(chat_params, chat_params.original_user_query, original_vector)
+
+        if results is None:
+            # Retrieve relevant rows from the database
+            results = await self.search(chat_params, new_user_query, self.query_vector_for(chat_params, new_user_query))
 
         if results is None:
             results = []  # Default to an empty list if no results
 
-        sources_content = [f"[{(item.id)}]:{item.to_str_for_rag()}\n\n" for item in results]
-        content = "\n".join(sources_content)
+        opinion_texts = await self.searcher.opinion_texts([case.id for case in results], opinion_char_limit())
+        content, context_tokens = await asyncio.to_thread(pack_context, results, opinion_texts, self.chat_model)
 
         # Generate a contextual and content specific answer using the search results and chat history
         contextual_messages: list[ChatCompletionMessageParam] = build_messages(
@@ -135,6 +210,16 @@ class SimpleRAGChat(RAGChatBase):
         )
 
         thoughts = [
+            ThoughtStep(
+                title="Query rewrite",
+                description="Rewritten with the chat model" if rewrite else "Searched the original query",
+                props={
+                    "policy": chat_params.rewrite_policy.value,
+                    "rewrite": rewrite,
+                    "reason": rewrite_reason,
+                    "cached": rewrite_cached,
+                },
+            ),
             ThoughtStep(
                 title="Search query for database",
                 description=new_user_query,
@@ -142,11 +227,13 @@ class SimpleRAGChat(RAGChatBase):
                     "top": chat_params.top,
                     "vector_search": chat_params.enable_vector_search,
                     "text_search": chat_params.enable_text_search,
+                    **({"speculative_search": speculative} if speculative else {}),
                 },
             ),
             ThoughtStep(
                 title="Search results",
                 description=[result.to_dict() for result in results],
+                props={"context_tokens": context_tokens},
             ),
         ]
         return contextual_messages, results, thoughts
@@ -196,18 +283,7 @@ class SimpleRAGChat(RAGChatBase):
         results: list[Case],
         earlier_thoughts: list[ThoughtStep],
     ) -> AsyncGenerator[RetrievalResponseDelta, None]:
-        chat_completion_async_stream: AsyncStream[
-            ChatCompletionChunk
-        ] = await self.openai_chat_client.chat.completions.create(
-            # Azure OpenAI takes the deployment name as the model name
-            model=self.chat_deployment if self.chat_deployment else self.chat_model,
-            messages=contextual_messages,
-            temperature=chat_params.temperature,
-            max_tokens=chat_params.response_token_limit,
-            n=1,
-            stream=True,
-        )
-
+        # Send the retrieval context before waiting on the chat model, so it reaches the client right after search
         yield RetrievalResponseDelta(
             context=RAGContext(
                 data_points={item.id: item.to_dict() for item in results},
@@ -223,7 +299,19 @@ class SimpleRAGChat(RAGChatBase):
                         ),
                     ),
                 ],
-            ),  
+            ),
+        )
+
+        chat_completion_async_stream: AsyncStream[
+            ChatCompletionChunk
+        ] = await self.openai_chat_client.chat.completions.create(
+            # Azure OpenAI takes the deployment name as the model name
+            model=self.chat_deployment if self.chat_deployment else self.chat_model,
+            messages=contextual_messages,
+            temperature=chat_params.temperature,
+            max_tokens=chat_params.response_token_limit,
+            n=1,
+            stream=True,
         )
         
 
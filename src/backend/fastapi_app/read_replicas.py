@@ -0,0 +1,43 @@
+import logging
+import time
+
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+logger = logging.getLogger("ragapp")
+
+
+class ReadReplicaRouter:
+    """
+    Hands out sessions for read-only work, round-robin over the read replicas and falling back to the primary.
+    A replica that fails to connect is skipped for retry_after seconds.
+    """
+
+    def __init__(
+        self,
+        primary: async_sessionmaker[AsyncSession],
+        replicas: list[async_sessionmaker[AsyncSession]],
+        retry_after: float = 30,
+    ):
+        self.primary = primary
+        self.replicas = replicas
+        self.retry_after = retry_after
+        self._unhealthy_until = [0.0] * len(replicas)
+        self._next = 0
+
+    async def session(self) -> AsyncSession:
+        now = time.monotonic()
+        for _ in range(len(self.replicas)):
+            index = self._next % len(self.replicas)
+            self._next += 1
+            if self._unhealthy_until[index] > now:
+                continue
+            session = self.replicas[index]()
+            try:
+                # Check out the connection now, so an unreachable replica is detected before any query runs
+                await session.connection()
+                return session
+            except Exception as e:
+                await session.close()
+                self._unhealthy_until[index] = now + self.retry_after
+                logger.warning("Read replica %d is unavailable, skipping it for %ss: %s", index, self.retry_after, e)
+        return self.primary()
@@ -1,23 +1,40 @@
 import json
 import logging
 from collections.abc import AsyncGenerator
+from typing import Annotated, Any
 
 import fastapi
 from fastapi import HTTPException
 from fastapi.responses import StreamingResponse
 from sqlalchemy import select
 
+from fastapi_app.answer_cache import answer_cache
 from fastapi_app.api_models import (
     ChatRequest,
     ErrorResponse,
     ItemPublic,
     ItemWithDistance,
+    RetrievalMode,
     RetrievalResponse,
     RetrievalResponseDelta,
 )
-from fastapi_app.dependencies import ChatClient, CommonDeps, DBSession, EmbeddingsClient
-from fastapi_app.postgres_models import Item
+from fastapi_app.dependencies import (
+    ChatClient,
+    CitationGraphDep,
+    CitationGraphStoreDep,
+    CommonDeps,
+    DBEngine,
+    DBReplicaEngines,
+    DBSession,
+    EmbeddingsClient,
+    ReadDBSession,
+    ReadReplicaRouterDep,
+)
+from fastapi_app.embeddings import embedding_cache
+from fastapi_app.postgres_engine import pool_stats_by_host
+from fastapi_app.postgres_models import CaseOpinion, Item
 from fastapi_app.postgres_searcher import PostgresSearcher
+from fastapi_app.query_rewriter import rewrite_cache
 from fastapi_app.rag_advanced import AdvancedRAGChat
 from fastapi_app.rag_simple import SimpleRAGChat
 
@@ -65,40 +82,143 @@ async def similar_handler(
     ]
 
 
-@router.get("/search", response_model=list[ItemPublic])
+@router.get("/search", response_model=list[dict[str, Any]])
 async def search_handler(
     context: CommonDeps,
-    database_session: DBSession,
+    read_replica_router: ReadReplicaRouterDep,
     openai_embed: EmbeddingsClient,
+    citation_graph: CitationGraphDep,
     query: str,
-    top: int = 5,
+    top: Annotated[int, fastapi.Query(ge=1)] = 5,
+    retrieval_mode: RetrievalMode = RetrievalMode.VECTOR,
+    consider_n: int | None = None,
+    ef_search: int | None = None,
+    graph_candidates: int | None = None,
     enable_vector_search: bool = True,
     enable_text_search: bool = True,
-) -> list[ItemPublic]:
-    """A search API to find items based on a query."""
-    searcher = PostgresSearcher(
-        db_session=database_session,
-        openai_embed_client=openai_embed.client,
-        embed_deployment=context.openai_embed_deployment,
-        embed_model=context.openai_embed_model,
-        embed_dimensions=context.openai_embed_dimensions,
-        embedding_column=context.embedding_column,
-    )
-    results = await searcher.search_and_embed(
-        query, top=top, enable_vector_search=enable_vector_search, enable_text_search=enable_text_search
-    )
-    return [ItemPublic.model_validate(item.to_dict()) for item in results]
+) -> list[dict[str, Any]]:
+    """A search API to find cases based on a query."""
+    async with await read_replica_router.session() as database_session:
+        searcher = PostgresSearcher(
+            db_session=database_session,
+            openai_embed_client=openai_embed.client,
+            embed_deployment=context.openai_embed_deployment,
+            embed_model=context.openai_embed_model,
+            embed_dimensions=context.openai_embed_dimensions,
+            embedding_column=context.embedding_column,
+            citation_graph=citation_graph,
+        )
+        results = await searcher.search_and_embed(
+            retrieval_mode,
+            query,
+            top=top,
+            enable_vector_search=enable_vector_search,
+            enable_text_search=enable_text_search,
+            consider_n=consider_n,
+            ef_search=ef_search,
+            graph_candidates=graph_candidates,
+        )
+    return [case.to_dict() for case in results]
+
+
+@router.post("/graph/refresh")
+async def citation_graph_refresh_handler(citation_graph_store: CitationGraphStoreDep):
+    """Reload the in-process citation graph, e.g. after seeding. The other workers reload on their next poll."""
+    if citation_graph_store is None:
+        raise HTTPException(detail="The in-process citation graph is not enabled.", status_code=404)
+    graph = await citation_graph_store.request_refresh()
+    return {"cases": len(graph.case_ids), "edges": graph.edge_count}
+
+
+@router.get("/cache/stats")
+async def cache_stats_handler():
+    """Hit and miss counters of the in-process caches."""
+    return {
+        "embeddings": embedding_cache.stats(),
+        "query_rewrites": rewrite_cache.stats(),
+        "answers": answer_cache.stats(),
+    }
+
+
+@router.get("/pool/stats")
+async def pool_stats_handler(engine: DBEngine, replica_engines: DBReplicaEngines):
+    """Checked-out connections, overflow and checkout wait time of the primary's and each replica's pool, by host."""
+    return pool_stats_by_host(engine, replica_engines)
+
+
+@router.get("/cases/{id}/opinions", response_model=list[dict[str, Any]])
+async def case_opinions_handler(database_session: ReadDBSession, id: str) -> list[dict[str, Any]]:
+    """The full opinion texts of a case, search results only carry an 800-character snippet."""
+    opinions = (
+        await database_session.scalars(
+            select(CaseOpinion).where(CaseOpinion.case_id == id).order_by(CaseOpinion.ordinal)
+        )
+    ).all()
+    if not opinions:
+        raise HTTPException(detail=f"Opinions of case with ID {id} not found.", status_code=404)
+    return [opinion.to_dict() for opinion in opinions]
 
 
 @router.post("/chat", response_model=RetrievalResponse | ErrorResponse)
 async def chat_handler(
     context: CommonDeps,
-    database_session: DBSession,
+    read_replica_router: ReadReplicaRouterDep,
     openai_embed: EmbeddingsClient,
     openai_chat: ChatClient,
+    citation_graph: CitationGraphDep,
     chat_request: ChatRequest,
 ):
     try:
+        async with await read_replica_router.session() as database_session:
+            searcher = PostgresSearcher(
+                db_session=database_session,
+                openai_embed_client=openai_embed.client,
+                embed_deployment=context.openai_embed_deployment,
+                embed_model=context.openai_embed_model,
+                embed_dimensions=context.openai_embed_dimensions,
+                embedding_column=context.embedding_column,
+                citation_graph=citation_graph,
+            )
+            rag_flow: SimpleRAGChat | AdvancedRAGChat
+            if chat_request.context.overrides.use_advanced_flow:
+                rag_flow = AdvancedRAGChat(
+                    searcher=searcher,
+                    openai_chat_client=openai_chat.client,
+                    chat_model=context.openai_chat_model,
+                    chat_deployment=context.openai_chat_deployment,
+                )
+            else:
+                rag_flow = SimpleRAGChat(
+                    searcher=searcher,
+                    openai_chat_client=openai_chat.client,
+                    chat_model=context.openai_chat_model,
+                    chat_deployment=context.openai_chat_deployment,
+                )
+
+            chat_params = rag_flow.get_params(chat_request.messages, chat_request.context.overrides)
+
+            contextual_messages, results, thoughts = await rag_flow.prepare_context(chat_params)
+            response = await rag_flow.cached_answer(
+                chat_params=chat_params,
+                contextual_messages=contextual_messages,
+                results=results,
+                earlier_thoughts=thoughts,
+            )
+        return response
+    except Exception as e:
+        return {"error": str(e)}
+
+
+@router.post("/chat/stream")
+async def chat_stream_handler(
+    context: CommonDeps,
+    read_replica_router: ReadReplicaRouterDep,
+    openai_embed: EmbeddingsClient,
+    openai_chat: ChatClient,
+    citation_graph: CitationGraphDep,
+    chat_request: ChatRequest,
+):
+    async with await read_replica_router.session() as database_session:
         searcher = PostgresSearcher(
             db_session=database_session,
             openai_embed_client=openai_embed.client,
@@ -106,7 +226,9 @@ async def chat_handler(
             embed_model=context.openai_embed_model,
             embed_dimensions=context.openai_embed_dimensions,
             embedding_column=context.embedding_column,
+            citation_graph=citation_graph,
         )
+
         rag_flow: SimpleRAGChat | AdvancedRAGChat
         if chat_request.context.overrides.use_advanced_flow:
             rag_flow = AdvancedRAGChat(
@@ -125,46 +247,11 @@ async def chat_handler(
 
         chat_params = rag_flow.get_params(chat_request.messages, chat_request.context.overrides)
 
+        # Intentionally do this before we stream down a response, to avoid using database connections during stream
+        # See https://github.com/tiangolo/fastapi/discussions/11321
         contextual_messages, results, thoughts = await rag_flow.prepare_context(chat_params)
-        response = await rag_flow.answer(
-            chat_params=chat_params, contextual_messages=contextual_messages, results=results, earlier_thoughts=thoughts
-        )
-        return response
-    except Exception as e:
-        return {"error": str(e)}
-
-
-@router.post("/chat/stream")
-async def chat_stream_handler(
-    context: CommonDeps,
-    database_session: DBSession,
-    openai_embed: EmbeddingsClient,
-    openai_chat: ChatClient,
-    chat_request: ChatRequest,
-):
-    searcher = PostgresSearcher(
-        db_session=database_session,
-        openai_embed_client=openai_embed.client,
-        embed_deployment=context.openai_embed_deployment,
-        embed_model=context.openai_embed_model,
-        embed_dimensions=context.openai_embed_dimensions,
-        embedding_column=context.embedding_column,
-    )
-
-    rag_flow = SimpleRAGChat(
-        searcher=searcher,
-        openai_chat_client=openai_chat.client,
-        chat_model=context.openai_chat_model,
-        chat_deployment=context.openai_chat_deployment,
-    )
-
-    chat_params = rag_flow.get_params(chat_request.messages, chat_request.context.overrides)
-
-    # Intentionally do this before we stream down a response, to avoid using database connections during stream
-    # See https://github.com/tiangolo/fastapi/discussions/11321
-    contextual_messages, results, thoughts = await rag_flow.prepare_context(chat_params)
 
-    result = rag_flow.answer_stream(
+    result = rag_flow.cached_answer_stream(
         chat_params=chat_params, contextual_messages=contextual_messages, results=results, earlier_thoughts=thoughts
     )
 
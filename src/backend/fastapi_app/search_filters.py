@@ -0,0 +1,63 @@
+import logging
+import os
+from datetime import date, timedelta
+from typing import Any
+
+logger = logging.getLogger("legalcaseapp")
+
+# Courts searched when the request has no court filter, the Washington Supreme Court by default
+DEFAULT_COURT_IDS = [int(court_id) for court_id in os.getenv("SEARCH_DEFAULT_COURT_IDS", "9029").split(",")]
+# Upper bound on the courts of a court_id "in" filter, the courts past it are dropped with a warning
+MAX_COURT_IDS = int(os.getenv("SEARCH_MAX_COURT_IDS", 20))
+
+# Filterable columns and the comparison operators allowed on each. The values are bound as parameters of the
+# ranking functions, which compare them against indexed columns and expressions of cases_updated:
+#   court_id       the court_id generated column
+#   decision_date  the decision_date generated column, ISO dates compare correctly as text
+#   jurisdiction   the jurisdiction generated column, data#>>'{jurisdiction, name_long}'
+FILTER_OPERATORS = {
+    "court_id": {"=", "in"},
+    "decision_date": {"=", ">", ">=", "<", "<="},
+    "jurisdiction": {"="},
+}
+
+
+def compile_filters(filters: list[dict] | None) -> dict[str, Any]:
+    """
+    Compile filters of the form {"column", "comparison_operator", "value"} into the bound parameters
+    court_ids, decided_from, decided_to and jurisdiction of the ranking functions.
+    Filters on other columns or with other operators are skipped with a warning.
+    """
+    params: dict[str, Any] = {
+        "court_ids": DEFAULT_COURT_IDS,
+        "decided_from": None,
+        "decided_to": None,
+        "jurisdiction": None,
+    }
+    for filter in filters or []:
+        column = filter.get("column")
+        operator = str(filter.get("comparison_operator", "=")).strip().lower()
+        value = filter.get("value")
+        if column not in FILTER_OPERATORS or operator not in FILTER_OPERATORS[column] or value is None:
+            logger.warning("Skipping unsupported search filter: %s", filter)
+            continue
+        try:
+            if column == "court_id":
+                court_ids = list(
+                    dict.fromkeys(int(court_id) for court_id in (value if isinstance(value, list) else [value]))
+                )
+                if len(court_ids) > MAX_COURT_IDS:
+                    logger.warning("Searching only the first %d of %d courts", MAX_COURT_IDS, len(court_ids))
+                params["court_ids"] = court_ids[:MAX_COURT_IDS]
+            elif column == "decision_date":
+                decided = date.fromisoformat(str(value))
+                # Both bounds are inclusive
+                if operator in ("=", ">=", ">"):
+                    params["decided_from"] = (decided + timedelta(days=1 if operator == ">" else 0)).isoformat()
+                if operator in ("=", "<=", "<"):
+                    params["decided_to"] = (decided - timedelta(days=1 if operator == "<" else 0)).isoformat()
+            elif column == "jurisdiction":
+                params["jurisdiction"] = str(value)
+        except (TypeError, ValueError):
+            logger.warning("Skipping search filter with an invalid value: %s", filter)
+    return params
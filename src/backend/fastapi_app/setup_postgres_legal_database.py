@@ -1,5 +1,6 @@
 import argparse
 import asyncio
+import json
 import logging
 import os
 
@@ -12,6 +13,121 @@ from fastapi_app.postgres_models import Base
 logger = logging.getLogger("legalcaseapp")
 
 
+# Indexed expression and operator class of the first-pass vector indexes per SEARCH_VECTOR_QUANTIZATION setting,
+# they must match the first-pass distance expressions of get_vector_ranked
+VECTOR_INDEX_EXPRESSIONS = {
+    "none": "description_vector vector_cosine_ops",
+    "halfvec": "(description_vector::halfvec(1536)) halfvec_cosine_ops",
+    "binary": "(binary_quantize(description_vector)::bit(1536)) bit_hamming_ops",
+}
+
+
+# First-pass ORDER BY expressions of get_vector_ranked, to check which index the planner picks for them
+VECTOR_ORDER_EXPRESSIONS = {
+    "none": "description_vector <=> CAST(:embedding AS vector(1536))",
+    "halfvec": "description_vector::halfvec(1536) <=> CAST(:embedding AS vector(1536))::halfvec(1536)",
+    "binary": "binary_quantize(description_vector)::bit(1536) <~> binary_quantize(CAST(:embedding AS vector(1536)))",
+}
+
+
+def vector_index_name(quantization: str, court_id: int | None = None) -> str:
+    court = f"_court_{court_id}" if court_id is not None else ""
+    suffix = f"_{quantization}" if quantization != "none" else ""
+    return f"cases_updated_description_vector{court}{suffix}_idx"
+
+
+def partial_index_court_ids() -> list[int]:
+    configured_court_ids = os.getenv("SEARCH_PARTIAL_INDEX_COURT_IDS", "9029").split(",")
+    return [int(court_id) for court_id in configured_court_ids if court_id.strip()]
+
+
+def plan_index_names(plan: dict) -> set[str]:
+    """Names of the indexes scanned anywhere in an EXPLAIN (FORMAT JSON) plan node"""
+    names = {plan["Index Name"]} if "Index Name" in plan else set()
+    for subplan in plan.get("Plans", []):
+        names |= plan_index_names(subplan)
+    return names
+
+
+async def create_court_vector_indexes(conn):
+    """
+    Create a partial HNSW index for each court in SEARCH_PARTIAL_INDEX_COURT_IDS, so a court-filtered search scans
+    an index of that court's cases instead of post-filtering the whole-table index.
+    With SEARCH_VECTOR_QUANTIZATION set to halfvec or binary, also create the quantized first-pass indexes,
+    whole-table and per court.
+    """
+    quantization = os.getenv("SEARCH_VECTOR_QUANTIZATION", "none")
+    if quantization not in VECTOR_INDEX_EXPRESSIONS:
+        logger.error(f"Unknown SEARCH_VECTOR_QUANTIZATION {quantization}, not creating quantized indexes")
+        quantization = "none"
+
+    court_ids = partial_index_court_ids()
+    if quantization != "none":
+        logger.info(f"Creating {quantization} HNSW index...")
+        await conn.execute(
+            text(f"""
+            CREATE INDEX IF NOT EXISTS {vector_index_name(quantization)}
+            ON cases_updated USING hnsw ({VECTOR_INDEX_EXPRESSIONS[quantization]})
+            WITH (m = 16, ef_construction = 64);
+        """)
+        )
+    for court_id in court_ids:
+        for index_quantization in dict.fromkeys(["none", quantization]):
+            logger.info(f"Creating partial {index_quantization} HNSW index for court {court_id}...")
+            await conn.execute(
+                text(f"""
+                CREATE INDEX IF NOT EXISTS {vector_index_name(index_quantization, court_id)}
+                ON cases_updated USING hnsw ({VECTOR_INDEX_EXPRESSIONS[index_quantization]})
+                WITH (m = 16, ef_construction = 64)
+                WHERE court_id = {court_id};
+            """)
+            )
+
+
+async def verify_court_vector_indexes(session) -> bool:
+    """
+    EXPLAIN the first pass of get_vector_ranked for each court in SEARCH_PARTIAL_INDEX_COURT_IDS, planned with the
+    court id as a constant like the function's custom plans, and warn when the court's partial index is not chosen.
+    Run after seeding, the planner needs the statistics of cases_updated.
+    """
+    quantization = os.getenv("SEARCH_VECTOR_QUANTIZATION", "none")
+    if quantization not in VECTOR_ORDER_EXPRESSIONS:
+        quantization = "none"
+    embedding = await session.scalar(
+        text("SELECT description_vector::text FROM cases_updated WHERE description_vector IS NOT NULL LIMIT 1;")
+    )
+    if embedding is None:
+        logger.warning("No case vectors to check the partial HNSW indexes with")
+        return False
+
+    await session.execute(text("SET LOCAL plan_cache_mode = force_custom_plan;"))
+    all_chosen = True
+    for court_id in partial_index_court_ids():
+        explain = await session.scalar(
+            text(f"""
+            EXPLAIN (FORMAT JSON)
+            SELECT id FROM cases_updated
+            WHERE court_id = ANY(CAST(:court_ids AS INT[]))
+            ORDER BY {VECTOR_ORDER_EXPRESSIONS[quantization]}
+            LIMIT 10;
+        """),
+            {"court_ids": [court_id], "embedding": embedding},
+        )
+        plan = (json.loads(explain) if isinstance(explain, str) else explain)[0]["Plan"]
+        index_names = plan_index_names(plan)
+        expected = vector_index_name(quantization, court_id)
+        if expected in index_names:
+            logger.info(f"Court {court_id} searches use the partial HNSW index {expected}")
+        else:
+            all_chosen = False
+            logger.warning(
+                f"Court {court_id} searches do not use the partial HNSW index {expected}, "
+                f"the plan scans {', '.join(sorted(index_names)) or 'no index'}"
+            )
+    await session.commit()
+    return all_chosen
+
+
 async def create_db_schema(engine):
     async with engine.begin() as conn:
         logger.info("Enabling azure_ai extension...")
@@ -59,13 +175,38 @@ async def create_db_schema(engine):
         """.format(deployment_name=deployment_name))
         )
 
+        # Reranker scores keyed by query, case and passage, so retries and mode switches skip pairs already scored.
+        # The table is logged, an unlogged table cannot be read on a hot standby that serves searches.
+        logger.info("Creating reranker score cache table...")
+        await conn.execute(text("DROP TABLE IF EXISTS reranker_score_cache;"))
+        await conn.execute(
+            text("""
+            CREATE TABLE reranker_score_cache (
+                query_hash TEXT NOT NULL,
+                case_id TEXT NOT NULL,
+                -- md5 of the scored passage, a changed passage is scored again
+                passage_hash TEXT NOT NULL,
+                relevance DOUBLE PRECISION NOT NULL,
+                created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                PRIMARY KEY (query_hash, case_id, passage_hash)
+            );
+        """)
+        )
+        # Entries older than RERANKER_CACHE_TTL_SECONDS are evicted by get_reranker_scores
+        await conn.execute(
+            text("CREATE INDEX reranker_score_cache_created_at_idx ON reranker_score_cache (created_at);")
+        )
+
         await conn.execute(
             text("""
                 DROP TABLE IF EXISTS public.cases_updated;
+                DROP TABLE IF EXISTS public.case_opinions;
+                DROP TABLE IF EXISTS public.answer_cache;
         """)
         )
         logger.info("Creating database tables and indexes...")
         await conn.run_sync(Base.metadata.create_all)
+        await create_court_vector_indexes(conn)
 
         # Enable the Apache AGE extension and load the library
         logger.info("Enabling the Apache AGE extension for Postgres...")
@@ -14,6 +14,7 @@ from fastapi_app.postgres_engine import (
     create_postgres_engine_from_args,
     create_postgres_engine_from_env,
 )
+from fastapi_app.setup_postgres_legal_database import verify_court_vector_indexes
 
 # Increase the field size limit
 csv.field_size_limit(2147483647)
@@ -21,6 +22,7 @@ csv.field_size_limit(2147483647)
 logger = logging.getLogger("legalcaseapp")
 
 BATCH_SIZE = 100
+OPINION_SNIPPET_LENGTH = 800
 
 
 async def initialize_gold_dataset(session: AsyncSession):
@@ -57,12 +59,100 @@ async def initialize_gold_dataset(session: AsyncSession):
     logger.info("gold_dataset table initialized successfully.")
 
 
+async def initialize_citation_tables(session: AsyncSession):
+    """
+    Drop and create the relational citation tables used by the graph stage of the search functions.
+    `case_citations` holds one row per citing -> cited edge, `case_citation_counts` the in-degree of each
+    cited case, kept current by statement-level triggers on `case_citations`.
+    A cited case does not have to be seeded yet, its in-degree is there when it is.
+    """
+    queries = [
+        "DROP TABLE IF EXISTS case_citation_counts;",
+        "DROP TABLE IF EXISTS case_citations;",
+        """
+        CREATE TABLE case_citations (
+            citing_id TEXT NOT NULL,
+            cited_id TEXT NOT NULL,
+            PRIMARY KEY (citing_id, cited_id)
+        );
+        """,
+        "CREATE INDEX case_citations_cited_id_idx ON case_citations (cited_id, citing_id);",
+        """
+        CREATE TABLE case_citation_counts (
+            case_id TEXT PRIMARY KEY,
+            in_degree INT NOT NULL DEFAULT 0
+        );
+        """,
+        """
+        CREATE OR REPLACE FUNCTION case_citations_count_inserted()
+        RETURNS trigger AS $$
+        BEGIN
+            INSERT INTO case_citation_counts (case_id, in_degree)
+            SELECT cited_id, COUNT(*) FROM inserted_citations GROUP BY cited_id
+            ON CONFLICT (case_id) DO UPDATE
+                SET in_degree = case_citation_counts.in_degree + EXCLUDED.in_degree;
+            RETURN NULL;
+        END $$ LANGUAGE plpgsql;
+        """,
+        """
+        CREATE OR REPLACE FUNCTION case_citations_count_deleted()
+        RETURNS trigger AS $$
+        BEGIN
+            UPDATE case_citation_counts
+            SET in_degree = case_citation_counts.in_degree - deleted.citations
+            FROM (SELECT cited_id, COUNT(*) AS citations FROM deleted_citations GROUP BY cited_id) AS deleted
+            WHERE case_citation_counts.case_id = deleted.cited_id;
+            RETURN NULL;
+        END $$ LANGUAGE plpgsql;
+        """,
+        """
+        CREATE TRIGGER case_citations_inserted
+        AFTER INSERT ON case_citations
+        REFERENCING NEW TABLE AS inserted_citations
+        FOR EACH STATEMENT EXECUTE FUNCTION case_citations_count_inserted();
+        """,
+        """
+        CREATE TRIGGER case_citations_deleted
+        AFTER DELETE ON case_citations
+        REFERENCING OLD TABLE AS deleted_citations
+        FOR EACH STATEMENT EXECUTE FUNCTION case_citations_count_deleted();
+        """,
+    ]
+
+    for query in queries:
+        await session.execute(text(query))
+    await session.commit()
+    logger.info("Citation tables initialized successfully.")
+
+
+async def upsert_case_citations(session: AsyncSession, case_ids: list[str] | None = None):
+    """
+    Insert the citation edges from the cases in `case_ids`, or from every case when no ids are given.
+    Existing edges are left alone, so this can be run again after new cases are seeded, and the triggers
+    add only the new edges to `case_citation_counts`.
+    """
+    # The edges of a new case are its outgoing ones, the cases it cites may be seeded later
+    case_filter = "WHERE c1.id = ANY(CAST(:case_ids AS TEXT[]))" if case_ids is not None else ""
+    query = text(f"""
+        INSERT INTO case_citations (citing_id, cited_id)
+        SELECT DISTINCT c1.id, case_ids::text
+        FROM public.cases_updated c1
+        JOIN LATERAL jsonb_array_elements(c1.data -> 'cites_to') AS cites_to_element ON true
+        JOIN LATERAL jsonb_array_elements(cites_to_element -> 'case_ids') AS case_ids ON true
+        {case_filter}
+        ON CONFLICT (citing_id, cited_id) DO NOTHING;
+    """)
+    await session.execute(query, {"case_ids": case_ids} if case_ids is not None else {})
+    await session.commit()
+
+
 async def seed_data_from_csv(engine: AsyncEngine, app_identity_name):
     csv_file_path = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../..", "data/cases_final.csv"))
     logger.info(f"Starting data seeding from {csv_file_path} using parameterized INSERT statements.")
 
     async with AsyncSession(engine) as session:
         await initialize_gold_dataset(session)
+        await initialize_citation_tables(session)
 
         batch = []
         try:
@@ -75,8 +165,11 @@ async def seed_data_from_csv(engine: AsyncEngine, app_identity_name):
                     description_vector_str = row["description_vector"]
                     description_vector = json.loads(description_vector_str)
 
+                    # The opinion texts go to case_opinions, the case document only keeps the metadata
+                    opinions = split_opinions(data)
+
                     # Add row to the batch
-                    batch.append((case_id, json.dumps(data), description_vector))
+                    batch.append((case_id, json.dumps(data), description_vector, opinions))
 
                     # When batch size is reached, insert into database
                     if len(batch) >= BATCH_SIZE:
@@ -96,6 +189,11 @@ async def seed_data_from_csv(engine: AsyncEngine, app_identity_name):
 
         await create_plpgsql_functions(session, app_identity_name)
 
+        # Fresh statistics for the planner, then check that court-filtered searches pick the partial indexes
+        await session.execute(text("ANALYZE cases_updated;"))
+        await session.commit()
+        await verify_court_vector_indexes(session)
+
         # # Insert cases as nodes in the graph
         await ingest_cases_to_graph_from_postgresql(session, app_identity_name)
 
@@ -105,15 +203,37 @@ async def seed_data_from_csv(engine: AsyncEngine, app_identity_name):
         await verify_age_query(session, app_identity_name)
 
 
+def split_opinions(data: dict) -> list[dict]:
+    """
+    Remove `casebody` from a case document and return its opinions as case_opinions rows.
+    """
+    casebody = data.pop("casebody", None) or {}
+    return [
+        {
+            "ordinal": ordinal,
+            "type": opinion.get("type"),
+            "author": opinion.get("author"),
+            "text": opinion.get("text") or "",
+        }
+        for ordinal, opinion in enumerate(casebody.get("opinions") or [])
+    ]
+
+
 async def insert_batch(session: AsyncSession, batch):
     """
-    Insert a batch of rows into the database.
+    Insert a batch of rows into the database, with the opinion texts of each case in case_opinions
+    and its citation edges in case_citations.
     """
     query = text("""
-        INSERT INTO cases_updated (id, data, description_vector)
-        VALUES (:id, :data, :description_vector)
+        INSERT INTO cases_updated (id, data, description_vector, opinion_snippet)
+        VALUES (:id, :data, :description_vector, :opinion_snippet)
         ON CONFLICT (id) DO NOTHING
     """)
+    query_opinions = text("""
+        INSERT INTO case_opinions (case_id, ordinal, type, author, text)
+        VALUES (:case_id, :ordinal, :type, :author, :text)
+        ON CONFLICT (case_id, ordinal) DO NOTHING
+    """)
 
     try:
         # Convert description_vector to JSON string format for each row
@@ -122,12 +242,17 @@ async def insert_batch(session: AsyncSession, batch):
                 "id": row[0],
                 "data": row[1],
                 "description_vector": json.dumps(row[2]),  # Convert list to JSON string
+                "opinion_snippet": row[3][0]["text"][:OPINION_SNIPPET_LENGTH] if row[3] else None,
             }
             for row in batch
         ]
+        opinions_prepared = [{"case_id": row[0], **opinion} for row in batch for opinion in row[3]]
 
         await session.execute(query, batch_prepared)
+        if opinions_prepared:
+            await session.execute(query_opinions, opinions_prepared)
         await session.commit()
+        await upsert_case_citations(session, [row[0] for row in batch])
     except Exception as e:
         logger.error(f"Batch insert failed: {e}")
         await session.rollback()
@@ -138,7 +263,7 @@ async def ingest_cases_to_graph_from_postgresql(session, app_identity_name):
     Ingest specific case text from PostgreSQL `cases_updated` table and create nodes in the graph.
     """
     query = text("""
-        SELECT id, data -> 'casebody' -> 'opinions' -> 0 ->> 'text' AS text
+        SELECT id, opinion_snippet AS text
         FROM cases_updated;
     """)
 
@@ -194,10 +319,13 @@ async def ingest_cases_to_graph_from_postgresql(session, app_identity_name):
 
 async def create_edges_from_citations(session):
     """
-    Creates edges in the `case_graph` graph based on citation relationships
-    in the `cases_updated` table.
+    Creates edges in the `case_graph` graph and in the `case_citations` table based on citation
+    relationships in the `cases_updated` table.
     """
     try:
+        await upsert_case_citations(session)
+        logger.info("Citation edges and in-degrees stored in `case_citations` and `case_citation_counts`.")
+
         query_prep = """
             WITH edges AS (
                 SELECT c1.id AS id_from, c2.id AS id_to
@@ -271,13 +399,216 @@ async def verify_age_query(session, app_identity_name):
 async def create_plpgsql_functions(session, app_identity_name):
     deployment_name = os.getenv("AZURE_ML_DEPLOYMENT", "bge-v2-m3-1")
 
+    reranker_cache_ttl = int(os.getenv("RERANKER_CACHE_TTL_SECONDS", 604800))
+
+    function_reranker_scores = text("""
+        CREATE OR REPLACE FUNCTION get_reranker_scores(
+            query_text TEXT,
+            case_ids TEXT[],
+            passages TEXT[],
+            passage_source TEXT
+        )
+        RETURNS TABLE (
+            case_id          TEXT,
+            relevance        DOUBLE PRECISION
+        ) AS $_$
+        #variable_conflict use_column
+        DECLARE
+            -- The passage of a case differs between sources, e.g. opinion text or GraphRAG document text
+            hashed_query TEXT := md5('{deployment_name}' || ':' || passage_source || ':' || query_text);
+            expires_before TIMESTAMPTZ := now() - interval '{reranker_cache_ttl} seconds';
+            missing_ids TEXT[];
+            missing_passages TEXT[];
+            scores JSONB;
+        BEGIN
+            -- A score only holds for the passage it was computed on, so the passage hash is part of the key
+            SELECT array_agg(candidates.case_id ORDER BY candidates.ord),
+                array_agg(candidates.passage ORDER BY candidates.ord)
+            INTO missing_ids, missing_passages
+            FROM unnest(case_ids, passages) WITH ORDINALITY AS candidates(case_id, passage, ord)
+            WHERE NOT EXISTS (
+                SELECT 1 FROM reranker_score_cache cache
+                WHERE cache.query_hash = hashed_query AND cache.case_id = candidates.case_id
+                    AND cache.passage_hash = md5(COALESCE(candidates.passage, ''))
+                    AND cache.created_at > expires_before
+            );
+
+            -- Only the pairs that are not cached yet are sent to the reranker
+            IF missing_ids IS NOT NULL THEN
+                scores := azure_ml.invoke(
+                    (
+                        SELECT jsonb_build_object(
+                            'pairs', jsonb_agg(jsonb_build_array(query_text, missing.passage) ORDER BY missing.ord)
+                        )
+                        FROM unnest(missing_passages) WITH ORDINALITY AS missing(passage, ord)
+                    ),
+                    deployment_name => '{deployment_name}',
+                    timeout_ms => 180000
+                );
+
+                -- Searches run on the replicas too, they read the cache but cannot write it. Only the primary stores
+                -- fresh scores and evicts expired ones, a replica's misses are sent to the reranker on every search.
+                IF NOT pg_is_in_recovery() THEN
+                    INSERT INTO reranker_score_cache (query_hash, case_id, passage_hash, relevance)
+                    SELECT hashed_query, missing_ids[elem.ordinality],
+                        md5(COALESCE(missing_passages[elem.ordinality], '')), elem.relevance::DOUBLE PRECISION
+                    FROM jsonb_array_elements(scores) WITH ORDINALITY AS elem(relevance, ordinality)
+                    ON CONFLICT (query_hash, case_id, passage_hash) DO UPDATE
+                        SET relevance = EXCLUDED.relevance, created_at = now();
+                    DELETE FROM reranker_score_cache cache WHERE cache.created_at <= expires_before;
+                END IF;
+            END IF;
+
+            RETURN QUERY
+            SELECT candidates.case_id, COALESCE(fresh.relevance, cache.relevance)
+            FROM unnest(case_ids, passages) WITH ORDINALITY AS candidates(case_id, passage, ord)
+            LEFT JOIN reranker_score_cache cache
+                ON cache.query_hash = hashed_query AND cache.case_id = candidates.case_id
+                    AND cache.passage_hash = md5(COALESCE(candidates.passage, ''))
+                    AND cache.created_at > expires_before
+            LEFT JOIN (
+                SELECT missing_ids[elem.ordinality] AS case_id, elem.relevance::DOUBLE PRECISION AS relevance
+                FROM jsonb_array_elements(scores) WITH ORDINALITY AS elem(relevance, ordinality)
+            ) AS fresh ON fresh.case_id = candidates.case_id
+            ORDER BY candidates.ord;
+        END;
+        $_$ LANGUAGE plpgsql;
+    """.format(deployment_name=deployment_name, reranker_cache_ttl=reranker_cache_ttl))
+    await session.execute(function_reranker_scores)
+    await session.commit()
+    logger.info("Function get_reranker_scores defined successfully.")
+
+    function_vector_ranked = text("""
+        CREATE OR REPLACE FUNCTION get_vector_ranked(
+            embedding VECTOR,
+            top_n INT,
+            court_ids INT[],
+            decided_from TEXT,
+            decided_to TEXT,
+            jurisdiction TEXT
+        )
+        RETURNS TABLE (
+            vector_rank      BIGINT,
+            id               TEXT,
+            case_name        TEXT,
+            date             TEXT,
+            opinion_snippet  TEXT
+        ) AS $_$
+        #variable_conflict use_variable
+        DECLARE
+            -- First-pass distance, set per transaction by the searcher like hnsw.ef_search. The quantized
+            -- expressions match the expression indexes, the candidates are then re-scored at full precision
+            quantization TEXT := COALESCE(NULLIF(current_setting('search.vector_quantization', true), ''), 'none');
+            oversample INT := COALESCE(NULLIF(current_setting('search.quantization_oversample', true), ''), '1')::INT;
+        BEGIN
+            IF quantization NOT IN ('halfvec', 'binary') THEN
+                oversample := 1;
+            END IF;
+
+            -- One statement per quantization. They are planned on every call with the arguments as constants
+            -- (plan_cache_mode below), a cached generic plan cannot prove the WHERE court_id = <id> predicate of a
+            -- court's partial index, a custom plan for a single court does. The iterative index scan keeps reading
+            -- the HNSW index until the court and date filters let top_n * oversample candidates through.
+            -- Reads the generated columns only, the JSONB document is not detoasted for the candidates
+            IF quantization = 'halfvec' THEN
+                RETURN QUERY
+                WITH candidates AS MATERIALIZED (
+                    SELECT cases_updated.id, cases_updated.case_name, cases_updated.decision_date,
+                        cases_updated.opinion_snippet, cases_updated.description_vector
+                    FROM cases_updated
+                    WHERE cases_updated.court_id = ANY(court_ids)
+                        AND (decided_from IS NULL OR cases_updated.decision_date >= decided_from)
+                        AND (decided_to IS NULL OR cases_updated.decision_date <= decided_to)
+                        AND (jurisdiction IS NULL OR cases_updated.jurisdiction = jurisdiction)
+                    ORDER BY cases_updated.description_vector::halfvec(1536) <=> embedding::halfvec(1536)
+                    LIMIT top_n * oversample
+                )
+                SELECT RANK() OVER (ORDER BY nearest.distance) AS vector_rank,
+                    nearest.id, nearest.case_name, nearest.decision_date AS date, nearest.opinion_snippet
+                FROM (
+                    SELECT candidates.id, candidates.case_name, candidates.decision_date, candidates.opinion_snippet,
+                        candidates.description_vector <=> embedding AS distance
+                    FROM candidates
+                    ORDER BY distance
+                    LIMIT top_n
+                ) AS nearest
+                ORDER BY nearest.distance;
+            ELSIF quantization = 'binary' THEN
+                RETURN QUERY
+                WITH candidates AS MATERIALIZED (
+                    SELECT cases_updated.id, cases_updated.case_name, cases_updated.decision_date,
+                        cases_updated.opinion_snippet, cases_updated.description_vector
+                    FROM cases_updated
+                    WHERE cases_updated.court_id = ANY(court_ids)
+                        AND (decided_from IS NULL OR cases_updated.decision_date >= decided_from)
+                        AND (decided_to IS NULL OR cases_updated.decision_date <= decided_to)
+                        AND (jurisdiction IS NULL OR cases_updated.jurisdiction = jurisdiction)
+                    ORDER BY
+                        binary_quantize(cases_updated.description_vector)::bit(1536) <~> binary_quantize(embedding)
+                    LIMIT top_n * oversample
+                )
+                SELECT RANK() OVER (ORDER BY nearest.distance) AS vector_rank,
+                    nearest.id, nearest.case_name, nearest.decision_date AS date, nearest.opinion_snippet
+                FROM (
+                    SELECT candidates.id, candidates.case_name, candidates.decision_date, candidates.opinion_snippet,
+                        candidates.description_vector <=> embedding AS distance
+                    FROM candidates
+                    ORDER BY distance
+                    LIMIT top_n
+                ) AS nearest
+                ORDER BY nearest.distance;
+            ELSE
+                RETURN QUERY
+                WITH candidates AS MATERIALIZED (
+                    SELECT cases_updated.id, cases_updated.case_name, cases_updated.decision_date,
+                        cases_updated.opinion_snippet, cases_updated.description_vector <=> embedding AS distance
+                    FROM cases_updated
+                    WHERE cases_updated.court_id = ANY(court_ids)
+                        AND (decided_from IS NULL OR cases_updated.decision_date >= decided_from)
+                        AND (decided_to IS NULL OR cases_updated.decision_date <= decided_to)
+                        AND (jurisdiction IS NULL OR cases_updated.jurisdiction = jurisdiction)
+                    ORDER BY cases_updated.description_vector <=> embedding
+                    LIMIT top_n
+                )
+                -- Ranked after the LIMIT so the window does not keep the index from being used, and re-sorted
+                -- because the relaxed iterative scan may return the candidates slightly out of order
+                SELECT RANK() OVER (ORDER BY candidates.distance) AS vector_rank,
+                    candidates.id, candidates.case_name, candidates.decision_date AS date, candidates.opinion_snippet
+                FROM candidates
+                ORDER BY candidates.distance;
+            END IF;
+        END;
+        $_$ LANGUAGE plpgsql
+        SET hnsw.iterative_scan = 'relaxed_order'
+        SET plan_cache_mode = force_custom_plan;
+    """)
+    # The filter parameters were added to the signatures, drop the old overloads
+    await session.execute(text("DROP FUNCTION IF EXISTS get_vector_ranked(VECTOR, INT);"))
+    await session.execute(text("DROP FUNCTION IF EXISTS get_vector_semantic_ranked(TEXT, VECTOR, INT);"))
+    await session.execute(
+        text("DROP FUNCTION IF EXISTS get_vector_semantic_graphrag_optimized(TEXT, VECTOR, INT, INT, TEXT);")
+    )
+    await session.execute(text("DROP FUNCTION IF EXISTS get_msr_graphrag_combined(TEXT, VECTOR, INT, INT, INT);"))
+    # The candidates are returned without the JSONB document, drop the functions whose result type changed
+    await session.execute(text("DROP FUNCTION IF EXISTS get_vector_ranked(VECTOR, INT, INT[], TEXT, TEXT, TEXT);"))
+    await session.execute(
+        text("DROP FUNCTION IF EXISTS get_vector_semantic_ranked(TEXT, VECTOR, INT, INT[], TEXT, TEXT, TEXT);")
+    )
+    await session.execute(function_vector_ranked)
+    await session.commit()
+    logger.info("Function get_vector_ranked defined successfully.")
+
     function_graphrag = text("""
         CREATE OR REPLACE FUNCTION get_vector_semantic_graphrag_optimized(
             query_text TEXT,
             embedding VECTOR,
             top_n INT,
             consider_n INT,
-            sort_option TEXT
+            sort_option TEXT,
+            court_ids INT[],
+            decided_from TEXT,
+            decided_to TEXT,
+            jurisdiction TEXT
         )
         RETURNS TABLE (
             label            TEXT,
@@ -289,6 +620,7 @@ async def create_plpgsql_functions(session, app_identity_name):
             case_name        TEXT,
             date             TEXT,
             data             JSONB,
+            opinion_snippet  TEXT,
             refs             BIGINT,
             relevance        DOUBLE PRECISION
         ) AS $_$
@@ -297,60 +629,36 @@ async def create_plpgsql_functions(session, app_identity_name):
 
             RETURN QUERY
             WITH vector AS (
-                SELECT cases_updated.id,
-                    cases_updated.data#>>'{{name_abbreviation}}' AS case_name,
-                    cases_updated.data#>>'{{decision_date}}' AS date,
-                    cases_updated.data,
-                    RANK() OVER (ORDER BY description_vector <=> embedding) AS vector_rank
-                FROM cases_updated
-                WHERE (cases_updated.data#>>'{{court, id}}')::integer IN (9029)
-                ORDER BY description_vector <=> embedding
-                LIMIT consider_n
-            ),
-            json_payload AS (
-                SELECT jsonb_build_object(
-                    'pairs', 
-                    jsonb_agg(
-                        jsonb_build_array(
-                            query_text, 
-                            LEFT(vector.data -> 'casebody' -> 'opinions' -> 0 ->> 'text', 800)
-                        )
-                    )
-                ) AS json_pairs
-                FROM vector
+                SELECT * FROM get_vector_ranked(
+                    embedding, consider_n, court_ids, decided_from, decided_to, jurisdiction
+                )
             ),
             semantic AS (
-                SELECT elem.relevance::DOUBLE precision AS relevance, elem.ordinality
-                FROM json_payload AS jp,
-                    LATERAL jsonb_array_elements(
-                        azure_ml.invoke(
-                            jp.json_pairs,
-                            deployment_name => '{deployment_name}',
-                            timeout_ms => 180000
-                        )
-                    ) WITH ORDINALITY AS elem(relevance)
+                SELECT scores.case_id AS id, scores.relevance
+                FROM (
+                    SELECT array_agg(vector.id ORDER BY vector.vector_rank) AS ids,
+                        array_agg(vector.opinion_snippet ORDER BY vector.vector_rank) AS passages
+                    FROM vector
+                ) AS candidates,
+                    LATERAL get_reranker_scores(query_text, candidates.ids, candidates.passages, 'cases') AS scores
             ),
             semantic_ranked AS (
                 SELECT RANK() OVER (ORDER BY semantic.relevance DESC) AS semantic_rank,
-                    semantic.*, vector.*
+                    semantic.relevance, vector.*
                 FROM vector
-                JOIN semantic ON vector.vector_rank = semantic.ordinality
+                JOIN semantic ON vector.id = semantic.id
                 ORDER BY semantic.relevance DESC
             ),      
-            graph_query AS (
-                SELECT * FROM ag_catalog.cypher('case_graph', 
-                    $$ MATCH (s)-[r:REF]->(n) RETURN n.case_id AS case_id, s.case_id AS ref_id $$
-                ) AS (case_id TEXT, ref_id TEXT)
-            ),
             graph AS (
                 SELECT subquery.id, COUNT(ref_id) AS refs
                 FROM (
-                    SELECT semantic_ranked.id, graph_query.ref_id, c2.description_vector <=> embedding AS ref_cosine
+                    SELECT semantic_ranked.id, case_citations.citing_id AS ref_id,
+                        c2.description_vector <=> embedding AS ref_cosine
                     FROM semantic_ranked
-                    LEFT JOIN graph_query
-                    ON semantic_ranked.id = graph_query.case_id
+                    JOIN case_citations
+                    ON case_citations.cited_id = semantic_ranked.id
                     LEFT JOIN cases_updated c2
-                    ON c2.id = graph_query.ref_id
+                    ON c2.id = case_citations.citing_id
                     WHERE semantic_ranked.semantic_rank <= 25
                     ORDER BY ref_cosine
                     LIMIT 200
@@ -358,12 +666,16 @@ async def create_plpgsql_functions(session, app_identity_name):
                 GROUP BY subquery.id
             ),
             graph2 AS (
-                SELECT semantic_ranked.*, graph.refs 
+                SELECT semantic_ranked.*, graph.refs, case_citation_counts.in_degree
                 FROM semantic_ranked
                 LEFT JOIN graph ON semantic_ranked.id = graph.id
+                LEFT JOIN case_citation_counts ON case_citation_counts.case_id = semantic_ranked.id
             ),
+            -- Candidates with as many citers near the query are ordered by how often they are cited at all
             graph_ranked AS (
-                SELECT RANK() OVER (ORDER BY COALESCE(graph2.refs, 0) DESC) AS graph_rank, graph2.*
+                SELECT RANK() OVER (
+                    ORDER BY COALESCE(graph2.refs, 0) DESC, COALESCE(graph2.in_degree, 0) DESC
+                ) AS graph_rank, graph2.*
                 FROM graph2
                 ORDER BY graph_rank DESC
             ),
@@ -375,31 +687,112 @@ async def create_plpgsql_functions(session, app_identity_name):
                     graph_ranked.*
                 FROM graph_ranked
                 LEFT JOIN gold_dataset ON graph_ranked.id = gold_dataset.gold_id
+            ),
+            top_ranked AS (
+                SELECT rrf.*
+                FROM rrf
+                ORDER BY
+                    CASE
+                        WHEN sort_option = 'vector_rank' THEN rrf.vector_rank
+                        WHEN sort_option = 'semantic_rank' THEN rrf.semantic_rank
+                    END ASC,
+                    CASE
+                        WHEN sort_option = 'score' THEN rrf.score
+                    END DESC
+                LIMIT top_n
             )
+            -- Only the returned rows read the JSONB document
             SELECT 
-                rrf.label, rrf.score, rrf.graph_rank, rrf.semantic_rank, rrf.vector_rank, rrf.id, rrf.case_name, rrf.date, rrf.data, rrf.refs, rrf.relevance
-            FROM rrf
-            ORDER BY 
-                CASE 
-                    WHEN sort_option = 'vector_rank' THEN rrf.vector_rank
-                    WHEN sort_option = 'semantic_rank' THEN rrf.semantic_rank
+                top_ranked.label, top_ranked.score, top_ranked.graph_rank, top_ranked.semantic_rank,
+                top_ranked.vector_rank, top_ranked.id, top_ranked.case_name, top_ranked.date, cases_updated.data,
+                top_ranked.opinion_snippet, top_ranked.refs, top_ranked.relevance
+            FROM top_ranked
+            JOIN cases_updated ON cases_updated.id = top_ranked.id
+            ORDER BY
+                CASE
+                    WHEN sort_option = 'vector_rank' THEN top_ranked.vector_rank
+                    WHEN sort_option = 'semantic_rank' THEN top_ranked.semantic_rank
                 END ASC,
-                CASE 
-                    WHEN sort_option = 'score' THEN rrf.score
-                END DESC
-            LIMIT top_n;
+                CASE
+                    WHEN sort_option = 'score' THEN top_ranked.score
+                END DESC;
         END;
         $_$ LANGUAGE plpgsql;
-    """.format(deployment_name=deployment_name))
+    """)
+    # The opinion snippet was added to the result type
+    await session.execute(
+        text(
+            "DROP FUNCTION IF EXISTS get_vector_semantic_graphrag_optimized"
+            "(TEXT, VECTOR, INT, INT, TEXT, INT[], TEXT, TEXT, TEXT);"
+        )
+    )
     await session.execute(function_graphrag)
     await session.commit()
     logger.info("Function get_vector_semantic_graphrag_optimized defined successfully.")
 
+    function_semantic_ranked = text("""
+        CREATE OR REPLACE FUNCTION get_vector_semantic_ranked(
+            query_text TEXT,
+            embedding VECTOR,
+            consider_n INT,
+            court_ids INT[],
+            decided_from TEXT,
+            decided_to TEXT,
+            jurisdiction TEXT
+        )
+        RETURNS TABLE (
+            semantic_rank    BIGINT,
+            vector_rank      BIGINT,
+            id               TEXT,
+            case_name        TEXT,
+            date             TEXT,
+            relevance        DOUBLE PRECISION
+        ) AS $_$
+        BEGIN
+            RETURN QUERY
+            WITH vector AS (
+                SELECT * FROM get_vector_ranked(
+                    embedding, consider_n, court_ids, decided_from, decided_to, jurisdiction
+                )
+            ),
+            semantic AS (
+                SELECT scores.case_id AS id, scores.relevance
+                FROM (
+                    SELECT array_agg(vector.id ORDER BY vector.vector_rank) AS ids,
+                        array_agg(vector.opinion_snippet ORDER BY vector.vector_rank) AS passages
+                    FROM vector
+                ) AS candidates,
+                    LATERAL get_reranker_scores(query_text, candidates.ids, candidates.passages, 'cases') AS scores
+            )
+            SELECT RANK() OVER (ORDER BY semantic.relevance DESC) AS semantic_rank,
+                vector.vector_rank, vector.id, vector.case_name, vector.date, semantic.relevance
+            FROM vector
+            JOIN semantic ON vector.id = semantic.id
+            ORDER BY semantic.relevance DESC;
+        END;
+        $_$ LANGUAGE plpgsql;
+    """)
+    await session.execute(function_semantic_ranked)
+    await session.commit()
+    logger.info("Function get_vector_semantic_ranked defined successfully.")
+
+    # The candidate pool and ANN parameters were added to the signature, drop the old overloads
+    await session.execute(text("DROP FUNCTION IF EXISTS get_msr_graphrag_combined(TEXT, VECTOR, INT);"))
+    await session.execute(
+        text("DROP FUNCTION IF EXISTS get_msr_graphrag_combined(TEXT, VECTOR, INT, INT, INT, INT[]);")
+    )
+    await session.commit()
+    # Candidates come from the HNSW indexes on the community reports and text units: the ann_k nearest of each
+    # are expanded through the link tables to (report, text unit) pairs, and only those pairs are scored
     function_msr_graphrag_combined = text("""
         CREATE OR REPLACE FUNCTION get_msr_graphrag_combined(
             query_text TEXT,
             embedding VECTOR,
-            top_n INT
+            top_n INT,
+            consider_n INT DEFAULT 103,
+            graph_candidates INT DEFAULT 39,
+            court_ids INT[] DEFAULT ARRAY[9029],
+            ann_k INT DEFAULT 100
         )
         RETURNS TABLE (
             label            TEXT,
@@ -416,7 +809,32 @@ async def create_plpgsql_functions(session, app_identity_name):
             SET search_path = ag_catalog, "$user", public;
 
             RETURN QUERY
-            WITH msr_graphrag as (SELECT 
+            -- The level filter is applied to the rows the HNSW scan returns, the iterative scan (set on the function)
+            -- keeps scanning until ann_k level-2 reports are found instead of returning fewer
+            WITH top_reports AS (
+				SELECT fcr.id AS report_id, fcr.community
+				FROM final_community_reports fcr
+				WHERE fcr.level = 2
+				ORDER BY fcr.full_content_vector <=> embedding
+				LIMIT ann_k
+			),
+			top_text_units AS (
+				SELECT ftu.id AS text_unit_id
+				FROM final_text_units ftu
+				ORDER BY ftu.text_vector <=> embedding
+				LIMIT ann_k
+			),
+			candidate_pairs AS (
+				SELECT top_reports.report_id, fctu.text_unit_id
+				FROM top_reports
+				JOIN final_community_text_units fctu ON fctu.community = top_reports.community
+				UNION
+				SELECT fcr.id, top_text_units.text_unit_id
+				FROM top_text_units
+				JOIN final_community_text_units fctu ON fctu.text_unit_id = top_text_units.text_unit_id
+				JOIN final_community_reports fcr ON fcr.community = fctu.community AND fcr.level = 2
+			),
+			msr_graphrag as (SELECT 
 				ftd.attributes,
 				fcr.full_content_vector <=> embedding AS summary_score,
 				ftu.text_vector <=> embedding AS vector_score,
@@ -431,14 +849,16 @@ async def create_plpgsql_functions(session, app_identity_name):
 				ftd.title AS document_title,
 				ftd.text AS document_text
 			FROM
-				final_community_reports fcr
+				candidate_pairs
+			JOIN
+				final_community_reports fcr ON fcr.id = candidate_pairs.report_id
 			JOIN
-				final_communities fc ON fcr.community = fc.community
+				final_text_units ftu ON ftu.id = candidate_pairs.text_unit_id
 			JOIN
-				final_text_units ftu ON ftu.id = ANY(fc.text_unit_ids)
+				final_text_unit_documents ftud ON ftud.text_unit_id = ftu.id
 			JOIN
-				final_documents ftd ON ftd.id = ANY(ftu.document_ids)
-			WHERE fcr.level = 2 AND (ftd.attributes#>>'{{court_id}}')::integer IN (9029)
+				final_documents ftd ON ftd.id = ftud.document_id
+			WHERE (ftd.attributes#>>'{court_id}')::integer = ANY(court_ids)
 			),
 			combined_scores AS (
 				SELECT
@@ -469,71 +889,56 @@ async def create_plpgsql_functions(session, app_identity_name):
 				FROM
 					combined_scores
 				ORDER BY msr_rank
-				LIMIT 103
-			),
-			json_payload AS (
-				SELECT jsonb_build_object(
-					'pairs',
-						jsonb_agg(
-							jsonb_build_array(
-								query_text,
-								LEFT(ranked_combined_scores.data, 800)
-							)
-						)
-					) AS json_pairs
-				FROM ranked_combined_scores
+				LIMIT consider_n
 			),
 			semantic AS (
-				SELECT
-					elem.relevance::DOUBLE PRECISION AS relevance,
-					elem.ordinality
-				FROM
-					json_payload AS jp,
-					LATERAL jsonb_array_elements(
-						azure_ml.invoke(
-							jp.json_pairs,
-							deployment_name => '{deployment_name}',
-							timeout_ms => 180000
-					)
-				) WITH ORDINALITY AS elem(relevance)
+				SELECT scores.case_id AS id, scores.relevance
+				FROM (
+					SELECT array_agg(ranked_combined_scores.id ORDER BY ranked_combined_scores.msr_rank) AS ids,
+						array_agg(
+							LEFT(ranked_combined_scores.data, 800) ORDER BY ranked_combined_scores.msr_rank
+						) AS passages
+					FROM ranked_combined_scores
+				) AS candidates,
+					LATERAL get_reranker_scores(query_text, candidates.ids, candidates.passages, 'documents') AS scores
 			),
 			semantic_ranked AS (
 				SELECT
 					RANK() OVER (ORDER BY semantic.relevance DESC) AS semantic_rank,
-					semantic.*, ranked_combined_scores.*
+					semantic.relevance, ranked_combined_scores.*
 				FROM
 					ranked_combined_scores
 				JOIN
-					semantic ON ranked_combined_scores.msr_rank = semantic.ordinality
+					semantic ON ranked_combined_scores.id = semantic.id
 				ORDER BY semantic.relevance DESC
 			),
-			graph_query AS (
-				SELECT * FROM ag_catalog.cypher('case_graph',
-					$$ MATCH (s)-[r:REF]->(n) RETURN n.case_id AS case_id, s.case_id AS ref_id $$
-				) AS (case_id TEXT, ref_id TEXT)
-			),
 			graph AS (
 				SELECT subquery.id, COUNT(ref_id) AS refs
 				FROM (
-					SELECT semantic_ranked.id, graph_query.ref_id, c2.description_vector <=> embedding AS ref_cosine
+					SELECT semantic_ranked.id, case_citations.citing_id AS ref_id,
+						c2.description_vector <=> embedding AS ref_cosine
 					FROM semantic_ranked
-					LEFT JOIN graph_query
-					ON semantic_ranked.id = graph_query.case_id
+					JOIN case_citations
+					ON case_citations.cited_id = semantic_ranked.id
 					LEFT JOIN cases_updated c2
-					ON c2.id = graph_query.ref_id
-					WHERE semantic_ranked.semantic_rank <= 39
+					ON c2.id = case_citations.citing_id
+					WHERE semantic_ranked.semantic_rank <= graph_candidates
 					ORDER BY ref_cosine
 					LIMIT 200
 				) AS subquery
 				GROUP BY subquery.id
 			),
 			graph2 AS (
-				SELECT graph.refs, semantic_ranked.*
+				SELECT graph.refs, case_citation_counts.in_degree, semantic_ranked.*
 				FROM semantic_ranked
 				LEFT JOIN graph ON semantic_ranked.id = graph.id
+				LEFT JOIN case_citation_counts ON case_citation_counts.case_id = semantic_ranked.id
 			),
+			-- Ties in citers near the query are broken by the precomputed in-degree
 			graph_ranked AS (
-				SELECT RANK() OVER (ORDER BY COALESCE(graph2.refs, 0) DESC) AS graph_rank, graph2.*
+				SELECT RANK() OVER (
+					ORDER BY COALESCE(graph2.refs, 0) DESC, COALESCE(graph2.in_degree, 0) DESC
+				) AS graph_rank, graph2.*
 				FROM graph2
                 WHERE refs is not null and refs > 0
 				ORDER BY graph_rank DESC
@@ -553,8 +958,9 @@ async def create_plpgsql_functions(session, app_identity_name):
 			ORDER BY rrf.score DESC
 			LIMIT top_n;
         END;
-        $_$ LANGUAGE plpgsql;
-    """.format(deployment_name=deployment_name))
+        $_$ LANGUAGE plpgsql
+        SET hnsw.iterative_scan = 'relaxed_order';
+    """)
     await session.execute(function_msr_graphrag_combined)
     await session.commit()
     logger.info("Function get_msr_graphrag_combined defined successfully.")
@@ -13,7 +13,7 @@ from sqlalchemy import text
 from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession
 
 from fastapi_app.dependencies import get_azure_credential
-from fastapi_app.embeddings import compute_text_embedding
+from fastapi_app.embeddings import compute_text_embedding, configure_embedding_cache, embedding_cache
 from fastapi_app.openai_clients import create_openai_embed_client
 from fastapi_app.postgres_engine import create_postgres_engine_from_args, create_postgres_engine_from_env
 
@@ -288,6 +288,79 @@ async def initialize_final_community_reports_table(engine: AsyncEngine):
         await initialize_table_from_csv(session, csv_file_path, table_name, query, process_row)
 
 
+async def initialize_link_tables(engine: AsyncEngine):
+    """
+    Normalize `final_communities.text_unit_ids` and `final_text_units.document_ids` into the indexed
+    `final_community_text_units` and `final_text_unit_documents` link tables, so get_msr_graphrag_combined
+    joins on keys instead of array membership.
+    """
+    async with AsyncSession(engine) as session:
+        await create_table(
+            session,
+            "final_community_text_units",
+            """
+            CREATE TABLE final_community_text_units (
+                community INT NOT NULL,
+                text_unit_id TEXT NOT NULL,
+                PRIMARY KEY (community, text_unit_id)
+            );
+        """,
+        )
+        await session.execute(
+            text("""
+            INSERT INTO final_community_text_units (community, text_unit_id)
+            SELECT DISTINCT fc.community, text_unit_id
+            FROM final_communities fc, unnest(fc.text_unit_ids) AS text_unit_id
+            WHERE fc.community IS NOT NULL AND text_unit_id IS NOT NULL
+        """)
+        )
+        await session.execute(
+            text("""
+            CREATE INDEX IF NOT EXISTS idx_final_community_text_units_text_unit_id
+            ON final_community_text_units (text_unit_id);
+        """)
+        )
+        await session.commit()
+
+        await create_table(
+            session,
+            "final_text_unit_documents",
+            """
+            CREATE TABLE final_text_unit_documents (
+                text_unit_id TEXT NOT NULL,
+                document_id TEXT NOT NULL,
+                PRIMARY KEY (text_unit_id, document_id)
+            );
+        """,
+        )
+        await session.execute(
+            text("""
+            INSERT INTO final_text_unit_documents (text_unit_id, document_id)
+            SELECT DISTINCT ftu.id, document_id
+            FROM final_text_units ftu, unnest(ftu.document_ids) AS document_id
+            WHERE document_id IS NOT NULL
+        """)
+        )
+        await session.execute(
+            text("""
+            CREATE INDEX IF NOT EXISTS idx_final_text_unit_documents_document_id
+            ON final_text_unit_documents (document_id);
+        """)
+        )
+        await session.execute(
+            text("""
+            CREATE INDEX IF NOT EXISTS idx_final_community_reports_level_community
+            ON final_community_reports (level, community);
+        """)
+        )
+        await session.commit()
+        await session.execute(
+            text("ANALYZE final_community_text_units, final_text_unit_documents, final_community_reports;")
+        )
+        await session.commit()
+        logger.info("Link tables `final_community_text_units` and `final_text_unit_documents` created successfully.")
+
+
 async def generate_and_update_embeddings(engine: AsyncEngine):
     """
     Generate embeddings for `full_content` and update the `full_content_vector` column.
@@ -464,10 +537,13 @@ async def main():
     else:
         engine = await create_postgres_engine_from_args(args)
 
+    configure_embedding_cache(engine)
+
     await initialize_final_documents_table(engine)
     await initialize_final_text_units_table(engine)
     await initialize_final_communities_table(engine)
     await initialize_final_community_reports_table(engine)
+    await initialize_link_tables(engine)
 
     if args.run_post_embedding == "true":
         await generate_and_update_embeddings(engine)
@@ -476,6 +552,8 @@ async def main():
     await create_hnsw_index(engine)
     await create_hnsw_index_ftu(engine)
 
+    # The persistent embedding cache is written in the background, persist it before the engine goes away
+    await embedding_cache.flush()
     await engine.dispose()
 
 
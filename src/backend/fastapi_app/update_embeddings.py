@@ -9,7 +9,7 @@ from sqlalchemy import select
 from sqlalchemy.ext.asyncio import async_sessionmaker
 
 from fastapi_app.dependencies import common_parameters, get_azure_credential
-from fastapi_app.embeddings import compute_text_embedding
+from fastapi_app.embeddings import compute_text_embedding, configure_embedding_cache, embedding_cache
 from fastapi_app.openai_clients import create_openai_embed_client
 from fastapi_app.postgres_engine import create_postgres_engine_from_env
 from fastapi_app.postgres_models import Item
@@ -20,6 +20,16 @@ logger = logging.getLogger("ragapp")
 async def update_embeddings(in_seed_data=False):
     azure_credential = await get_azure_credential()
     engine = await create_postgres_engine_from_env(azure_credential)
+    configure_embedding_cache(engine)
+    try:
+        await update_embedding_column(engine, azure_credential, in_seed_data)
+    finally:
+        # The persistent embedding cache is written in the background, persist it before the engine goes away
+        await embedding_cache.flush()
+        await engine.dispose()
+
+
+async def update_embedding_column(engine, azure_credential, in_seed_data=False):
     openai_embed_client = await create_openai_embed_client(azure_credential)
     common_params = await common_parameters()
 
@@ -0,0 +1,113 @@
+import pytest
+
+from fastapi_app import caching
+from fastapi_app.caching import TTLCache, hash_key
+from fastapi_app.query_rewriter import rewrite_cache_key
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake_clock = FakeClock()
+    monkeypatch.setattr(caching.time, "monotonic", fake_clock)
+    return fake_clock
+
+
+def test_get_counts_hits_and_misses(clock):
+    cache: TTLCache[str] = TTLCache(maxsize=2, ttl=60)
+    cache.set("a", "value")
+
+    assert cache.get("a") == "value"
+    assert cache.get("b") is None
+    assert cache.stats() == {"size": 1, "maxsize": 2, "hits": 1, "misses": 1, "evictions": 0}
+
+
+def test_entries_expire_after_ttl(clock):
+    cache: TTLCache[str] = TTLCache(maxsize=2, ttl=60)
+    cache.set("a", "value")
+
+    clock.now += 60
+    assert cache.get("a") == "value"
+    clock.now += 1
+    assert cache.get("a") is None
+    # The expired entry is dropped and counted as a miss, not as an eviction
+    assert len(cache) == 0
+    assert cache.stats()["misses"] == 1
+    assert cache.stats()["evictions"] == 0
+
+
+def test_set_refreshes_ttl(clock):
+    cache: TTLCache[str] = TTLCache(maxsize=2, ttl=60)
+    cache.set("a", "old")
+    clock.now += 50
+    cache.set("a", "new")
+    clock.now += 50
+
+    assert cache.get("a") == "new"
+
+
+def test_evicts_least_recently_used(clock):
+    cache: TTLCache[int] = TTLCache(maxsize=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    # Reading a makes b the least recently used entry
+    cache.get("a")
+    cache.set("c", 3)
+
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert cache.stats()["evictions"] == 1
+
+
+def test_zero_maxsize_disables_the_cache(clock):
+    cache: TTLCache[int] = TTLCache(maxsize=0, ttl=60)
+    cache.set("a", 1)
+
+    assert len(cache) == 0
+    assert cache.get("a") is None
+
+
+def test_clear_keeps_counters(clock):
+    cache: TTLCache[int] = TTLCache(maxsize=2, ttl=60)
+    cache.set("a", 1)
+    cache.get("a")
+    cache.clear()
+
+    assert len(cache) == 0
+    assert cache.stats()["hits"] == 1
+
+
+def test_hash_key_separates_parts():
+    assert hash_key("ab", "c") == hash_key("ab", "c")
+    assert hash_key("ab", "c") != hash_key("a", "bc")
+
+
+def test_rewrite_cache_key_normalizes_message_contents():
+    prompt = {"template": "Rewrite the question"}
+    messages = [{"role": "user", "content": "  café   water\n rights "}]
+    normalized = [{"role": "user", "content": "café water rights"}]
+
+    assert rewrite_cache_key(prompt, "gpt-4o", messages) == rewrite_cache_key(prompt, "gpt-4o", normalized)
+
+
+@pytest.mark.parametrize(
+    "prompt, model, content",
+    [
+        ({"template": "Rewrite the question briefly"}, "gpt-4o", "water rights"),
+        ({"template": "Rewrite the question"}, "gpt-4o-mini", "water rights"),
+        ({"template": "Rewrite the question"}, "gpt-4o", "Water rights"),
+    ],
+)
+def test_rewrite_cache_key_depends_on_prompt_model_and_content(prompt, model, content):
+    messages = [{"role": "user", "content": "water rights"}]
+    key = rewrite_cache_key({"template": "Rewrite the question"}, "gpt-4o", messages)
+
+    assert rewrite_cache_key(prompt, model, [{"role": "user", "content": content}]) != key
@@ -0,0 +1,86 @@
+import numpy as np
+
+from fastapi_app.citation_graph import GRAPH_CANDIDATES, GRAPH_REF_LIMIT, RRF_K, CitationGraph, rank
+
+
+def build_graph(case_ids, edges, vectors):
+    """Graph of (citing, cited) case id edges, with the given 2-dimensional vectors of the citing cases."""
+    index = {case_id: i for i, case_id in enumerate(case_ids)}
+    citing = np.array([index[edge[0]] for edge in edges], dtype=np.int32)
+    cited = np.array([index[edge[1]] for edge in edges], dtype=np.int32)
+    vector_rows = np.full(len(case_ids), -1, dtype=np.int32)
+    citer_vectors = np.zeros((len(vectors), 2), dtype=np.float16)
+    for row, (case_id, vector) in enumerate(vectors.items()):
+        citer_vectors[row] = np.array(vector) / np.linalg.norm(vector)
+        vector_rows[index[case_id]] = row
+    return CitationGraph.from_edges(case_ids, citing, cited, citer_vectors, vector_rows)
+
+
+def test_rank_matches_sql_rank():
+    assert rank([3, 1, 3, 2], descending=True) == [1, 4, 1, 3]
+    assert rank([(1, 5), (1, 7), (0, 9)], descending=True) == [2, 1, 3]
+
+
+def test_citers_and_in_degree():
+    graph = build_graph(["a", "b", "c"], [("b", "a"), ("c", "a"), ("c", "b")], {})
+
+    assert sorted(graph.case_ids[i] for i in graph.citers("a")) == ["b", "c"]
+    assert graph.in_degree("a") == 2
+    assert graph.in_degree("c") == 0
+    assert graph.in_degree("unknown") == 0
+    assert graph.edge_count == 3
+
+
+def test_count_refs_keeps_the_closest_citers():
+    citers = [f"citer{i}" for i in range(GRAPH_REF_LIMIT + 1)]
+    edges = [(citer, "a") for citer in citers[:-1]] + [(citers[-1], "b")]
+    # The citer of b is the farthest from the query, so it falls outside GRAPH_REF_LIMIT
+    vectors = {citer: [1.0, 0.0] for citer in citers[:-1]} | {citers[-1]: [0.0, 1.0]}
+    graph = build_graph(["a", "b", *citers], edges, vectors)
+
+    assert graph.count_refs(["a", "b"], [1.0, 0.0]) == {"a": GRAPH_REF_LIMIT}
+
+
+def test_count_refs_sorts_citers_without_a_vector_last():
+    citers = [f"citer{i}" for i in range(GRAPH_REF_LIMIT + 1)]
+    edges = [(citer, "a") for citer in citers[:-1]] + [(citers[-1], "b")]
+    # Far from the query, but a citer without a vector is farther still
+    vectors = {citers[-1]: [0.0, 1.0]}
+    graph = build_graph(["a", "b", *citers], edges, vectors)
+
+    assert graph.count_refs(["a", "b"], [1.0, 0.0]) == {"a": GRAPH_REF_LIMIT - 1, "b": 1}
+
+
+def test_rank_candidates_breaks_ties_by_in_degree():
+    graph = build_graph(["a", "b", "c", "x", "y"], [("x", "b"), ("y", "b")], {"x": [1.0, 0.0], "y": [1.0, 0.0]})
+    # b is past GRAPH_CANDIDATES, so it has no refs counted, like a and c
+    candidates = [
+        {"id": "a", "semantic_rank": 1},
+        {"id": "b", "semantic_rank": GRAPH_CANDIDATES + 1},
+        {"id": "c", "semantic_rank": GRAPH_CANDIDATES + 2},
+    ]
+
+    ranked = {row["id"]: row for row in graph.rank_candidates(candidates, [1.0, 0.0], top=3)}
+
+    assert {case_id: row["graph_rank"] for case_id, row in ranked.items()} == {"a": 2, "b": 1, "c": 2}
+    assert all(row["refs"] is None for row in ranked.values())
+
+
+def test_rank_candidates_fuses_graph_and_semantic_ranks():
+    graph = build_graph(["a", "b", "x", "y"], [("x", "b"), ("y", "b")], {"x": [1.0, 0.0], "y": [1.0, 0.0]})
+    candidates = [{"id": "a", "semantic_rank": 1}, {"id": "b", "semantic_rank": 3}]
+
+    ranked = {row["id"]: row for row in graph.rank_candidates(candidates, [1.0, 0.0], top=2)}
+
+    assert ranked["b"]["refs"] == 2
+    assert ranked["b"]["score"] == 1.0 / (RRF_K + 1) + 1.0 / (RRF_K + 3)
+    assert ranked["a"]["score"] == 1.0 / (RRF_K + 2) + 1.0 / (RRF_K + 1)
+
+
+def test_rank_candidates_returns_the_top_by_score():
+    graph = build_graph(["a", "b", "x", "y"], [("x", "b"), ("y", "b")], {"x": [1.0, 0.0], "y": [1.0, 0.0]})
+    candidates = [{"id": "a", "semantic_rank": 2}, {"id": "b", "semantic_rank": 1}]
+
+    ranked = graph.rank_candidates(candidates, [1.0, 0.0], top=1)
+
+    assert [row["id"] for row in ranked] == ["b"]
@@ -0,0 +1,95 @@
+import re
+
+import pytest
+
+from fastapi_app.context_packer import get_encoding, opinion_char_limit, pack_context
+from fastapi_app.postgres_models import Case
+
+MODEL = "gpt-4o-mini"
+LONG_OPINION = "The court held that the water right was forfeited. " * 400
+
+
+def make_case(case_id: str, opinion_snippet: str | None = None) -> Case:
+    return Case(
+        id=case_id,
+        data={"name_abbreviation": f"State v. Case {case_id}", "decision_date": "2001-05-10"},
+        opinion_snippet=opinion_snippet,
+    )
+
+
+def packed_opinion(content: str, case_id: str) -> str | None:
+    match = re.search(rf"\[{case_id}\]:[^\n]*? \| Opinion: ([^\n]*)", content)
+    return match.group(1) if match else None
+
+
+def token_count(text: str) -> int:
+    return len(get_encoding(MODEL).encode(text))
+
+
+@pytest.mark.parametrize("budget", [120, 500, 2000])
+def test_stays_within_budget(budget):
+    cases = [make_case(str(i)) for i in range(1, 6)]
+    opinion_texts = {case.id: LONG_OPINION for case in cases}
+
+    content, tokens = pack_context(cases, opinion_texts, MODEL, budget)
+
+    assert tokens <= budget
+    assert tokens == token_count(content)
+
+
+def test_every_case_keeps_its_header():
+    cases = [make_case(str(i)) for i in range(1, 4)]
+
+    content, _ = pack_context(cases, {case.id: LONG_OPINION for case in cases}, MODEL, budget=200)
+
+    for case in cases:
+        assert f"[{case.id}]:Case: State v. Case {case.id} | Decided: 2001-05-10" in content
+
+
+def test_higher_ranked_cases_get_more_opinion():
+    cases = [make_case(str(i)) for i in range(1, 4)]
+
+    content, _ = pack_context(cases, {case.id: LONG_OPINION for case in cases}, MODEL, budget=600)
+
+    lengths = [token_count(packed_opinion(content, case.id) or "") for case in cases]
+    assert lengths[0] > lengths[1] > lengths[2] > 0
+
+
+def test_unused_tokens_carry_over_to_lower_ranks():
+    cases = [make_case("1"), make_case("2")]
+
+    long_first, _ = pack_context(cases, {"1": LONG_OPINION, "2": LONG_OPINION}, MODEL, budget=600)
+    short_first, _ = pack_context(cases, {"1": "Affirmed.", "2": LONG_OPINION}, MODEL, budget=600)
+
+    assert packed_opinion(short_first, "1") == "Affirmed."
+    assert len(packed_opinion(short_first, "2") or "") > len(packed_opinion(long_first, "2") or "")
+
+
+def test_falls_back_to_the_snippet():
+    cases = [make_case("1", opinion_snippet="The first 800 characters."), make_case("2")]
+
+    content, _ = pack_context(cases, {}, MODEL, budget=2000)
+
+    assert packed_opinion(content, "1") == "The first 800 characters."
+    # Without an opinion or a snippet there is no opinion label
+    assert packed_opinion(content, "2") is None
+    assert "[2]:Case: State v. Case 2 | Decided: 2001-05-10\n" in content
+
+
+def test_opinion_texts_take_precedence_over_the_snippet():
+    cases = [make_case("1", opinion_snippet="Snippet.")]
+
+    content, _ = pack_context(cases, {"1": "Full opinion."}, MODEL, budget=2000)
+
+    assert packed_opinion(content, "1") == "Full opinion."
+
+
+def test_opinion_prefix_packs_like_the_full_text():
+    cases = [make_case("1"), make_case("2")]
+    budget = 600
+    prefix = LONG_OPINION[: opinion_char_limit(budget)]
+    assert len(prefix) < len(LONG_OPINION)
+
+    assert pack_context(cases, {"1": prefix, "2": prefix}, MODEL, budget) == pack_context(
+        cases, {"1": LONG_OPINION, "2": LONG_OPINION}, MODEL, budget
+    )
@@ -0,0 +1,38 @@
+import pytest
+
+from fastapi_app.api_models import RewritePolicy
+from fastapi_app.query_rewriter import REWRITE_MAX_KEYWORD_TOKENS, rewrite_decision
+
+HISTORY = [
+    {"role": "user", "content": "water rights cases"},
+    {"role": "assistant", "content": "Here are some water rights cases."},
+]
+
+
+@pytest.mark.parametrize(
+    "policy, query, past_messages, expected",
+    [
+        (RewritePolicy.ALWAYS, "water rights", [], (True, "policy is always")),
+        (RewritePolicy.NEVER, "which of them is cited the most?", HISTORY, (False, "policy is never")),
+        (RewritePolicy.AUTO, "water rights", HISTORY, (True, "the conversation has history")),
+        (
+            RewritePolicy.AUTO,
+            " ".join(["water"] * (REWRITE_MAX_KEYWORD_TOKENS + 1)),
+            [],
+            (True, f"more than {REWRITE_MAX_KEYWORD_TOKENS} tokens"),
+        ),
+        (RewritePolicy.AUTO, "their water rights", [], (True, "contains their")),
+        (RewritePolicy.AUTO, "landmark water rights precedent", [], (True, "contains landmark, precedent")),
+        (RewritePolicy.AUTO, "water rights forfeiture?", [], (True, "phrased as a question")),
+        (RewritePolicy.AUTO, "Water Rights forfeiture", [], (False, "short single-turn keyword query")),
+    ],
+)
+def test_rewrite_decision(policy, query, past_messages, expected):
+    assert rewrite_decision(policy, query, past_messages) == expected
+
+
+def test_rewrite_decision_counts_word_tokens():
+    # Punctuation does not count, exactly REWRITE_MAX_KEYWORD_TOKENS words are still searched as is
+    query = ", ".join(["water"] * REWRITE_MAX_KEYWORD_TOKENS)
+
+    assert rewrite_decision(RewritePolicy.AUTO, query, []) == (False, "short single-turn keyword query")
@@ -0,0 +1,66 @@
+import pytest
+
+from fastapi_app.read_replicas import ReadReplicaRouter
+
+
+class FakeSession:
+    def __init__(self, name: str, available: bool = True):
+        self.name = name
+        self.available = available
+        self.closed = False
+
+    async def connection(self):
+        if not self.available:
+            raise ConnectionError(f"{self.name} is down")
+
+    async def close(self):
+        self.closed = True
+
+
+class FakeSessionmaker:
+    def __init__(self, name: str, available: bool = True):
+        self.name = name
+        self.available = available
+        self.sessions: list[FakeSession] = []
+
+    def __call__(self) -> FakeSession:
+        session = FakeSession(self.name, self.available)
+        self.sessions.append(session)
+        return session
+
+
+@pytest.mark.asyncio
+async def test_sessions_round_robin_over_replicas():
+    primary = FakeSessionmaker("primary")
+    replicas = [FakeSessionmaker("replica-1"), FakeSessionmaker("replica-2")]
+    router = ReadReplicaRouter(primary, replicas)
+
+    names = [(await router.session()).name for _ in range(3)]
+
+    assert names == ["replica-1", "replica-2", "replica-1"]
+    assert primary.sessions == []
+
+
+@pytest.mark.asyncio
+async def test_no_replicas_uses_primary():
+    primary = FakeSessionmaker("primary")
+    router = ReadReplicaRouter(primary, [])
+
+    session = await router.session()
+
+    assert session.name == "primary"
+
+
+@pytest.mark.asyncio
+async def test_unavailable_replica_falls_back_to_primary():
+    primary = FakeSessionmaker("primary")
+    replica = FakeSessionmaker("replica", available=False)
+    router = ReadReplicaRouter(primary, [replica], retry_after=60)
+
+    session = await router.session()
+
+    assert session.name == "primary"
+    assert replica.sessions[0].closed
+    # The replica is skipped until retry_after has passed
+    await router.session()
+    assert len(replica.sessions) == 1
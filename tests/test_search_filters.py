@@ -0,0 +1,108 @@
+import pytest
+
+from fastapi_app.search_filters import DEFAULT_COURT_IDS, MAX_COURT_IDS, compile_filters
+
+NO_FILTERS = {"court_ids": DEFAULT_COURT_IDS, "decided_from": None, "decided_to": None, "jurisdiction": None}
+
+
+@pytest.mark.parametrize("filters", [None, []])
+def test_no_filters_search_the_default_courts(filters):
+    assert compile_filters(filters) == NO_FILTERS
+
+
+@pytest.mark.parametrize(
+    "value, court_ids",
+    [
+        (9029, [9029]),
+        ("9029", [9029]),
+    ],
+)
+def test_court_equals(value, court_ids):
+    params = compile_filters([{"column": "court_id", "comparison_operator": "=", "value": value}])
+
+    assert params == NO_FILTERS | {"court_ids": court_ids}
+
+
+def test_court_in_dedups_and_keeps_order():
+    params = compile_filters([{"column": "court_id", "comparison_operator": "IN", "value": [9030, "9029", 9030]}])
+
+    assert params["court_ids"] == [9030, 9029]
+
+
+def test_court_in_is_capped():
+    court_ids = list(range(1, MAX_COURT_IDS + 6))
+
+    params = compile_filters([{"column": "court_id", "comparison_operator": "in", "value": court_ids}])
+
+    assert params["court_ids"] == court_ids[:MAX_COURT_IDS]
+
+
+@pytest.mark.parametrize(
+    "operator, decided_from, decided_to",
+    [
+        ("=", "2001-05-10", "2001-05-10"),
+        (">=", "2001-05-10", None),
+        (">", "2001-05-11", None),
+        ("<=", None, "2001-05-10"),
+        ("<", None, "2001-05-09"),
+    ],
+)
+def test_decision_date_bounds_are_inclusive(operator, decided_from, decided_to):
+    params = compile_filters([{"column": "decision_date", "comparison_operator": operator, "value": "2001-05-10"}])
+
+    assert params == NO_FILTERS | {"decided_from": decided_from, "decided_to": decided_to}
+
+
+def test_decision_date_range():
+    params = compile_filters(
+        [
+            {"column": "decision_date", "comparison_operator": ">", "value": "1999-12-31"},
+            {"column": "decision_date", "comparison_operator": "<", "value": "2001-01-01"},
+        ]
+    )
+
+    assert params["decided_from"] == "2000-01-01"
+    assert params["decided_to"] == "2000-12-31"
+
+
+def test_jurisdiction_equals():
+    params = compile_filters([{"column": "jurisdiction", "comparison_operator": "=", "value": "Washington"}])
+
+    assert params == NO_FILTERS | {"jurisdiction": "Washington"}
+
+
+def test_operator_defaults_to_equals():
+    params = compile_filters([{"column": "jurisdiction", "value": "Washington"}])
+
+    assert params["jurisdiction"] == "Washington"
+
+
+@pytest.mark.parametrize(
+    "filter",
+    [
+        # Columns outside the allow-list, including SQL in the column name
+        {"column": "case_name", "comparison_operator": "=", "value": "State v. Smith"},
+        {"column": "court_id; DROP TABLE cases_updated", "comparison_operator": "=", "value": 9029},
+        # Operators not allowed on the column
+        {"column": "jurisdiction", "comparison_operator": "LIKE", "value": "%Wash%"},
+        {"column": "court_id", "comparison_operator": ">", "value": 9029},
+        {"column": "decision_date", "comparison_operator": "in", "value": ["2001-05-10"]},
+        # Missing or invalid values
+        {"column": "jurisdiction", "comparison_operator": "=", "value": None},
+        {"column": "court_id", "comparison_operator": "=", "value": "Supreme Court"},
+        {"column": "decision_date", "comparison_operator": ">=", "value": "May 2001"},
+    ],
+)
+def test_unsupported_filters_are_skipped(filter):
+    assert compile_filters([filter]) == NO_FILTERS
+
+
+def test_unsupported_filter_does_not_drop_the_others():
+    params = compile_filters(
+        [
+            {"column": "case_name", "comparison_operator": "=", "value": "State v. Smith"},
+            {"column": "court_id", "comparison_operator": "=", "value": 9030},
+        ]
+    )
+
+    assert params["court_ids"] == [9030]
@@ -0,0 +1,40 @@
+import pytest
+
+from fastapi_app.api_models import RetrievalMode
+from fastapi_app.postgres_searcher import (
+    DEFAULT_CONSIDER_N,
+    DEFAULT_GRAPH_CANDIDATES,
+    MAX_CONSIDER_N,
+    MAX_GRAPH_CANDIDATES,
+    PostgresSearcher,
+)
+
+MSR = RetrievalMode.MSRGRAPHRAG
+
+
+def test_defaults():
+    consider_n, _, graph_candidates = PostgresSearcher.search_limits(MSR, 5, None, None)
+
+    assert consider_n == DEFAULT_CONSIDER_N[MSR]
+    assert graph_candidates == DEFAULT_GRAPH_CANDIDATES
+
+
+@pytest.mark.parametrize(
+    "requested, expected",
+    [
+        (10, 10),
+        (0, DEFAULT_GRAPH_CANDIDATES),
+        (-5, 1),
+        (MAX_CONSIDER_N + 1, min(MAX_CONSIDER_N, MAX_GRAPH_CANDIDATES)),
+    ],
+)
+def test_graph_candidates_are_capped(requested, expected):
+    _, _, graph_candidates = PostgresSearcher.search_limits(MSR, 5, MAX_CONSIDER_N, None, graph_candidates=requested)
+
+    assert graph_candidates == expected
+
+
+def test_graph_candidates_stay_within_the_candidate_pool():
+    consider_n, _, graph_candidates = PostgresSearcher.search_limits(MSR, 5, 20, None, graph_candidates=39)
+
+    assert (consider_n, graph_candidates) == (20, 20)